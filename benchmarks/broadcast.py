@@ -0,0 +1,74 @@
+"""Measures the CPU cost of :meth:`WebSocketAwareResource.send` as the number
+of listeners grows, comparing framing the message for every listener (the old
+behaviour) against framing it once per wire protocol.
+
+Sockets are replaced by a stub whose ``sendall`` does nothing so only the
+framing and dispatch overhead is measured::
+
+    python benchmarks/broadcast.py [payload size in bytes]
+"""
+import sys
+import timeit
+
+from eventlet.websocket import WebSocket as v76WebSocket
+
+from stargate import WebSocketAwareResource
+from stargate.view import WebSocket, HixieWebSocket
+
+LISTENER_COUNTS = (10, 100, 1000, 5000)
+ENVIRON = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='/bench')
+
+
+class NullSocket(object):
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        pass
+
+
+class PerListenerResource(WebSocketAwareResource):
+    """Frames the message once for every listener, as ``send`` used to:
+    with ws4py for hybi and eventlet for draft 76
+    """
+
+    def send(self, message, binary=False):
+        for ws in self.listeners:
+            if isinstance(ws, HixieWebSocket):
+                v76WebSocket.send(ws, message)
+            else:
+                frame = ws.stream.text_message(message).single()
+                ws.write_to_connection(frame)
+
+
+def make_resource(klass, count):
+    resource = klass()
+    for i in xrange(count):
+        if i % 2:
+            resource.add_listener(WebSocket(NullSocket(), ENVIRON))
+        else:
+            resource.add_listener(HixieWebSocket(NullSocket(), ENVIRON))
+    return resource
+
+
+def bench(resource, message, repeat=5, number=20):
+    timer = timeit.Timer(lambda: resource.send(message))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main(size=1024):
+    message = 'x' * size
+    print "payload: %d bytes" % size
+    print "%10s %16s %16s %10s" % ('listeners', 'per-listener ms',
+                                   'encode-once ms', 'saved')
+    for count in LISTENER_COUNTS:
+        before = bench(make_resource(PerListenerResource, count), message)
+        after = bench(make_resource(WebSocketAwareResource, count), message)
+        print "%10d %16.3f %16.3f %9.0f%%" % (count, before * 1000,
+                                              after * 1000,
+                                              100 * (1 - after / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
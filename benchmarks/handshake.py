@@ -0,0 +1,88 @@
+"""Measures how many websocket upgrades a second one core completes when
+they are routed by Pyramid and when :class:`~stargate.fastpath.UpgradeMiddleware`
+completes them itself.
+
+The socket is a stub and the view's handler returns straight away, so only
+the routing and handshake are measured::
+
+    python benchmarks/handshake.py
+"""
+import timeit
+
+from pyramid.config import Configurator
+
+from stargate import WebSocketView, is_websocket
+from stargate.fastpath import UpgradeMiddleware
+
+
+class NullSocket(object):
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        pass
+
+
+class NullInput(object):
+
+    def get_socket(self):
+        return NullSocket()
+
+
+class QuickView(WebSocketView):
+
+    def handler(self, websocket):
+        pass
+
+
+def environ():
+    return {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/feeds/prices',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.url_scheme': 'http',
+        'HTTP_HOST': 'localhost',
+        'HTTP_ORIGIN': 'http://localhost',
+        'HTTP_UPGRADE': 'websocket',
+        'HTTP_CONNECTION': 'Upgrade',
+        'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        'HTTP_SEC_WEBSOCKET_VERSION': '13',
+        'eventlet.input': NullInput(),
+    }
+
+
+def pyramid_app():
+    config = Configurator()
+    config.add_route('feeds', '/feeds/*rest')
+    config.add_view(QuickView, route_name='feeds',
+                    custom_predicates=[is_websocket])
+    return config.make_wsgi_app()
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench(app, repeat=5, number=2000):
+    timer = timeit.Timer(lambda: app(environ(), start_response))
+    return number / min(timer.repeat(repeat, number))
+
+
+def main():
+    routed = pyramid_app()
+    fast = UpgradeMiddleware(routed)
+    fast.add_prefix('/feeds/', QuickView)
+    before = bench(routed)
+    after = bench(fast)
+    print "%20s %12s" % ('', 'upgrades/s')
+    print "%20s %12.0f" % ('pyramid routing', before)
+    print "%20s %12.0f" % ('UpgradeMiddleware', after)
+    print "%20s %11.1fx" % ('speedup', after / before)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Measures unmasking client payloads of increasing size, comparing ws4py's
+byte at a time :meth:`ws4py.framing.Frame.mask` against
+:func:`stargate.framing.mask` with and without NumPy::
+
+    python benchmarks/unmask.py
+"""
+import os
+import timeit
+
+from ws4py.framing import Frame
+
+from stargate import framing
+
+SIZES = (16, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+#: ws4py is too slow to bother timing beyond this
+REFERENCE_LIMIT = 1024 * 1024
+
+
+def bench(func, repeat=3):
+    number = 1
+    while True:
+        elapsed = min(timeit.Timer(func).repeat(repeat, number))
+        if elapsed > 0.05 or number > 10000:
+            return elapsed / number
+        number *= 10
+
+
+def mb_per_second(size, seconds):
+    return size / seconds / (1024 * 1024)
+
+
+def main():
+    key = os.urandom(4)
+    print "%10s %14s %14s %14s" % ('bytes', 'ws4py MB/s', 'translate MB/s',
+                                   'numpy MB/s')
+    for size in SIZES:
+        data = os.urandom(size)
+        if size <= REFERENCE_LIMIT:
+            frame = Frame(masking_key=key)
+            reference = '%14.1f' % mb_per_second(
+                size, bench(lambda: frame.mask(data)))
+        else:
+            reference = '%14s' % '-'
+        out = bytearray(size)
+        python = mb_per_second(
+            size, bench(lambda: framing._mask_python(key, data, out)))
+        if framing.numpy is not None:
+            vectorized = '%14.1f' % mb_per_second(
+                size, bench(lambda: framing._mask_numpy(key, data, out)))
+        else:
+            vectorized = '%14s' % 'n/a'
+        print "%10d %s %14.1f %s" % (size, reference, python, vectorized)
+
+
+if __name__ == '__main__':
+    main()
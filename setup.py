@@ -28,12 +28,21 @@ setup(name='stargate',
           'ws4py',
           # -*- Extra requirements: -*-
       ],
+      extras_require={
+          'speedups': ['numpy'],
+          'asyncio': ['trollius'],
+          'msgpack': ['msgpack'],
+      },
       test_suite='nose.collector',
       tests_require=[
         'nose',
         'mock',
       ],
       entry_points = {
-      'paste.server_factory': ['eventlet_server = stargate.factory:server_factory'],
+      'paste.server_factory': [
+          'eventlet_server = stargate.factory:server_factory',
+          'asyncio_server = stargate.aio:server_factory',
+          'prefork_server = stargate.prefork:server_factory',
+      ],
       }
       )
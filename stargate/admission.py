@@ -0,0 +1,164 @@
+"""Admission control: turning upgrades away before the 101 when the process
+is already as busy as it should be
+
+Accepting every connection during a reconnect storm degrades the service
+for every client, old and new. An :class:`Admission` caps the connections
+open at once, in the process and on any one resource, and the rate of
+handshakes. Upgrades over a limit are answered straight away with a
+``503 Service Unavailable`` and a ``Retry-After`` header, before any of the
+handshake is done::
+
+    WebSocketView.admission = Admission(max_connections=20000,
+                                        max_per_resource=5000,
+                                        handshake_rate=500)
+
+Set it on :class:`~stargate.view.WebSocketView` itself (or a common base of
+your views) so that all of them share the one process wide count. The
+resource a connection counts against is the request's ``context``.
+"""
+
+import math
+import time
+
+
+class Overloaded(Exception):
+    """Raised by :meth:`Admission.admit` for a connection over a limit
+
+    :param retry_after: Whole seconds the client should wait before trying
+        again
+    """
+
+    def __init__(self, reason, retry_after):
+        Exception.__init__(self, reason)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Allows ``rate`` events a second on average, and bursts of up to
+    ``burst``
+
+    :param clock: Returns the current time in seconds
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self._clock = clock
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self):
+        """Takes a token, returning False if there are none"""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self):
+        """Seconds until a token will be available"""
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class Ticket(object):
+    """A connection's place, given back with :meth:`release` when the
+    connection is over
+    """
+
+    def __init__(self, admission, resource):
+        self.admission = admission
+        self.resource = resource
+        self.released = False
+
+    def release(self, websocket=None):
+        """Frees the place. Safe to call more than once, and usable as a
+        websocket close callback.
+        """
+        if not self.released:
+            self.released = True
+            self.admission._release(self.resource)
+
+
+class _NoTicket(object):
+
+    def release(self, websocket=None):
+        pass
+
+
+#: The ticket of connections made without admission control
+NO_TICKET = _NoTicket()
+
+
+class Admission(object):
+    """Limits on the connections a process accepts
+
+    :param max_connections: Most connections open at once, or None
+    :param max_per_resource: Most connections open at once per resource, or
+        None
+    :param handshake_rate: Most handshakes a second, averaged by a
+        :class:`TokenBucket`, or None
+    :param handshake_burst: Handshakes allowed at once before
+        ``handshake_rate`` applies, by default a second's worth
+    :param retry_after: Seconds clients turned away for having too many
+        connections are told to wait
+    """
+
+    def __init__(self, max_connections=None, max_per_resource=None,
+                 handshake_rate=None, handshake_burst=None, retry_after=1):
+        self.max_connections = max_connections
+        self.max_per_resource = max_per_resource
+        self.retry_after = retry_after
+        self._bucket = None
+        if handshake_rate is not None:
+            self._bucket = TokenBucket(handshake_rate, handshake_burst)
+        #: Connections currently admitted
+        self.connections = 0
+        #: Upgrades turned away
+        self.rejected = 0
+        self._per_resource = {}
+
+    def connections_to(self, resource):
+        """The connections currently admitted to ``resource``"""
+        return self._per_resource.get(resource, 0)
+
+    def admit(self, resource=None):
+        """Takes a place for a new connection to ``resource``
+
+        :returns: A :class:`Ticket`
+        :raises: :exc:`Overloaded` if a limit has been reached
+        """
+        if self.max_connections is not None and \
+                self.connections >= self.max_connections:
+            self._reject('Too many connections', self.retry_after)
+        counted = self.max_per_resource is not None and resource is not None
+        if counted and self.connections_to(resource) >= self.max_per_resource:
+            self._reject('Too many connections to %s' % resource,
+                         self.retry_after)
+        if self._bucket is not None and not self._bucket.take():
+            self._reject('Too many handshakes', self._bucket.wait())
+        self.connections += 1
+        if counted:
+            self._per_resource[resource] = self.connections_to(resource) + 1
+        else:
+            resource = None
+        return Ticket(self, resource)
+
+    def _reject(self, reason, retry_after):
+        self.rejected += 1
+        raise Overloaded(reason, max(1, int(math.ceil(retry_after))))
+
+    def _release(self, resource):
+        self.connections -= 1
+        if resource is not None:
+            count = self._per_resource[resource] - 1
+            if count:
+                self._per_resource[resource] = count
+            else:
+                del self._per_resource[resource]
@@ -0,0 +1,551 @@
+"""An asyncio :mod:`backend <stargate.backend>`: websockets served from an
+asyncio event loop, with no eventlet and no monkey patching
+
+In a paste config::
+
+    [server:main]
+    use = egg:stargate#asyncio_server
+    host = 0.0.0.0
+    port = 6543
+
+and in the application, :class:`AsyncioWebSocketView` and
+:class:`AsyncioResource` in place of their eventlet counterparts. Only
+asyncio's callback API (protocols and transports) is used, which trollius,
+its Python 2 backport, provides too.
+
+Nothing may block the loop, so a view's
+:meth:`~AsyncioWebSocketView.handler` sets its websocket up and returns, and
+:meth:`~AsyncioWebSocketView.received` is then called with each message as
+it arrives. Writes are buffered by the transport and never wait: a
+broadcast is a loop appending the shared frame to each listener's transport,
+and :meth:`AsyncioResource.publish` drops listeners with more than
+:attr:`~AsyncioResource.max_buffered` bytes still to send rather than
+buffering for them without limit. Outbound queues, conflation and
+:mod:`~stargate.keepalive` are eventlet only.
+
+The HTTP server is deliberately minimal. It reads one request per
+connection, runs the WSGI application on the loop (so ordinary views must
+not block either) and closes the connection after the response, unless the
+request was upgraded to a websocket.
+"""
+
+import errno
+import logging
+import socket
+import sys
+import time
+import urllib
+from io import BytesIO
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from webob import Response
+from ws4py.framing import OPCODE_TEXT, OPCODE_BINARY, OPCODE_PING
+from ws4py.messaging import CloseControlMessage
+
+from stargate.admission import Overloaded
+from stargate.backend import Backend
+from stargate.codec import ObjectMixin
+from stargate.delivery import Delivery, DeliveryStats, FAILED, TIMED_OUT
+from stargate.frames import FrameCache, HYBI, hybi_header
+from stargate.framing import Stream
+from stargate.handshake import websocket_handshake, HandShakeFailed
+from stargate.resource import WebSocketAwareResource
+from stargate.view import CloseCallbacksMixin, WebSocketView, \
+     _handling, _itemsize, _use_extensions
+
+log = logging.getLogger(__name__)
+
+
+class AsyncioBackend(Backend):
+    """An asyncio event loop
+
+    :param loop: The loop to use, by default the current event loop
+    """
+
+    name = 'asyncio'
+
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._servers = []
+
+    @property
+    def loop(self):
+        return self._loop or asyncio.get_event_loop()
+
+    def serve(self, app, host, port):
+        self._serve(app, host=host, port=port)
+
+    def serve_socket(self, app, sock, pool_size=None):
+        self._serve(app, sock=sock)
+
+    def _serve(self, app, **where):
+        loop = self.loop
+        server = loop.run_until_complete(loop.create_server(
+            lambda: HTTPProtocol(app, self), **where))
+        self._servers.append(server)
+        try:
+            loop.run_forever()
+        finally:
+            self._servers.remove(server)
+            server.close()
+
+    #: Seconds between checks for websockets still open while shutting down
+    poll_interval = 0.1
+
+    def shutdown(self):
+        for server in self._servers:
+            server.close()
+        self.loop.call_soon(self._stop_when_closed)
+
+    def _stop_when_closed(self):
+        # the loop is what sends the websockets' buffered close frames
+        if _handling:
+            self.loop.call_later(self.poll_interval, self._stop_when_closed)
+        else:
+            self.loop.stop()
+
+    def after_fork(self):
+        if self._loop is None:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def spawn(self, func, *args):
+        return self.loop.call_soon(func, *args)
+
+    def call_later(self, delay, func, *args):
+        return self.loop.call_later(delay, func, *args)
+
+
+ASYNCIO = AsyncioBackend()
+
+
+def server_factory(global_conf, host, port):
+    """Implements the [server_factory]_ api to serve on an asyncio loop"""
+    port = int(port)
+    def serve(app):
+        ASYNCIO.serve(app, host, port)
+    return serve
+
+
+def parse_request(head):
+    """Builds the CGI part of a WSGI environ from a request's head
+
+    >>> environ = parse_request('GET /a%20b?c=d HTTP/1.1\\r\\nHost: x\\r\\n'
+    ...                         'Content-Length: 0')
+    >>> sorted(environ.items()) # doctest: +NORMALIZE_WHITESPACE
+    [('CONTENT_LENGTH', '0'), ('HTTP_HOST', 'x'), ('PATH_INFO', '/a b'),
+     ('QUERY_STRING', 'c=d'), ('REQUEST_METHOD', 'GET'), ('SCRIPT_NAME', ''),
+     ('SERVER_PROTOCOL', 'HTTP/1.1')]
+
+    :raises: :exc:`ValueError` if it isn't an HTTP request
+    """
+    lines = head.split('\r\n')
+    method, target, version = lines[0].split(' ')
+    if not version.startswith('HTTP/'):
+        raise ValueError(lines[0])
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': urllib.unquote(path),
+        'QUERY_STRING': query,
+        'SERVER_PROTOCOL': version,
+    }
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if not colon:
+            raise ValueError(line)
+        key = name.strip().upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.strip()
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+class HTTPProtocol(asyncio.Protocol):
+    """Serves a single WSGI request and then, if the request upgraded the
+    connection, the websocket it was upgraded to
+    """
+
+    #: Largest request, head and body, that is read
+    max_request_size = 64 * 1024
+
+    def __init__(self, app, backend=ASYNCIO):
+        self.app = app
+        self.backend = backend
+        self.transport = None
+        self.websocket = None
+        self._buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if self.websocket is not None:
+            self.websocket.connection_lost(exc)
+
+    def data_received(self, data):
+        if self.websocket is not None:
+            return self.websocket.feed(data)
+        if self._buffer is None:
+            # a response is on its way, anything more is ignored
+            return
+        self._buffer += data
+        if len(self._buffer) > self.max_request_size:
+            return self._respond('413 Request Entity Too Large')
+        end = self._buffer.find('\r\n\r\n')
+        if end < 0:
+            return
+        try:
+            environ = parse_request(str(self._buffer[:end]))
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return self._respond('400 Bad Request')
+        start = end + 4
+        if len(self._buffer) - start < length:
+            return
+        body = str(self._buffer[start:start + length])
+        rest = str(self._buffer[start + length:])
+        self._buffer = None
+        self.dispatch(environ, body, rest)
+
+    def dispatch(self, environ, body, rest=''):
+        """Runs the application for a parsed request
+
+        :param rest: Anything received after the request, which belongs to
+            the websocket if the request is upgraded
+        """
+        host, port = (self.transport.get_extra_info('sockname') or
+                      ('', 0))[:2]
+        peer = self.transport.get_extra_info('peername') or ('',)
+        environ.update({
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'REMOTE_ADDR': peer[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'stargate.backend': self.backend,
+            'stargate.transport': self.transport,
+        })
+        started = []
+        chunks = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return chunks.append
+        try:
+            result = self.app(environ, start_response)
+            try:
+                upgrade = environ.get('stargate.upgrade')
+                if upgrade is not None:
+                    return self._upgrade(rest, *upgrade)
+                chunks.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            log.exception('Error serving %s', environ['PATH_INFO'])
+            if self.websocket is None:
+                self._respond('500 Internal Server Error')
+            return
+        self._respond(*started, body=''.join(chunks))
+
+    def _upgrade(self, rest, reply, websocket, opened):
+        self.transport.write(reply)
+        self.websocket = websocket
+        opened(websocket)
+        if rest:
+            websocket.feed(rest)
+
+    def _respond(self, status, headers=(), body=''):
+        self._buffer = None
+        lines = ['HTTP/1.1 ' + status]
+        lines.extend('%s: %s' % header for header in headers
+                     if header[0].lower() != 'connection')
+        lines.append('Connection: close')
+        self.transport.write('\r\n'.join(lines) + '\r\n\r\n' + body)
+        self.transport.close()
+
+
+class AsyncioWebSocket(CloseCallbacksMixin, ObjectMixin):
+    """A hybi websocket over an asyncio transport
+
+    Rather than being read from, it is fed what the transport receives and
+    hands each complete message to ``on_message(websocket, message)``.
+    Pings are answered and the close handshake completed as the frames
+    arrive.
+    """
+
+    #: The framing spoken by this websocket, see :mod:`stargate.frames`
+    wire_protocol = HYBI
+    #: Frames smaller than this have their header and payload joined and
+    #: written at once rather than written separately
+    gather_threshold = 16 * 1024
+
+    #: Largest message accepted from the peer, see
+    #: :attr:`stargate.view.WebSocket.max_message_size`
+    max_message_size = Stream.max_message_size
+
+    #: The negotiated :class:`~stargate.deflate.Deflate`, if any
+    deflate = None
+
+    def __init__(self, transport, environ, protocols=None, extensions=None,
+                 on_message=None):
+        self.stream = Stream()
+        self.stream.max_message_size = self.max_message_size
+        self.transport = transport
+        self.environ = environ
+        self.protocols = protocols
+        self.extensions = extensions
+        _use_extensions(self, extensions)
+        self.on_message = on_message
+
+        self.client_terminated = False
+        self.server_terminated = False
+        self._lost = False
+        self.last_received = self.last_active = time.time()
+
+    @property
+    def terminated(self):
+        return self.client_terminated and self.server_terminated
+
+    @property
+    def buffered(self):
+        """Bytes written to the websocket that are still to be sent"""
+        return self.transport.get_write_buffer_size()
+
+    def write_to_connection(self, data):
+        """Writes ``data`` to the transport, which never blocks
+
+        :raises: :exc:`socket.error` with ``EPIPE`` once the websocket is
+            closed
+        """
+        if self.server_terminated or self._lost:
+            raise socket.error(errno.EPIPE, 'The websocket is closed')
+        self.transport.write(data)
+
+    def write_frame(self, frame):
+        """Writes an already built frame, as produced by
+        :mod:`stargate.frames`
+        """
+        self.last_active = time.time()
+        self.write_to_connection(frame)
+
+    def send(self, payload, binary=False):
+        """Sends ``payload``, a string, bytearray or memoryview, as a single
+        message
+        """
+        self.last_active = time.time()
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        if self.deflate is not None:
+            payload = self.deflate.compress(payload)
+            header = hybi_header(len(payload), opcode, rsv1=1)
+        else:
+            header = hybi_header(len(payload) * _itemsize(payload), opcode)
+        if len(payload) < self.gather_threshold:
+            frame = bytearray(header)
+            frame += payload
+            return self.write_to_connection(frame)
+        self.write_to_connection(header)
+        self.transport.write(payload)
+
+    def ping(self, data=''):
+        """Sends a ping frame, which the peer answers with a pong"""
+        self.write_to_connection(hybi_header(len(data), OPCODE_PING) + data)
+
+    def close(self, code=1000, reason=''):
+        """Sends a close frame, if one hasn't been sent, and closes the
+        transport once what has been written to it is sent
+        """
+        if not self.server_terminated and not self._lost:
+            self.transport.write(
+                CloseControlMessage(code=code, reason=reason).single())
+        self.server_terminated = True
+        self.close_connection()
+
+    def close_connection(self):
+        self.transport.close()
+
+    def feed(self, data):
+        """Parses ``data`` received by the transport"""
+        self.last_received = time.time()
+        s = self.stream
+        s.parser.send(data)
+        errors, s.errors = s.errors, []
+        pings, s.pings = s.pings, []
+        s.pongs = []
+        if errors:
+            return self.close(errors[0].code, errors[0].reason)
+        for ping in pings:
+            if not self.server_terminated:
+                self.write_to_connection(s.pong(str(ping.data)))
+        if s.messages:
+            self.last_active = self.last_received
+        while s.messages:
+            message = s.messages.popleft()
+            if s.message is message:
+                s.message = None
+            if self.on_message is not None:
+                self.on_message(self, message)
+        closing = s.closing
+        if closing is not None:
+            self.client_terminated = True
+            self.close(closing.code, closing.reason)
+
+    def connection_lost(self, exc):
+        """Called by the protocol when the transport is closed. Fires the
+        close callbacks.
+        """
+        self._lost = True
+        self.client_terminated = self.server_terminated = True
+        self.fire_close_callbacks()
+
+    def receive_obj(self):
+        """Not available: messages are handed to ``on_message`` as they
+        arrive, decode them there with :meth:`decode_obj`
+
+        :raises TypeError: Always
+        """
+        raise TypeError('Asyncio websockets are not read from, each message '
+                        'is passed to on_message (AsyncioWebSocketView.'
+                        'received) as it arrives, decode it there with '
+                        'decode_obj')
+
+
+class AsyncioWebSocketView(WebSocketView):
+    """A :class:`~stargate.view.WebSocketView` for the asyncio backend
+
+    Subclasses override :meth:`handler`, which is called once the websocket
+    is open, and :meth:`received`. Draft 76 clients are turned away.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.environ = request.environ
+        self.transport = self.environ['stargate.transport']
+
+    def handler(self, websocket):
+        """Sets up a newly opened websocket, for instance by adding it to
+        resources. It mustn't block.
+        """
+
+    def received(self, websocket, message):
+        """Handles a message from ``websocket``
+
+        :param message: A :class:`ws4py.messaging.Message`, ``str(message)``
+            being its payload and ``websocket.decode_obj(message)`` the
+            object it holds
+        """
+
+    def handle_websocket(self, websocket):
+        """Hands the newly opened websocket to :meth:`handler`, closing it
+        (with 1011) if the handler fails
+        """
+        try:
+            self.handler(websocket)
+        except Exception:
+            websocket.close(1011, 'Internal error')
+            raise
+
+    def handle_upgrade(self):
+        """Completes the handshake and arranges for the server to switch
+        the connection over to the websocket once the response is returned
+
+        :returns: :exc:`webob.exc.HTTPBadRequest` if the handshake fails, or
+            :exc:`webob.exc.HTTPServiceUnavailable` if :attr:`admission`
+            turns the connection away
+        """
+        try:
+            ticket = self.admit()
+        except Overloaded:
+            _, val, _ = sys.exc_info()
+            return self.overloaded(val)
+        try:
+            v, handshake_reply = websocket_handshake(
+                self.request.headers, extensions=self.extensions,
+                codecs=self.codecs)
+            if v < 2:
+                raise HandShakeFailed('Draft 76 websockets are not '
+                                      'supported by the asyncio backend')
+        except HandShakeFailed:
+            ticket.release()
+            _, val, _ = sys.exc_info()
+            return self.handshake_failed(val)
+        websocket = AsyncioWebSocket(
+            self.transport, self.environ,
+            extensions=self.environ.get('stargate.extensions'),
+            on_message=self.received)
+        websocket.add_close_callback(ticket.release)
+        _handling.add(websocket)
+        websocket.add_close_callback(_handling.discard)
+        websocket.codec = self.environ.get('stargate.codec') or \
+            self.default_codec
+        self.environ['stargate.upgrade'] = (handshake_reply, websocket,
+                                            self.handle_websocket)
+        return Response()
+
+
+class _Finished(object):
+    """Stands in for the greenthread of a :class:`Delivery` that is done"""
+
+    dead = True
+
+    def __init__(self, result):
+        self._result = result
+
+    def wait(self):
+        return self._result
+
+
+class AsyncioResource(WebSocketAwareResource):
+    """A :class:`~stargate.resource.WebSocketAwareResource` whose listeners
+    are :class:`AsyncioWebSocket` instances
+
+    :meth:`send`, replay and :attr:`tick` batching work as they do with
+    eventlet; writes go straight into each listener's transport buffer.
+    Leave :attr:`queue_size` and :attr:`conflate` unset, their queues are
+    run by green threads.
+    """
+
+    backend = ASYNCIO
+
+    #: Bytes a listener may have waiting to be sent before :meth:`publish`
+    #: gives up on it
+    max_buffered = 1024 * 1024
+
+    def publish(self, message, binary=False, timeout=None, key=None):
+        """Writes ``message`` to every listener straight away
+
+        Listeners with more than :attr:`max_buffered` bytes still to be
+        sent are counted as timed out, and they and listeners that fail are
+        removed and disconnected. ``timeout`` is ignored as no write waits.
+        The message is numbered and kept for
+        :meth:`~stargate.resource.WebSocketAwareResource.replay`.
+
+        :returns: A finished :class:`~stargate.delivery.Delivery`
+        """
+        frames = self._sequenced(FrameCache(message, binary, key))
+        stats = DeliveryStats()
+        for ws in list(self.listeners):
+            if getattr(ws, 'buffered', 0) > self.max_buffered:
+                outcome = TIMED_OUT
+            else:
+                try:
+                    outcome = self._write(ws, frames)
+                except (socket.error, IOError):
+                    outcome = FAILED
+            stats.record(ws, outcome)
+        self._drop(stats.dropped)
+        return Delivery(_Finished(stats))
@@ -0,0 +1,130 @@
+"""The I/O backends stargate can run on
+
+Everything that has to wait on a socket or a clock goes through a
+:class:`Backend`, so the same resources can be served by eventlet's green
+threads (:data:`EVENTLET`, the default) or by an asyncio event loop
+(:data:`stargate.aio.ASYNCIO`) in processes where monkey patching isn't
+acceptable::
+
+    class Feed(WebSocketAwareResource):
+        backend = get_backend('asyncio')
+
+Backends are looked up by name so that a backend's event loop library is
+only imported when that backend is asked for.
+"""
+
+import eventlet
+from eventlet import greenio, hubs, wsgi
+from greenlet import GreenletExit
+
+#: Where each named backend lives, as ``module:attribute``
+BACKENDS = {
+    'eventlet': 'stargate.backend:EVENTLET',
+    'asyncio': 'stargate.aio:ASYNCIO',
+}
+
+
+class Backend(object):
+    """The handful of event loop operations stargate relies on"""
+
+    #: The name the backend is looked up by, see :func:`get_backend`
+    name = None
+
+    def serve(self, app, host, port):
+        """Serves the WSGI ``app`` on ``host`` and ``port`` until stopped"""
+        raise NotImplementedError
+
+    def serve_socket(self, app, sock, pool_size=None):
+        """Serves the WSGI ``app`` on the already listening ``sock`` until
+        stopped
+
+        :param pool_size: Most connections served at once, where the
+            backend limits them
+        """
+        raise NotImplementedError
+
+    def after_fork(self):
+        """Called in a forked process before it serves anything, so that
+        the child doesn't share the parent's event loop
+        """
+
+    def shutdown(self):
+        """Stops serving: no more connections are accepted and
+        :meth:`serve` or :meth:`serve_socket` returns once those open are
+        done with
+        """
+        raise NotImplementedError
+
+    def spawn(self, func, *args):
+        """Runs ``func(*args)`` concurrently with the caller"""
+        raise NotImplementedError
+
+    def call_later(self, delay, func, *args):
+        """Calls ``func(*args)`` after ``delay`` seconds
+
+        :returns: An object whose ``cancel()`` stops the call if it hasn't
+            happened yet
+        """
+        raise NotImplementedError
+
+
+class EventletBackend(Backend):
+    """Green threads and :mod:`eventlet.wsgi`"""
+
+    name = 'eventlet'
+
+    def __init__(self):
+        self._servers = []
+
+    def serve(self, app, host, port):
+        self._serve(eventlet.listen((host, port)), app)
+
+    def serve_socket(self, app, sock, pool_size=None):
+        pool = None
+        if pool_size is not None:
+            pool = eventlet.GreenPool(pool_size)
+        self._serve(greenio.GreenSocket(sock), app, custom_pool=pool)
+
+    def _serve(self, sock, app, **kwargs):
+        # in a greenthread of its own, as closing the socket doesn't wake an
+        # accept waiting on it but killing the greenthread does, and
+        # wsgi.server still waits for the open connections
+        server = eventlet.spawn(wsgi.server, sock, app, **kwargs)
+        self._servers.append(server)
+        try:
+            server.wait()
+        except GreenletExit:
+            pass
+        finally:
+            self._servers.remove(server)
+
+    def shutdown(self):
+        for server in list(self._servers):
+            server.kill()
+
+    def after_fork(self):
+        hubs.use_hub()
+
+    def spawn(self, func, *args):
+        return eventlet.spawn(func, *args)
+
+    def call_later(self, delay, func, *args):
+        return eventlet.spawn_after(delay, func, *args)
+
+
+EVENTLET = EventletBackend()
+
+
+def get_backend(name):
+    """Returns the backend called ``name``
+
+    :raises: :exc:`ValueError` for an unknown backend and
+        :exc:`ImportError` if the backend's event loop library isn't
+        installed
+    """
+    try:
+        module, attribute = BACKENDS[name].split(':')
+    except KeyError:
+        raise ValueError('Unknown backend %r, expected one of %s' %
+                         (name, ', '.join(sorted(BACKENDS))))
+    return getattr(__import__(module, fromlist=[attribute]), attribute)
@@ -0,0 +1,353 @@
+"""Backplanes deliver resource broadcasts to every worker process
+
+Listeners are held per process, so with more than one worker a plain
+:meth:`~stargate.resource.WebSocketAwareResource.send` only reaches the
+clients connected to the worker it was called in. When a resource has a
+``backplane`` its :meth:`send` publishes the message to the backplane instead
+and every worker, including the sending one, delivers it to its own listeners
+by looking the resource's path up in its
+:class:`~stargate.registry.ResourceRegistry`::
+
+    registry = ResourceRegistry()
+    backplane = UnixSocketBackplane(registry, '/tmp/stargate.sock')
+    backplane.start()
+    WebSocketAwareResource.registry = registry
+    WebSocketAwareResource.backplane = backplane
+
+With the :mod:`prefork server <stargate.prefork>` the application is loaded
+before the workers are forked, so start the backplane in each worker, from
+its ``post_fork`` hook, rather than as the application is made.
+
+:meth:`~stargate.resource.WebSocketAwareResource.publish` doesn't go through
+the backplane, its :class:`~stargate.delivery.Delivery` accounts for each
+listener it writes to, so it only reaches this worker's listeners. Use
+:meth:`send` for messages every worker's clients must receive.
+
+Two implementations are provided:
+
+* :class:`UnixSocketBackplane` talks to a :class:`UnixSocketBroker` over a
+  local Unix domain socket, suitable for workers on one host and needing no
+  external services
+* :class:`AdapterBackplane` wraps a :class:`BrokerAdapter` for Redis style
+  pub/sub brokers, see :class:`RedisAdapter`
+"""
+
+import errno
+import logging
+import os
+import struct
+
+import eventlet
+from eventlet.green import socket
+from eventlet.semaphore import Semaphore
+
+log = logging.getLogger(__name__)
+
+#: Length of the record, lengths of the path and the conflation key, flags
+HEADER = struct.Struct('!IHHB')
+FLAG_BINARY = 0x1
+FLAG_KEY = 0x2
+
+
+class BackplaneError(Exception):
+    """Raised when a backplane can't publish a message"""
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def pack_message(path, message, binary=False, key=None):
+    """Serializes a broadcast for sending over a backplane
+
+    The conflation ``key``, if any, travels as a string.
+
+    >>> unpack_message(pack_message('/jobs/1', 'hi')[4:])
+    ('/jobs/1', 'hi', False, None)
+    """
+    path = _encode(path)
+    message = _encode(message)
+    flags = FLAG_BINARY if binary else 0
+    if key is None:
+        key = ''
+    else:
+        key = _encode(key)
+        flags |= FLAG_KEY
+    length = HEADER.size - 4 + len(path) + len(key) + len(message)
+    return HEADER.pack(length, len(path), len(key), flags) + path + key + \
+           message
+
+
+def unpack_message(record):
+    """Reverses :func:`pack_message` for a record without its length prefix
+
+    :returns: A tuple of ``(path, message, binary, key)``
+    """
+    path_length, key_length, flags = struct.unpack_from('!HHB', record)
+    start = HEADER.size - 4
+    path = record[start:start + path_length]
+    start += path_length
+    key = record[start:start + key_length] if flags & FLAG_KEY else None
+    message = record[start + key_length:]
+    return path, message, bool(flags & FLAG_BINARY), key
+
+
+def read_records(sock):
+    """Yields the length prefixed records read from ``sock`` until it closes"""
+    buf = ''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        buf += data
+        while len(buf) >= 4:
+            length = struct.unpack_from('!I', buf)[0]
+            if len(buf) < length + 4:
+                break
+            yield buf[4:length + 4]
+            buf = buf[length + 4:]
+
+
+class Backplane(object):
+    """Base class for backplanes
+
+    Subclasses implement :meth:`publish` and arrange for every message
+    published by any worker to be passed to :meth:`dispatch` in every worker.
+
+    :param registry: The :class:`~stargate.registry.ResourceRegistry` used to
+        find the local resource for a path
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def start(self):
+        """Starts receiving messages"""
+
+    def close(self):
+        """Stops receiving messages and releases any connections"""
+
+    def publish(self, path, message, binary=False, key=None):
+        """Publishes ``message`` for the resource at ``path`` to all workers"""
+        raise NotImplementedError
+
+    def dispatch(self, path, message, binary=False, key=None):
+        """Delivers a published message to this worker's listeners
+
+        :returns: The number of local listeners written to
+        """
+        return self.registry.publish(path, message, binary, key)
+
+
+class LocalBackplane(Backplane):
+    """A backplane for a single process, messages are dispatched directly"""
+
+    def publish(self, path, message, binary=False, key=None):
+        self.dispatch(path, message, binary, key)
+
+
+class UnixSocketBroker(object):
+    """Relays every record it receives to all connected backplanes
+
+    It can run in a greenthread of one of the workers or as a process of its
+    own::
+
+        python -m stargate.backplane /tmp/stargate.sock
+
+    :param address: Filesystem path of the Unix domain socket to listen on
+    """
+
+    def __init__(self, address):
+        self.address = address
+        #: The write lock of each connected backplane, by its socket
+        self.clients = {}
+        self._server = None
+        self._listener = None
+
+    def listen(self):
+        """Binds the listening socket, replacing a stale socket file"""
+        try:
+            os.unlink(self.address)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._listener = eventlet.listen(self.address, family=socket.AF_UNIX)
+
+    def start(self):
+        """Listens and serves in a new greenthread"""
+        self.listen()
+        self._server = eventlet.spawn(self.serve)
+        return self._server
+
+    def serve(self):
+        if self._listener is None:
+            self.listen()
+        while True:
+            client, _ = self._listener.accept()
+            self.clients[client] = Semaphore()
+            eventlet.spawn_n(self._relay, client)
+
+    def close(self):
+        if self._server is not None:
+            self._server.kill()
+        for client in list(self.clients):
+            client.close()
+        self.clients.clear()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _relay(self, client):
+        try:
+            for record in read_records(client):
+                packet = struct.pack('!I', len(record)) + record
+                for other, lock in self.clients.items():
+                    self._send(other, lock, packet)
+        except socket.error:
+            pass
+        finally:
+            self.clients.pop(client, None)
+            client.close()
+
+    def _send(self, client, lock, packet):
+        # Each publisher has a greenthread relaying its records, the lock
+        # keeps their writes to a subscriber from interleaving
+        try:
+            with lock:
+                client.sendall(packet)
+        except socket.error:
+            # Drop the subscriber. Shutting it down ends its relay, which
+            # closes it.
+            if self.clients.pop(client, None) is not None:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class UnixSocketBackplane(Backplane):
+    """A :class:`Backplane` connected to a :class:`UnixSocketBroker`
+
+    :param registry: See :class:`Backplane`
+    :param address: The broker's socket path
+    """
+
+    def __init__(self, registry, address):
+        super(UnixSocketBackplane, self).__init__(registry)
+        self.address = address
+        self._sock = None
+        self._reader = None
+        # Serialises publishes from this worker's greenthreads
+        self._write_lock = Semaphore()
+
+    def start(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        self._sock = sock
+        self._reader = eventlet.spawn(self._read)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.kill()
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def publish(self, path, message, binary=False, key=None):
+        if self._sock is None:
+            raise BackplaneError('Not connected to %s' % self.address)
+        try:
+            with self._write_lock:
+                self._sock.sendall(pack_message(path, message, binary, key))
+        except socket.error, e:
+            raise BackplaneError('Lost connection to %s: %s' % (self.address,
+                                                                e))
+
+    def _read(self):
+        for record in read_records(self._sock):
+            try:
+                self.dispatch(*unpack_message(record))
+            except Exception:
+                log.exception('Failed dispatching backplane message')
+        log.warning('Backplane connection to %s closed', self.address)
+
+
+class BrokerAdapter(object):
+    """Interface between :class:`AdapterBackplane` and a pub/sub broker
+
+    Implementations only need to move opaque byte strings around; the
+    backplane takes care of encoding paths and messages.
+    """
+
+    def publish(self, channel, data):
+        """Publishes ``data`` on ``channel``"""
+        raise NotImplementedError
+
+    def listen(self, channel):
+        """Returns an iterator over the data published to ``channel``
+
+        It is consumed in a greenthread so must cooperate with eventlet,
+        either by using green sockets or by running under monkey patching.
+        """
+        raise NotImplementedError
+
+
+class RedisAdapter(BrokerAdapter):
+    """A :class:`BrokerAdapter` for a redis-py compatible client
+
+    :param client: A ``redis.StrictRedis`` (or API compatible) instance
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def publish(self, channel, data):
+        self.client.publish(channel, data)
+
+    def listen(self, channel):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(channel)
+        for item in pubsub.listen():
+            if item['type'] == 'message':
+                yield item['data']
+
+
+class AdapterBackplane(Backplane):
+    """A :class:`Backplane` publishing through a :class:`BrokerAdapter`
+
+    :param registry: See :class:`Backplane`
+    :param adapter: A :class:`BrokerAdapter`
+    :param channel: The broker channel shared by all the workers
+    """
+
+    def __init__(self, registry, adapter, channel='stargate'):
+        super(AdapterBackplane, self).__init__(registry)
+        self.adapter = adapter
+        self.channel = channel
+        self._reader = None
+
+    def start(self):
+        self._reader = eventlet.spawn(self._read)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.kill()
+            self._reader = None
+
+    def publish(self, path, message, binary=False, key=None):
+        self.adapter.publish(self.channel,
+                             pack_message(path, message, binary, key)[4:])
+
+    def _read(self):
+        for record in self.adapter.listen(self.channel):
+            try:
+                self.dispatch(*unpack_message(record))
+            except Exception:
+                log.exception('Failed dispatching backplane message')
+
+
+if __name__ == '__main__':
+    import sys
+    UnixSocketBroker(sys.argv[1]).serve()
@@ -0,0 +1,189 @@
+"""Message codecs: objects in and out of websocket messages, agreed with each
+client as a subprotocol
+
+A view lists the codecs it speaks, most preferred first::
+
+    class Feed(WebSocketView):
+        codecs = (MSGPACK, JSON)
+
+and a client asking for ``Sec-WebSocket-Protocol: json`` gets a websocket
+whose ``codec`` is :data:`JSON`, with which it sends and receives objects::
+
+    websocket.send_obj({'price': 10})
+    order = websocket.receive_obj()
+
+Websockets that didn't agree a codec use the view's ``default_codec``.
+Draft 76 websockets, which can't carry binary messages, use :data:`JSON`
+whatever the ``default_codec``. Asyncio websockets hand messages to their
+view as they arrive rather than being read from, and the view decodes them
+with ``websocket.decode_obj(message)``.
+
+Broadcasting an object with
+:meth:`~stargate.resource.WebSocketAwareResource.send_obj` encodes it at most
+once per codec in use by the listeners (see :class:`ObjectFrames`), and then
+frames each encoding once per wire protocol as with any other message.
+
+:data:`MSGPACK` needs the ``msgpack`` package and is ignored in negotiation
+without it.
+"""
+
+try:
+    import json
+except ImportError: #pragma NO COVER
+    import simplejson as json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from stargate.frames import FrameCache
+
+
+class Codec(object):
+    """Turns objects into message payloads and back"""
+
+    #: The subprotocol the codec is negotiated as
+    name = None
+    #: Whether the encoded messages are sent as binary messages
+    binary = False
+    #: Whether the codec can be used in this process
+    available = True
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.name)
+
+
+class JSONCodec(Codec):
+    """Compact JSON text messages"""
+
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(str(data))
+
+
+class MsgpackCodec(Codec):
+    """`MessagePack <http://msgpack.org>`_ binary messages"""
+
+    name = 'msgpack'
+    binary = True
+    available = msgpack is not None
+
+    def encode(self, obj):
+        return msgpack.packb(obj)
+
+    def decode(self, data):
+        return msgpack.unpackb(str(data))
+
+
+class RawCodec(Codec):
+    """Payloads passed through unchanged as binary messages, for clients
+    that do their own encoding
+    """
+
+    name = 'raw'
+    binary = True
+
+    def encode(self, obj):
+        if isinstance(obj, unicode):
+            return obj.encode('utf-8')
+        return obj
+
+    def decode(self, data):
+        return data
+
+
+JSON = JSONCodec()
+MSGPACK = MsgpackCodec()
+RAW = RawCodec()
+
+
+def negotiate_codec(header, codecs):
+    """Picks the first of ``codecs`` offered in a ``Sec-WebSocket-Protocol``
+    ``header``
+
+    >>> negotiate_codec('chat, json', [MSGPACK, RAW, JSON])
+    <JSONCodec json>
+
+    :returns: The :class:`Codec` or None if there is none in common
+    """
+    offered = set(name.strip() for name in (header or '').split(','))
+    for codec in codecs:
+        if codec.available and codec.name in offered:
+            return codec
+    return None
+
+
+class ObjectMixin(object):
+    """Adds :meth:`send_obj` and :meth:`receive_obj` to a websocket with
+    ``send(payload, binary)`` and ``receive()`` methods
+    """
+
+    #: The :class:`Codec` objects are sent and received with
+    codec = JSON
+
+    def send_obj(self, obj):
+        """Encodes ``obj`` with the websocket's :attr:`codec` and sends it"""
+        codec = self.codec
+        self.send(codec.encode(obj), codec.binary)
+
+    def receive_obj(self):
+        """Receives the next message and decodes it with the websocket's
+        :attr:`codec`, returning None once the connection is closed
+        """
+        return self.decode_obj(self.receive())
+
+    def decode_obj(self, message):
+        """Decodes a ``message`` received by the websocket with its
+        :attr:`codec`. None is passed through.
+        """
+        if message is not None:
+            return self.codec.decode(message)
+
+
+class ObjectFrames(object):
+    """The frames for an object broadcast to listeners using any number of
+    codecs
+
+    The object is encoded the first time a listener using each codec needs
+    it and the encoding is then framed, once per wire protocol, by a
+    :class:`~stargate.frames.FrameCache`.
+    """
+
+    #: Unknown until the object is encoded, see
+    #: :meth:`stargate.offload.Offloader.worth_it`
+    size = None
+
+    def __init__(self, obj, key=None):
+        self.message = obj
+        self.key = key
+        self._caches = {}
+
+    def for_codec(self, codec):
+        """Returns the :class:`~stargate.frames.FrameCache` for listeners
+        using ``codec``, :data:`JSON` if it is None
+        """
+        codec = codec or JSON
+        try:
+            return self._caches[codec]
+        except KeyError:
+            cache = FrameCache(codec.encode(self.message), codec.binary,
+                               self.key)
+            self._caches[codec] = cache
+            return cache
+
+    def with_message(self, obj):
+        return ObjectFrames(obj, self.key)
+
+    def prepare(self, targets):
+        for codec, protocol in targets:
+            self.for_codec(codec).frame_for(protocol)
@@ -0,0 +1,310 @@
+"""The permessage-deflate websocket extension ([rfc7692]_)
+
+Compression is switched on by listing a :class:`PerMessageDeflate` in a
+view's :attr:`~stargate.view.WebSocketView.extensions`::
+
+    class Feed(WebSocketView):
+        extensions = (PerMessageDeflate(server_max_window_bits=12),)
+
+When a client offers the extension the handshake negotiates a
+:class:`Deflate` with it, which then compresses every message the websocket
+sends and decompresses the compressed messages it receives.
+
+With ``server_no_context_takeover`` (the default here) each message is
+compressed on its own, so a broadcast is compressed once, by the
+:class:`DeflateProtocol` for its parameters, and the same frame written to
+every listener that negotiated them. With context
+takeover each listener's messages are compressed in turn with its own
+compressor, which compresses better but costs a compression per listener.
+
+.. [rfc7692] http://tools.ietf.org/html/rfc7692
+"""
+
+import zlib
+
+from stargate.frames import encode_hybi, _encode
+
+NAME = 'permessage-deflate'
+#: Appended by a sync flush, stripped from (and restored to) each message
+TAIL = '\x00\x00\xff\xff'
+
+
+def parse_extensions(header):
+    """Parses a ``Sec-WebSocket-Extensions`` header into a list of
+    ``(name, [(param, value), ...])`` offers, value being None for a
+    parameter without one
+
+    >>> parse_extensions('permessage-deflate; client_max_window_bits, foo')
+    [('permessage-deflate', [('client_max_window_bits', None)]), ('foo', [])]
+    """
+    offers = []
+    for offer in (header or '').split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        if not parts[0]:
+            continue
+        params = []
+        for part in parts[1:]:
+            if not part:
+                continue
+            key, _, value = part.partition('=')
+            params.append((key.strip(), value.strip().strip('"') or None))
+        offers.append((parts[0], params))
+    return offers
+
+
+def _window_bits(value):
+    if value is None or not value.isdigit() or value.startswith('0'):
+        raise ValueError(value)
+    bits = int(value)
+    if not 8 <= bits <= 15:
+        raise ValueError(value)
+    return bits
+
+
+class PerMessageDeflate(object):
+    """The server's configuration of permessage-deflate
+
+    :param server_max_window_bits: The largest LZ77 window, as a power of
+        two, used to compress. A client may ask for a smaller one.
+    :param client_max_window_bits: The largest window the client is asked to
+        compress with, if it says it can be asked
+    :param server_no_context_takeover: Compress every message on its own,
+        which lets broadcasts share a compressed frame. Always done if the
+        client asks.
+    :param client_no_context_takeover: Ask the client to compress every
+        message on its own, so no decompressor is kept between messages
+    :param level: The zlib compression level
+    """
+
+    name = NAME
+
+    def __init__(self, server_max_window_bits=15, client_max_window_bits=15,
+                 server_no_context_takeover=True,
+                 client_no_context_takeover=False, level=6):
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.level = level
+
+    def accept(self, params):
+        """Negotiates a :class:`Deflate` from one offer's parameters
+
+        :returns: The :class:`Deflate` or None to decline the offer
+        """
+        offered = {}
+        for key, value in params:
+            if key in offered:
+                return None
+            offered[key] = value
+        server_bits = self.server_max_window_bits
+        client_bits = None
+        server_no_context = self.server_no_context_takeover
+        client_no_context = self.client_no_context_takeover
+        try:
+            for key, value in offered.iteritems():
+                if key == 'server_no_context_takeover':
+                    if value is not None:
+                        return None
+                    server_no_context = True
+                elif key == 'client_no_context_takeover':
+                    if value is not None:
+                        return None
+                    client_no_context = True
+                elif key == 'server_max_window_bits':
+                    server_bits = min(server_bits, _window_bits(value))
+                elif key == 'client_max_window_bits':
+                    client_bits = self.client_max_window_bits
+                    if value is not None:
+                        client_bits = min(client_bits, _window_bits(value))
+                else:
+                    return None
+        except ValueError:
+            return None
+        if server_bits == 8:
+            # zlib can't produce raw deflate streams with a 256 byte window
+            return None
+        return Deflate(server_bits, client_bits, server_no_context,
+                       client_no_context, self.level,
+                       'server_max_window_bits' in offered)
+
+
+class DeflateProtocol(object):
+    """The ``wire_protocol`` (see :mod:`stargate.frames`) of websockets
+    compressing each message on its own with the same parameters, whose
+    compressed frames are interchangeable
+
+    Equal, and hashing equally, to any other with the same parameters. It
+    holds no compression state: each frame is compressed with a compressor
+    of its own, so building a broadcast's frame never touches the state of
+    a listener's own sends.
+    """
+
+    def __init__(self, server_max_window_bits=15, level=6):
+        self._key = (server_max_window_bits, level)
+
+    @property
+    def server_max_window_bits(self):
+        return self._key[0]
+
+    @property
+    def level(self):
+        return self._key[1]
+
+    def __eq__(self, other):
+        if not isinstance(other, DeflateProtocol):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return '<DeflateProtocol window_bits=%d level=%d>' % self._key
+
+    def encode(self, message, binary=False):
+        """Builds a compressed frame for ``message``"""
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      -self.server_max_window_bits)
+        compressed = compressor.compress(_encode(message)) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed.endswith(TAIL):
+            compressed = compressed[:-4]
+        return encode_hybi(compressed, binary, compressed=True)
+
+
+class Deflate(object):
+    """The permessage-deflate parameters agreed with one client, and its
+    compression state
+    """
+
+    def __init__(self, server_max_window_bits=15, client_max_window_bits=None,
+                 server_no_context_takeover=True,
+                 client_no_context_takeover=False, level=6,
+                 send_server_bits=False):
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.level = level
+        self._send_server_bits = send_server_bits or \
+            server_max_window_bits < 15
+        self._compressor = None
+        self._decompressor = None
+        self._compressing = None
+        self._current = None
+
+    @property
+    def shareable(self):
+        """Whether the frames built for one client can be sent to another"""
+        return self.server_no_context_takeover
+
+    @property
+    def wire_protocol(self):
+        """The :class:`DeflateProtocol` building frames shared with other
+        clients, or None if they can't be
+        """
+        if self.shareable:
+            return DeflateProtocol(self.server_max_window_bits, self.level)
+        return None
+
+    def response_params(self):
+        """The extension as it is sent back in the handshake response"""
+        params = [NAME]
+        if self.server_no_context_takeover:
+            params.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            params.append('client_no_context_takeover')
+        if self._send_server_bits:
+            params.append('server_max_window_bits=%d' %
+                          self.server_max_window_bits)
+        if self.client_max_window_bits is not None:
+            params.append('client_max_window_bits=%d' %
+                          self.client_max_window_bits)
+        return '; '.join(params)
+
+    def compress(self, data, final=True):
+        """Compresses a whole message's payload or, with ``final`` unset,
+        the next part of one, returning as much as is ready
+        """
+        compressor = self._compressing
+        if compressor is None:
+            compressor = self._compressor
+            if compressor is None:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                              -self.server_max_window_bits)
+                if not self.server_no_context_takeover:
+                    self._compressor = compressor
+            self._compressing = compressor
+        if isinstance(data, bytearray):
+            data = buffer(data)
+        elif isinstance(data, memoryview):
+            data = data.tobytes()
+        compressed = compressor.compress(data)
+        if final:
+            self._compressing = None
+            compressed += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if compressed.endswith(TAIL):
+                compressed = compressed[:-4]
+        return compressed
+
+    def decompress(self, data, final=True, max_size=None):
+        """Decompresses a whole message's payload or, with ``final`` unset,
+        the next part of one
+
+        :param max_size: Most bytes the payload may decompress to, or None.
+            Decompression stops as soon as it is exceeded.
+        :raises: :exc:`zlib.error` if it isn't valid and :exc:`ValueError`
+            if it decompresses to more than ``max_size``
+        """
+        decompressor = self._current
+        if decompressor is None:
+            decompressor = self._decompressor
+            if decompressor is None:
+                decompressor = zlib.decompressobj(
+                    -(self.client_max_window_bits or 15))
+                if not self.client_no_context_takeover:
+                    self._decompressor = decompressor
+            self._current = decompressor
+        if isinstance(data, bytearray):
+            data = buffer(data)
+        if max_size is None:
+            decompressed = decompressor.decompress(data)
+            if final:
+                decompressed += decompressor.decompress(TAIL)
+        else:
+            # a byte over the limit shows it was exceeded, whatever is
+            # left in unconsumed_tail is never inflated
+            decompressed = decompressor.decompress(data, max_size + 1)
+            if final and len(decompressed) <= max_size:
+                decompressed += decompressor.decompress(
+                    TAIL, max_size + 1 - len(decompressed))
+            if len(decompressed) > max_size:
+                self._current = None
+                raise ValueError('Decompressed to more than %d bytes' %
+                                 max_size)
+        if final:
+            self._current = None
+        return decompressed
+
+
+def negotiate(header, extensions):
+    """Picks the first offer in the ``Sec-WebSocket-Extensions`` ``header``
+    accepted by each of ``extensions``
+
+    :returns: A list of the negotiated extensions
+    """
+    accepted = []
+    offers = parse_extensions(header)
+    for extension in extensions:
+        for name, params in offers:
+            if name == extension.name:
+                negotiated = extension.accept(params)
+                if negotiated is not None:
+                    accepted.append(negotiated)
+                    break
+    return accepted
@@ -0,0 +1,133 @@
+"""This module implements the concurrent fan-out behind
+:meth:`WebSocketAwareResource.publish <stargate.resource.WebSocketAwareResource.publish>`
+
+Each listener is written to in its own greenthread from a bounded
+:class:`eventlet.greenpool.GreenPool` under its own write timeout, so a client
+with a full TCP window only ever delays itself.
+"""
+
+import eventlet
+from eventlet import GreenPile
+from eventlet.green import socket
+
+from stargate.frames import write_message
+
+DELIVERED = 'delivered'
+FAILED = 'failed'
+TIMED_OUT = 'timed_out'
+#: Queued in place of an older message for the same key, which is lost, see
+#: :class:`~stargate.outbound.ConflatingQueue`
+CONFLATED = 'conflated'
+#: The listener's queue was full so a message was thrown away, this one or
+#: an older one waiting, see :class:`~stargate.outbound.OutboundQueue`
+DISCARDED = 'discarded'
+
+
+class DeliveryStats(object):
+    """Outcome of a single :meth:`publish`
+
+    ``delivered``, ``conflated``, ``discarded``, ``failed`` and
+    ``timed_out`` count listeners, ``dropped`` holds the websockets which
+    failed or timed out and were removed from the resource. Listeners with
+    outbound queues count as delivered once the message is queued, unless
+    queueing it lost a message (see :data:`CONFLATED` and
+    :data:`DISCARDED`).
+    """
+
+    def __init__(self):
+        self.delivered = 0
+        self.conflated = 0
+        self.discarded = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.dropped = []
+
+    @property
+    def listeners(self):
+        """The number of listeners the message was published to"""
+        return self.delivered + self.conflated + self.discarded + \
+            self.failed + self.timed_out
+
+    def record(self, ws, outcome):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        if outcome in (FAILED, TIMED_OUT):
+            self.dropped.append(ws)
+
+    def __repr__(self):
+        return '<DeliveryStats delivered=%d conflated=%d discarded=%d ' \
+            'failed=%d timed_out=%d>' % (self.delivered, self.conflated,
+                                         self.discarded, self.failed,
+                                         self.timed_out)
+
+
+class Delivery(object):
+    """A handle on a publish that is in progress
+
+    Returned by :meth:`~stargate.resource.WebSocketAwareResource.publish`
+    straight away, :meth:`wait` blocks until every listener has either been
+    written to or given up on.
+    """
+
+    def __init__(self, greenthread):
+        self._gt = greenthread
+
+    def wait(self):
+        """Waits for the fan-out to finish
+
+        :returns: :class:`DeliveryStats`
+        """
+        return self._gt.wait()
+
+    @property
+    def ready(self):
+        """True once every listener has been dealt with"""
+        return self._gt.dead
+
+
+def write_with_timeout(ws, frames, timeout, write=write_message):
+    """Writes ``frames`` to ``ws`` giving up after ``timeout`` seconds
+
+    :param write: The function doing the write, called with ``ws`` and
+        ``frames``. It may return the outcome, such as :data:`CONFLATED` for
+        a message it queued, None meaning :data:`DELIVERED`.
+    :returns: One of :data:`DELIVERED`, :data:`CONFLATED`,
+        :data:`DISCARDED`, :data:`FAILED` or :data:`TIMED_OUT`
+    """
+    timer = eventlet.Timeout(timeout)
+    try:
+        outcome = write(ws, frames)
+    except eventlet.Timeout, t:
+        if t is not timer:
+            raise
+        return TIMED_OUT
+    except (socket.error, IOError):
+        return FAILED
+    finally:
+        timer.cancel()
+    return outcome or DELIVERED
+
+
+def fan_out(pool, listeners, frames, timeout, write=write_message):
+    """Writes ``frames`` to each of ``listeners`` concurrently
+
+    Blocks until all writes are finished; run it in its own greenthread for
+    a non-blocking publish.
+
+    :param pool: The :class:`eventlet.greenpool.GreenPool` bounding the number
+        of writes in flight
+    :param listeners: The websockets to write to
+    :param frames: A :class:`stargate.frames.FrameCache`
+    :param timeout: Seconds allowed for each listener's write
+    :param write: See :func:`write_with_timeout`
+    :returns: :class:`DeliveryStats`
+    """
+    pile = GreenPile(pool)
+    for ws in listeners:
+        pile.spawn(_write, ws, frames, timeout, write)
+    stats = DeliveryStats()
+    for ws, outcome in pile:
+        stats.record(ws, outcome)
+    return stats
+
+def _write(ws, frames, timeout, write):
+    return ws, write_with_timeout(ws, frames, timeout, write)
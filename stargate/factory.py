@@ -1,18 +1,21 @@
 """This module provides a paste [server_factory]_ to run pyramid inside an
-eventlet wsgi server
+eventlet wsgi server, or on an asyncio event loop with ``backend = asyncio``
 
 See `Paste Deploy <http://pythonpaste.org/deploy/#paste-server-factory>`_
 for more details.
 """
 
-import eventlet
-from eventlet import wsgi
+from stargate.backend import get_backend
 
 
-def server_factory(global_conf, host, port):
-    """Implements the [server_factory]_ api to provide an eventlet wsgi server"""
+def server_factory(global_conf, host, port, backend='eventlet'):
+    """Implements the [server_factory]_ api to provide an eventlet wsgi server
+
+    :param backend: The name of the :mod:`I/O backend <stargate.backend>`
+        to serve with
+    """
     port = int(port)
+    backend = get_backend(backend)
     def serve(app):
-        listener = eventlet.listen((host, port))
-        wsgi.server(listener, app)
-    return serve
\ No newline at end of file
+        backend.serve(app, host, port)
+    return serve
@@ -0,0 +1,117 @@
+"""WSGI middleware completing websocket upgrades without going through
+Pyramid
+
+An upgrade routed by Pyramid pays for the router, traversal, the
+:func:`~stargate.is_websocket` predicate, view lookup and a full
+:class:`webob.Request` before the handshake even starts, which during a
+reconnect storm is most of the work. :class:`UpgradeMiddleware` sits in front
+of the application and hands upgrade requests for the paths registered with
+it straight to their view::
+
+    app = UpgradeMiddleware(config.make_wsgi_app())
+    app.add_prefix('/feeds/', FeedView,
+                   context=lambda request: registry.lookup(request.path_info))
+    app.add_pattern(r'^/jobs/(?P<job>\\d+)$', JobView, context=jobs)
+
+Views are ordinary :class:`~stargate.view.WebSocketView` subclasses. They
+are given an :class:`UpgradeRequest` carrying the environ, the headers, the
+``context`` registered with the path (or returned by it, if it is callable)
+and, for patterns, the ``matchdict`` of the pattern's named groups. Anything
+else, including upgrades for paths that aren't registered, is passed on to
+the application.
+"""
+
+import re
+
+from webob.headers import EnvironHeaders
+
+
+class UpgradeRequest(object):
+    """The little of a request a :class:`~stargate.view.WebSocketView`
+    needs, built without parsing anything
+    """
+
+    def __init__(self, environ, context=None, matchdict=None):
+        self.environ = environ
+        self.headers = EnvironHeaders(environ)
+        self.context = context
+        self.matchdict = matchdict or {}
+
+    @property
+    def path_info(self):
+        return self.environ.get('PATH_INFO', '')
+
+
+def is_upgrade(environ):
+    """Whether ``environ`` is a websocket upgrade request
+
+    >>> is_upgrade({'HTTP_UPGRADE': 'WebSocket'})
+    True
+    >>> is_upgrade({'HTTP_UPGRADE': 'h2c'})
+    False
+    """
+    return environ.get('HTTP_UPGRADE', '').lower() == 'websocket'
+
+
+class UpgradeMiddleware(object):
+    """Completes the upgrades for registered paths and passes everything
+    else on to ``app``
+
+    Paths are matched in the order they were registered and the first match
+    wins.
+
+    :param app: The WSGI application wrapped
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = []
+
+    def add_prefix(self, prefix, view, context=None):
+        """Upgrades requests for paths starting with ``prefix`` with ``view``
+
+        :param view: A :class:`~stargate.view.WebSocketView` subclass
+        :param context: The request's ``context``, or a callable returning
+            it when called with the :class:`UpgradeRequest`
+        """
+        def match(path):
+            if path.startswith(prefix):
+                return {}
+        self._routes.append((match, view, context))
+
+    def add_pattern(self, pattern, view, context=None):
+        """Upgrades requests for paths matching the regular expression
+        ``pattern`` with ``view``, see :meth:`add_prefix`
+
+        The pattern's named groups become the request's ``matchdict``.
+        """
+        regex = re.compile(pattern)
+        def match(path):
+            found = regex.match(path)
+            if found is not None:
+                return found.groupdict()
+        self._routes.append((match, view, context))
+
+    def route(self, environ):
+        """Returns the view for ``environ`` and the request to give it, or
+        None if the path isn't registered
+        """
+        path = environ.get('PATH_INFO', '')
+        for match, view, context in self._routes:
+            matchdict = match(path)
+            if matchdict is not None:
+                request = UpgradeRequest(environ, matchdict=matchdict)
+                if callable(context):
+                    context = context(request)
+                request.context = context
+                return view, request
+        return None
+
+    def __call__(self, environ, start_response):
+        if is_upgrade(environ):
+            routed = self.route(environ)
+            if routed is not None:
+                view, request = routed
+                response = view(request)()
+                return response(environ, start_response)
+        return self.app(environ, start_response)
@@ -0,0 +1,220 @@
+"""This module builds websocket wire frames independently of any socket so
+that a message broadcast to many clients is only framed once per protocol
+version.
+
+Each of the stargate websocket classes advertises the framing it speaks via
+a ``wire_protocol`` attribute and accepts pre-built bytes through
+``write_frame``. Websockets that don't (plain
+:class:`eventlet.websocket.WebSocket` instances for example) are handed the
+message itself and left to frame it.
+
+A wire protocol is either one of the names in :data:`ENCODERS` or an object
+with an ``encode(message, binary)`` method, such as a
+:class:`~stargate.deflate.DeflateProtocol`; websockets whose wire protocols
+are equal share the frames built for them. Building a frame must not depend
+on, or change, the state of any one connection.
+"""
+
+import struct
+
+from ws4py.framing import Frame, OPCODE_TEXT, OPCODE_BINARY
+
+#: The RFC 6455 / hybi framing used by :class:`stargate.view.WebSocket`
+HYBI = 'hybi'
+#: The ``0x00 ... 0xFF`` framing from draft 76 (and earlier) of the spec
+HIXIE76 = 'hixie-76'
+
+
+def _encode(message):
+    if isinstance(message, unicode):
+        return message.encode('utf-8')
+    elif isinstance(message, bytearray):
+        return str(message)
+    elif isinstance(message, memoryview):
+        return message.tobytes()
+    return message
+
+def hybi_header(length, opcode=OPCODE_TEXT, fin=1, rsv1=0):
+    """Build the header of an unmasked hybi frame with a ``length`` byte
+    payload, for writing ahead of a payload that isn't to be copied
+
+    >>> hybi_header(5)
+    '\\x81\\x05'
+    >>> hybi_header(200, OPCODE_BINARY)
+    '\\x82~\\x00\\xc8'
+    """
+    first = chr((fin << 7) | (rsv1 << 6) | opcode)
+    if length < 126:
+        return first + chr(length)
+    elif length < (1 << 16):
+        return first + '\x7e' + struct.pack('!H', length)
+    return first + '\x7f' + struct.pack('!Q', length)
+
+def encode_hybi(message, binary=False, compressed=False):
+    """Build an unmasked, unfragmented hybi frame for ``message``
+
+    ``compressed`` sets the RSV1 bit marking a permessage-deflate payload.
+    """
+    opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+    return Frame(opcode=opcode, body=_encode(message), fin=1,
+                 rsv1=int(compressed)).build()
+
+def encode_hixie76(message, binary=False):
+    """Build a draft 76 frame for ``message``
+
+    .. note:: Draft 76 has no binary frames, ``binary`` is accepted for
+        symmetry with :func:`encode_hybi` and ignored.
+    """
+    return "\x00" + _encode(message) + "\xFF"
+
+ENCODERS = {
+    HYBI: encode_hybi,
+    HIXIE76: encode_hixie76,
+}
+
+def _encoder(protocol):
+    try:
+        return ENCODERS[protocol]
+    except KeyError:
+        return protocol.encode
+
+
+class FrameCache(object):
+    """Lazily builds and remembers the frames for a single message
+
+    One of these is created per broadcast and shared between all of the
+    listeners receiving it, so whether there are 5 or 5000 of them the
+    message is framed at most once for each protocol in use.
+
+    ``key`` optionally names what the message is about, letting a
+    :class:`~stargate.outbound.ConflatingQueue` replace an older message for
+    the same key that is still waiting to be written.
+    """
+
+    def __init__(self, message, binary=False, key=None):
+        self.message = message
+        self.binary = binary
+        self.key = key
+        self._frames = {}
+
+    def frame_for(self, protocol):
+        """Returns the bytes for ``message`` framed for ``protocol``"""
+        try:
+            return self._frames[protocol]
+        except KeyError:
+            frame = _encoder(protocol)(self.message, self.binary)
+            self._frames[protocol] = frame
+            return frame
+
+    @property
+    def size(self):
+        """The length of the message"""
+        return len(self.message)
+
+    def for_codec(self, codec):
+        """The frames for listeners using ``codec``: the message is already
+        encoded, so these same ones (see :mod:`stargate.codec`)
+        """
+        return self
+
+    def with_message(self, message):
+        """Returns a new cache for ``message`` sent the same way"""
+        return FrameCache(message, self.binary, self.key)
+
+    def prepare(self, targets):
+        """Builds the frames for each ``(codec, protocol)`` of ``targets``
+        ahead of time, see :meth:`stargate.offload.Offloader.prepare`
+        """
+        for codec, protocol in targets:
+            self.for_codec(codec).frame_for(protocol)
+
+    def send_unframed(self, ws):
+        """Sends the message with ``ws.send`` for websockets without a
+        ``wire_protocol``
+        """
+        if self.binary:
+            ws.send(self.message, binary=True)
+        else:
+            ws.send(self.message)
+
+
+class FrameBatch(object):
+    """Several :class:`FrameCache` objects written out as one
+
+    The frames of all the messages are joined, once per protocol, so that a
+    listener receives the whole batch in a single write.
+    """
+
+    key = None
+
+    def __init__(self, caches):
+        self.caches = caches
+        self._frames = {}
+        self._codecs = {}
+
+    def __len__(self):
+        return len(self.caches)
+
+    def frame_for(self, protocol):
+        """Returns the frames for every message, back to back"""
+        try:
+            return self._frames[protocol]
+        except KeyError:
+            frame = ''.join([cache.frame_for(protocol)
+                             for cache in self.caches])
+            self._frames[protocol] = frame
+            return frame
+
+    @property
+    def size(self):
+        """The combined length of the messages, or None if some of them
+        aren't encoded yet
+        """
+        sizes = [cache.size for cache in self.caches]
+        if None in sizes:
+            return None
+        return sum(sizes)
+
+    def for_codec(self, codec):
+        """The batch of the messages' frames for listeners using
+        ``codec``
+        """
+        try:
+            return self._codecs[codec]
+        except KeyError:
+            caches = [cache.for_codec(codec) for cache in self.caches]
+            if all(a is b for a, b in zip(caches, self.caches)):
+                batch = self
+            else:
+                batch = FrameBatch(caches)
+            self._codecs[codec] = batch
+            return batch
+
+    def prepare(self, targets):
+        """Builds the joined frames for each ``(codec, protocol)`` of
+        ``targets`` ahead of time
+        """
+        for codec, protocol in targets:
+            self.for_codec(codec).frame_for(protocol)
+
+    def send_unframed(self, ws):
+        for cache in self.caches:
+            cache.send_unframed(ws)
+
+
+def write_message(ws, frames):
+    """Writes the message held in ``frames`` to ``ws``
+
+    Uses the cached frame when ``ws`` supports pre-built frames and falls back
+    to ``ws.send`` otherwise.
+
+    :param ws: A websocket
+    :param frames: A :class:`FrameCache`, :class:`FrameBatch` or
+        :class:`~stargate.codec.ObjectFrames`
+    """
+    frames = frames.for_codec(getattr(ws, 'codec', None))
+    protocol = getattr(ws, 'wire_protocol', None)
+    if protocol is None:
+        frames.send_unframed(ws)
+    else:
+        ws.write_frame(frames.frame_for(protocol))
@@ -0,0 +1,493 @@
+"""Parsing of incoming hybi frames
+
+ws4py's parser unmasks client payloads a byte at a time in Python and
+handles one frame per read. This module provides a drop in replacement
+:class:`Stream` for :class:`stargate.view.WebSocket` whose parser unmasks
+whole payloads at once with :func:`mask`:
+
+* with NumPy installed, payloads are XORed 32 bits at a time in C
+* otherwise every fourth byte of the payload is XORed with the same byte
+  of the key by :meth:`str.translate`, a lookup table per key byte
+
+Outgoing frames are still built by ws4py.
+"""
+
+import codecs
+from collections import deque
+import struct
+import zlib
+
+from ws4py.framing import OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, \
+     OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG
+from ws4py import messaging
+from ws4py.messaging import CloseControlMessage, PingControlMessage, \
+     PongControlMessage
+from ws4py.streaming import Stream as BaseStream, VALID_CLOSING_CODES
+
+try:
+    import numpy
+except ImportError: #pragma NO COVER
+    numpy = None
+
+#: Payloads shorter than this are unmasked in pure Python even with NumPy
+NUMPY_THRESHOLD = 4096
+
+#: Payloads shorter than this are unmasked a byte at a time, which is quicker
+#: than slicing and translating them four ways (see benchmarks/unmask.py)
+LOOP_THRESHOLD = 20
+
+
+_tables = {}
+
+def _table(byte):
+    """A :meth:`str.translate` table XORing every byte with ``byte``"""
+    try:
+        return _tables[byte]
+    except KeyError:
+        table = _tables[byte] = ''.join([chr(i ^ ord(byte))
+                                         for i in xrange(256)])
+        return table
+
+def _mask_python(key, data, out, offset=0):
+    """XORs ``data`` with ``key`` by translating every fourth byte"""
+    length = len(data)
+    if length < LOOP_THRESHOLD:
+        key = bytearray(key)
+        for i, byte in enumerate(bytearray(data)):
+            out[offset + i] = byte ^ key[i & 3]
+        return
+    end = offset + length
+    for i in xrange(4):
+        out[offset + i:end:4] = data[i::4].translate(_table(key[i]))
+
+def _mask_numpy(key, data, out, offset=0):
+    """XORs ``data`` with ``key`` a 32 bit word at a time"""
+    length = len(data)
+    if length < NUMPY_THRESHOLD:
+        return _mask_python(key, data, out, offset)
+    words = length // 4
+    target = numpy.frombuffer(out, dtype=numpy.uint8, count=words * 4,
+                              offset=offset)
+    numpy.bitwise_xor(numpy.frombuffer(data, dtype=numpy.uint32, count=words),
+                      numpy.frombuffer(key, dtype=numpy.uint32)[0],
+                      out=target.view(numpy.uint32))
+    if length > words * 4:
+        _mask_python(key, data[words * 4:], out, offset + words * 4)
+
+if numpy is not None:
+    mask_into = _mask_numpy
+else: #pragma NO COVER
+    mask_into = _mask_python
+mask_into.__doc__ = """Writes ``data`` masked with the 4 byte ``key`` into
+    the :class:`bytearray` ``out``, starting at ``offset``
+    """
+
+def mask(key, data):
+    """Masks (or unmasks) ``data`` with the 4 byte ``key``
+
+    :returns: A new :class:`bytearray`
+
+    >>> str(mask('abcd', str(mask('abcd', 'hello'))))
+    'hello'
+    """
+    out = bytearray(len(data))
+    mask_into(key, data, out)
+    return out
+
+
+class FrameError(Exception):
+    """Raised by :class:`FrameParser` for a frame header that can't be
+    accepted, with the close ``code`` the connection should be closed with
+    """
+
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+        self.reason = reason
+
+
+class Frame(object):
+    """A single parsed frame, its payload already unmasked
+
+    The payload of a masked frame is a :class:`bytearray` which nothing
+    else refers to. A frame parsed in pieces (see
+    :attr:`FrameParser.partial`) has ``more`` set on all but its last.
+    """
+
+    __slots__ = ('fin', 'rsv1', 'rsv2', 'rsv3', 'opcode', 'masked', 'payload',
+                 'more')
+
+    def __init__(self, fin, rsv1, rsv2, rsv3, opcode, masked, payload,
+                 more=False):
+        self.fin = fin
+        self.rsv1 = rsv1
+        self.rsv2 = rsv2
+        self.rsv3 = rsv3
+        self.opcode = opcode
+        self.masked = masked
+        self.payload = payload
+        self.more = more
+
+
+class FrameParser(object):
+    """Incrementally splits bytes into :class:`Frame` objects
+
+    Bytes can be fed in chunks of any size and every frame they complete is
+    returned at once. :attr:`needed` is the number of bytes the parser needs
+    before it can make progress.
+
+    Once a frame's header has been read its payload is allocated in full and
+    each chunk is unmasked straight into it, so a large frame arriving over
+    many reads is never joined or copied again. Headers are checked before
+    anything is allocated: a control frame longer than 125 bytes, or a data
+    frame taking its message over ``max_size`` bytes, raises
+    :exc:`FrameError`.
+
+    :param max_size: Largest message, summed over its fragments, or None
+    """
+
+    #: Return the payload of a data frame in pieces, as it arrives, rather
+    #: than allocating all of it. Checked as each frame's header is parsed.
+    partial = False
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        # bytes of the message being received in the frames before this one
+        self._message_size = 0
+        self._pending = ''
+        self._frame = None
+        self._payload = None
+        self._length = 0
+        self._filled = 0
+        self._key = None
+        #: Bytes needed to complete the frame currently being parsed
+        self.needed = 2
+
+    def feed(self, data):
+        """Adds ``data`` and returns a list of the frames it completed
+
+        ``data`` may be a :class:`buffer` over memory that is reused once
+        this returns: whatever the parser keeps of it is copied.
+        """
+        frames = []
+        if self._frame is not None:
+            data = self._fill(data, frames)
+        if self._pending:
+            data = self._pending + bytes(data)
+            self._pending = ''
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if end - pos < 2:
+                self._pending = data[pos:]
+                self.needed = 2 - (end - pos)
+                break
+            first, second = ord(data[pos]), ord(data[pos + 1])
+            length = second & 0x7f
+            masked = second & 0x80
+            header = 2
+            if length == 126:
+                header = 4
+            elif length == 127:
+                header = 10
+            if masked:
+                header += 4
+            if end - pos < header:
+                self._pending = data[pos:]
+                self.needed = header - (end - pos)
+                break
+            if length == 126:
+                length = struct.unpack_from('!H', data, pos + 2)[0]
+            elif length == 127:
+                length = struct.unpack_from('!Q', data, pos + 2)[0]
+            self._check(first & 0xf, first >> 7, length)
+            start = pos + header
+            frame = [first >> 7, (first >> 6) & 1, (first >> 5) & 1,
+                     (first >> 4) & 1, first & 0xf, bool(masked)]
+            key = data[start - 4:start] if masked else None
+            if end - start >= length:
+                if key is not None and length:
+                    payload = bytearray(length)
+                    mask_into(key, buffer(data, start, length), payload)
+                else:
+                    payload = data[start:start + length]
+                frames.append(Frame(*(frame + [payload])))
+                pos = start + length
+                self.needed = 2
+            else:
+                self._frame = frame
+                self._length = length
+                self._filled = 0
+                self._key = key
+                if not self.partial or frame[4] > 0x7:
+                    self._payload = bytearray(length)
+                self._fill(buffer(data, start) if start else data, frames)
+                break
+        return frames
+
+    def _check(self, opcode, fin, length):
+        """Refuses a frame, from its header, before its payload is allocated
+        """
+        if opcode > 0x7:
+            if length > 125:
+                raise FrameError(1002, 'Invalid control frame')
+            return
+        size = length
+        if opcode == OPCODE_CONTINUATION:
+            size += self._message_size
+        if self.max_size is not None and size > self.max_size:
+            raise FrameError(1009, 'Message too big')
+        self._message_size = 0 if fin else size
+
+    def _fill(self, data, frames):
+        """Copies ``data`` into the current frame's payload, or returns it as
+        the next piece of the frame
+
+        :returns: Whatever of ``data`` is left once the payload is complete
+        """
+        payload, filled = self._payload, self._filled
+        wanted = self._length - filled
+        chunk = buffer(data, 0, wanted) if len(data) > wanted else data
+        size = len(chunk)
+        offset = filled
+        if payload is None:
+            payload = bytearray(size) if self._key is not None else chunk[:]
+            offset = 0
+        if self._key is not None:
+            rotate = filled % 4
+            key = self._key[rotate:] + self._key[:rotate]
+            mask_into(key, chunk, payload, offset)
+        elif payload is self._payload:
+            payload[filled:filled + size] = chunk
+        self._filled = filled = filled + size
+        if filled < self._length:
+            if self._payload is None and size:
+                frames.append(Frame(*(self._frame + [payload, True])))
+            self.needed = self._length - filled
+            return ''
+        frames.append(Frame(*(self._frame + [payload])))
+        self._frame = self._payload = self._key = None
+        self.needed = 2
+        return buffer(data, wanted)
+
+
+class AssembledMessage(object):
+    """Mixin for messages whose ``data`` is the payload exactly as the
+    parser assembled it, usually a :class:`bytearray`
+
+    ``str(message)`` copies the payload into a string; :meth:`view` doesn't.
+    """
+
+    def __init__(self, data):
+        super(AssembledMessage, self).__init__('')
+        self.data = data
+
+    def __str__(self):
+        return bytes(self.data)
+
+    def view(self):
+        """Returns a :class:`memoryview` over the payload"""
+        return memoryview(self.data)
+
+
+class TextMessage(AssembledMessage, messaging.TextMessage):
+    pass
+
+
+class BinaryMessage(AssembledMessage, messaging.BinaryMessage):
+    pass
+
+
+class Stream(BaseStream):
+    """A :class:`ws4py.streaming.Stream` parsing with :class:`FrameParser`
+
+    It exposes the same ``message``, ``pings``, ``pongs``, ``closing`` and
+    ``errors`` attributes, and its :attr:`parser` the same protocol: send it
+    bytes and it returns how many more it would like. As a single send may
+    complete several messages they are also queued, in order, on
+    :attr:`messages`; ``message`` is the most recent.
+    """
+
+    #: The negotiated :class:`~stargate.deflate.Deflate` used to
+    #: decompress messages sent with the RSV1 bit set, if any
+    deflate = None
+
+    #: Hand out data as it arrives, on :attr:`fragments`, instead of
+    #: assembling whole messages. Unset again once a streamed message is
+    #: complete, so that messages following it are assembled as usual.
+    streaming = False
+
+    #: Largest message accepted, counted after decompression. Larger ones
+    #: are refused with close code 1009 before they are read. None for no
+    #: limit.
+    max_message_size = 16 * 1024 * 1024
+    #: Largest message accepted while :attr:`streaming`, which holds on to
+    #: no more than a read's worth of it at a time. None for no limit.
+    max_streamed_size = None
+
+    def __init__(self, always_mask=False, expect_masking=True):
+        super(Stream, self).__init__(always_mask, expect_masking)
+        #: Completed messages not yet taken by the reader
+        self.messages = deque()
+        #: ``(data, last)`` pieces of messages received while
+        #: :attr:`streaming`, ``last`` being set on a message's final piece
+        self.fragments = deque()
+        self._fragments = None
+        self._fragment_opcode = None
+        self._compressed = False
+        self._inflated = 0
+        self._utf8 = None
+        self._in_frame = False
+
+    def receiver(self):
+        parser = FrameParser()
+        failed = False
+        while True:
+            data = yield parser.needed
+            if data and not failed:
+                parser.partial = self.streaming
+                if self.streaming:
+                    parser.max_size = self.max_streamed_size
+                else:
+                    parser.max_size = self.max_message_size
+                try:
+                    frames = parser.feed(data)
+                except FrameError, e:
+                    # the connection is closed, whatever follows is ignored
+                    failed = True
+                    self._error(e.code, e.reason)
+                    continue
+                for frame in frames:
+                    self.process(frame)
+
+    def _error(self, code, reason=''):
+        self.errors.append(CloseControlMessage(code=code, reason=reason))
+
+    def process(self, frame):
+        """Updates the stream's state with a parsed :class:`Frame`"""
+        opcode = frame.opcode
+        payload = frame.payload
+        if self._in_frame:
+            # the rest of a data frame whose header has been checked
+            self._in_frame = frame.more
+            return self._data(payload, frame.fin and not frame.more)
+        if frame.rsv2 or frame.rsv3 or (frame.rsv1 and (
+                self.deflate is None or
+                opcode not in (OPCODE_TEXT, OPCODE_BINARY))):
+            return self._error(1002, 'Unexpected reserved bits')
+        if 2 < opcode < 8 or opcode > 0xA:
+            return self._error(1002, 'Reserved opcode')
+        if opcode > 0x7:
+            if not frame.fin or len(payload) > 125:
+                return self._error(1002, 'Invalid control frame')
+            payload = bytes(payload)
+        if self.expect_masking and not frame.masked:
+            return self._error(1002, 'Missing masking when expected')
+        if frame.masked and not self.expect_masking:
+            return self._error(1002, 'Masked when not expected')
+
+        if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self._fragment_opcode is not None:
+                return self._error(1002, 'Received a new message before '
+                                         'completing previous')
+            self._fragments = []
+            self._fragment_opcode = opcode
+            self._compressed = bool(frame.rsv1)
+            self._inflated = 0
+            if opcode == OPCODE_TEXT:
+                self._utf8 = codecs.getincrementaldecoder('utf-8')()
+            self._in_frame = frame.more
+            self._data(payload, frame.fin and not frame.more)
+        elif opcode == OPCODE_CONTINUATION:
+            if self._fragment_opcode is None:
+                return self._error(1002, 'Message not started yet')
+            self._in_frame = frame.more
+            self._data(payload, frame.fin and not frame.more)
+        elif opcode == OPCODE_CLOSE:
+            self._closing(payload)
+        elif opcode == OPCODE_PING:
+            self.pings.append(PingControlMessage(payload))
+        elif opcode == OPCODE_PONG:
+            self.pongs.append(PongControlMessage(payload))
+
+    def _data(self, payload, last):
+        if not self.streaming:
+            self._fragments.append(payload)
+            if last:
+                self._complete()
+            return
+        if self._fragments:
+            # started before streaming was
+            self._fragments.append(payload)
+            payload = bytearray().join(self._fragments)
+            self._fragments = []
+        if self._compressed:
+            try:
+                payload = self.deflate.decompress(payload, last,
+                                                  self._inflate_limit())
+            except zlib.error:
+                return self._error(1007, 'Invalid compressed data')
+            except ValueError:
+                return self._error(1009, 'Message too big')
+            self._inflated += len(payload)
+        if self._utf8 is not None:
+            try:
+                self._utf8.decode(bytes(payload), last)
+            except UnicodeDecodeError:
+                return self._error(1007, 'Invalid UTF-8 bytes')
+        if payload or last:
+            self.fragments.append((payload, last))
+        if last:
+            self._fragments = self._fragment_opcode = self._utf8 = None
+            self.streaming = False
+
+    def _inflate_limit(self):
+        if self.max_streamed_size is not None:
+            return self.max_streamed_size - self._inflated
+
+    def _complete(self):
+        if len(self._fragments) == 1:
+            data = self._fragments[0]
+        else:
+            data = bytearray().join(self._fragments)
+        opcode = self._fragment_opcode
+        self._fragments = self._fragment_opcode = self._utf8 = None
+        if self._compressed:
+            try:
+                data = self.deflate.decompress(data,
+                                               max_size=self.max_message_size)
+            except zlib.error:
+                return self._error(1007, 'Invalid compressed data')
+            except ValueError:
+                return self._error(1009, 'Message too big')
+        if opcode == OPCODE_TEXT:
+            try:
+                data.decode('utf-8')
+            except UnicodeDecodeError:
+                return self._error(1007, 'Invalid UTF-8 bytes')
+            message = TextMessage(data)
+        else:
+            message = BinaryMessage(data)
+        message.completed = True
+        self.message = message
+        self.messages.append(message)
+
+    def _closing(self, payload):
+        if not payload:
+            self.closing = CloseControlMessage(code=1000)
+            return
+        if len(payload) == 1:
+            self.closing = CloseControlMessage(
+                code=1002, reason='Payload has invalid length')
+            return
+        code = struct.unpack('!H', payload[:2])[0]
+        reason = payload[2:]
+        if code not in VALID_CLOSING_CODES and not (2999 < code < 5000):
+            self.closing = CloseControlMessage(
+                code=1002, reason='Invalid Closing Frame Code: %d' % code)
+            return
+        try:
+            reason.decode('utf-8')
+        except UnicodeDecodeError:
+            return self._error(1007, 'Invalid UTF-8 bytes')
+        self.closing = CloseControlMessage(code=code, reason=reason)
@@ -11,6 +11,9 @@ import struct
 
 from hashlib import md5, sha1
 
+from stargate.codec import negotiate_codec
+from stargate.deflate import negotiate
+
 class HandShakeFailed(Exception):
     """Raised when the handshake fails"""
 
@@ -23,7 +26,8 @@ BASE_RESPONSE = ("HTTP/1.1 101 Web Socket Protocol Handshake\r\n"
 
 WS_KEY = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 
-def websocket_handshake(headers, allowed_origins=None):
+def websocket_handshake(headers, allowed_origins=None, extensions=(),
+                        codecs=()):
     """Perform the websocket handshake
 
     This function does the part of the handshake that is common across spec
@@ -34,6 +38,10 @@ def websocket_handshake(headers, allowed_origins=None):
     :param headers: The websocket upgrade request headers
         (headers attribute from :class:`webob.Request`)
     :type headers: :class:`webob.headers.EnvironHeaders`
+    :param extensions: The extensions the server supports, see
+        :func:`handshake_hybi_10`
+    :param codecs: The :mod:`codecs <stargate.codec>` the server speaks, see
+        :func:`handshake_hybi_10`
     :raises: :exc:`HandShakeFailed`, :exc:`InvalidOrigin`
     :returns: A string to send back to the client
     """
@@ -50,7 +58,7 @@ def websocket_handshake(headers, allowed_origins=None):
         raise InvalidOrigin('Origin %s not allowed' % origin)
     # The following 3 lines are sent regardless of spec version
     if upgrade == "websocket":
-        return 2, handshake_hybi_10(headers)
+        return 2, handshake_hybi_10(headers, extensions, codecs)
     if any([k.startswith('Sec-Websocket') for k in headers]):
         return 1, handshake_v76(headers, BASE_RESPONSE)
     return 0, handshake_pre76(headers, BASE_RESPONSE)
@@ -75,18 +83,48 @@ def build_location_url(headers):
         location += '?' + qs
     return location
 
-def handshake_hybi_10(headers):
+def handshake_hybi_10(headers, extensions=(), codecs=()):
+    """The websocket handshake as described in version 10 of the hybi
+    drafts and RFC 6455
+
+    Each of ``extensions`` (a :class:`~stargate.deflate.PerMessageDeflate`
+    for example) is negotiated with the client's
+    ``Sec-WebSocket-Extensions`` offers. The ones agreed on are put in the
+    response and left in the ``stargate.extensions`` key of the request's
+    environ for the websocket to use.
+
+    The first of ``codecs`` the client lists in ``Sec-WebSocket-Protocol``
+    is agreed as the subprotocol and left in ``stargate.codec``.
+
+    :param headers: The request headers from :func:`websocket_handshake`
+    :param extensions: The extensions the server supports
+    :param codecs: The :class:`~stargate.codec.Codec` objects the server
+        speaks, most preferred first
+    """
     BASE_RESPONSE = ("HTTP/1.1 101 Switching Protocols\r\n"
                      "Upgrade: websocket\r\n"
                      "Connection: Upgrade\r\n")
     key = headers.get("Sec-WebSocket-Key")
     if len(base64.b64decode(key)) != 16:
         raise HandShakeFailed("Sec-Websocket-Key length invalid")
-    return BASE_RESPONSE + (
+    response = BASE_RESPONSE + (
         "Sec-WebSocket-Version: 8\r\n"
-        "Sec-WebSocket-Accept: %s\r\n"
-        "\r\n" % base64.b64encode(sha1(key + WS_KEY).digest())
+        "Sec-WebSocket-Accept: %s\r\n" %
+        base64.b64encode(sha1(key + WS_KEY).digest())
     )
+    if extensions:
+        accepted = negotiate(headers.get('Sec-WebSocket-Extensions'),
+                             extensions)
+        headers.environ['stargate.extensions'] = accepted
+        if accepted:
+            response += "Sec-WebSocket-Extensions: %s\r\n" % ', '.join(
+                [extension.response_params() for extension in accepted])
+    if codecs:
+        codec = negotiate_codec(headers.get('Sec-WebSocket-Protocol'), codecs)
+        headers.environ['stargate.codec'] = codec
+        if codec is not None:
+            response += "Sec-WebSocket-Protocol: %s\r\n" % codec.name
+    return response + "\r\n"
 
 def handshake_pre76(headers, base_response):
     """The websocket handshake as described in version 75 of the spec [ws75]_
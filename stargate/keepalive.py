@@ -0,0 +1,241 @@
+"""Server initiated pings and idle connection reaping for every websocket
+in the process, driven by a single timer wheel
+
+A dead peer behind a NAT or a load balancer is otherwise only noticed on the
+next write to it, which may be never. :class:`Keepalive` pings each websocket
+that has been quiet for ``ping_interval`` and hangs up on those that don't
+answer within ``pong_timeout``, or that haven't sent or been sent a message
+for ``idle_timeout``::
+
+    class Feed(WebSocketView):
+        keepalive = Keepalive(ping_interval=30, pong_timeout=10)
+
+Rather than a timer or a sleeping greenthread per connection, every
+connection sits in one slot of a :class:`TimerWheel` and one greenthread
+advances the wheel a slot per ``tick``, so the cost of a connection is an
+entry in a dictionary. Keepalives share the process's wheel for their tick,
+see :func:`shared_wheel`, so adding more views doesn't add greenthreads.
+
+.. note:: Pongs are only seen while the websocket's handler is reading from
+    it. Websockets that are only written to can use ``pong_timeout=None``;
+    dead peers will then still be found by the pings failing to be written.
+"""
+
+import logging
+import os
+import socket
+import time
+
+import eventlet
+
+log = logging.getLogger(__name__)
+
+GOING_AWAY = 1001
+
+
+class TimerWheel(object):
+    """Runs callbacks, keyed by an object, after a delay
+
+    Delays are rounded up to whole ticks. Scheduling and cancelling are
+    dictionary operations and each tick only looks at the callbacks in one
+    slot, whatever the number of callbacks scheduled.
+
+    :param tick: Seconds per slot
+    :param size: Number of slots. Delays longer than ``tick * size`` go round
+        the wheel more than once.
+    """
+
+    def __init__(self, tick=1.0, size=512):
+        self.tick = tick
+        self.size = size
+        self._slots = [{} for i in xrange(size)]
+        self._where = {}
+        self._ticks = 0
+        self._gt = None
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, delay, callback):
+        """Calls ``callback(key)`` after ``delay`` seconds, replacing any
+        callback already scheduled for ``key``
+        """
+        self.cancel(key)
+        ticks = max(1, int(-(-delay // self.tick)))
+        due = self._ticks + ticks
+        slot = due % self.size
+        self._slots[slot][key] = (due, callback)
+        self._where[key] = slot
+        # a wheel made before a fork has no greenthread in the child's hub
+        if self._gt is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._gt = eventlet.spawn(self._run)
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    def advance(self):
+        """Moves the wheel on by one tick, running the callbacks due"""
+        self._ticks += 1
+        bucket = self._slots[self._ticks % self.size]
+        due = [(key, callback) for key, (at, callback) in bucket.iteritems()
+               if at <= self._ticks]
+        for key, callback in due:
+            del bucket[key]
+            del self._where[key]
+        for key, callback in due:
+            try:
+                callback(key)
+            except Exception:
+                log.exception('Timer wheel callback failed')
+        return len(due)
+
+    def stop(self):
+        if self._gt is not None:
+            self._gt.kill()
+            self._gt = None
+
+    def _run(self):
+        next_tick = time.time() + self.tick
+        while True:
+            eventlet.sleep(max(0, next_tick - time.time()))
+            # catch up on any ticks missed while the hub was busy
+            while time.time() >= next_tick:
+                self.advance()
+                next_tick += self.tick
+
+
+#: The wheels shared by keepalives, by tick
+_wheels = {}
+#: Pings and closes websockets for every keepalive
+_pool = eventlet.GreenPool()
+
+
+def shared_wheel(tick=1.0):
+    """Returns the process's :class:`TimerWheel` advancing every ``tick``
+    seconds
+    """
+    wheel = _wheels.get(tick)
+    if wheel is None:
+        wheel = _wheels[tick] = TimerWheel(tick)
+    return wheel
+
+
+class Keepalive(object):
+    """Pings quiet websockets and hangs up on dead or idle ones
+
+    Websockets are tracked from :meth:`add` until their close callbacks are
+    fired (see :class:`stargate.view.CloseCallbacksMixin`).
+
+    :param ping_interval: Seconds without hearing from a websocket before it
+        is pinged. Draft 76 websockets, which can't be pinged, are only
+        checked for being idle.
+    :param pong_timeout: Seconds to wait for anything to be received after a
+        ping before hanging up, or None to never hang up for that
+    :param idle_timeout: Seconds without a message sent or received before
+        hanging up, or None to keep idle connections
+    :param tick: The resolution, in seconds, of the timer wheel
+    :param wheel: The :class:`TimerWheel` to use, by default the
+        :func:`shared_wheel` for ``tick``. A websocket can be kept alive by
+        only one keepalive on a wheel.
+    """
+
+    #: Seconds to wait for the close frame to be written before hanging up
+    close_timeout = 1.0
+
+    def __init__(self, ping_interval=30.0, pong_timeout=10.0,
+                 idle_timeout=None, tick=1.0, wheel=None):
+        self.ping_interval = ping_interval
+        self.pong_timeout = pong_timeout
+        self.idle_timeout = idle_timeout
+        self.wheel = wheel or shared_wheel(tick)
+        self._websockets = set()
+        self._pinged = {}
+
+    def __len__(self):
+        return len(self._websockets)
+
+    def add(self, ws):
+        """Starts keeping ``ws`` alive"""
+        now = time.time()
+        if getattr(ws, 'last_received', None) is None:
+            ws.last_received = now
+        if getattr(ws, 'last_active', None) is None:
+            ws.last_active = now
+        ws.add_close_callback(self.discard)
+        self._websockets.add(ws)
+        self._schedule(ws, now)
+
+    def discard(self, ws):
+        if ws in self._websockets:
+            self._websockets.remove(ws)
+            self.wheel.cancel(ws)
+        self._pinged.pop(ws, None)
+
+    def _schedule(self, ws, now):
+        pinged = self._pinged.get(ws)
+        if pinged is not None and pinged <= ws.last_received:
+            # answered
+            pinged = self._pinged.pop(ws)
+        heard = max(ws.last_received, pinged)
+        delay = self.ping_interval - (now - heard)
+        if pinged is not None and self.pong_timeout is not None:
+            delay = min(delay, self.pong_timeout - (now - pinged))
+        if self.idle_timeout is not None:
+            delay = min(delay, self.idle_timeout - (now - ws.last_active))
+        self.wheel.schedule(ws, max(delay, 0), self._check)
+
+    def _check(self, ws):
+        now = time.time()
+        if self.idle_timeout is not None and \
+                now - ws.last_active >= self.idle_timeout:
+            return self._hang_up(ws, 'Idle')
+        pinged = self._pinged.get(ws)
+        if pinged is not None and ws.last_received < pinged:
+            if self.pong_timeout is not None and \
+                    now - pinged >= self.pong_timeout:
+                return self._hang_up(ws, 'No pong')
+        else:
+            pinged = None
+        heard = max(ws.last_received, pinged)
+        if now - heard >= self.ping_interval and hasattr(ws, 'ping'):
+            self._pinged[ws] = now
+            _pool.spawn_n(self._ping, ws)
+        self._schedule(ws, now)
+
+    def _ping(self, ws):
+        try:
+            ws.ping()
+        except (socket.error, IOError):
+            self.discard(ws)
+
+    def _hang_up(self, ws, reason):
+        log.debug('Closing websocket: %s', reason)
+        self.discard(ws)
+        _pool.spawn_n(self._close, ws, reason)
+
+    def _close(self, ws, reason):
+        timer = eventlet.Timeout(self.close_timeout)
+        try:
+            try:
+                ws.close(GOING_AWAY, reason)
+            except TypeError:
+                # draft 76 websockets have no close codes
+                ws.close()
+        except eventlet.Timeout, t:
+            if t is not timer:
+                raise
+            try:
+                ws.close_connection()
+            except (socket.error, IOError):
+                pass
+        except (socket.error, IOError):
+            pass
+        finally:
+            timer.cancel()
@@ -0,0 +1,99 @@
+"""Running CPU heavy work off the eventlet hub
+
+Whatever a handler does between two reads or writes runs on the hub, so
+encoding large state, rendering a template or compressing a big frame there
+stalls every other connection in the process until it's done. A
+:class:`ThreadOffloader` runs that work in :mod:`eventlet.tpool`'s native
+threads and hands the result back to the greenthread that asked for it,
+which waits without holding up anyone else::
+
+    class Feed(WebSocketAwareResource):
+        offloader = ThreadOffloader()
+
+    class FeedView(WebSocketView):
+        offloader = ThreadOffloader()
+
+        def handler(self, websocket):
+            websocket.send(self.offload(json.dumps, self.context.state))
+
+With an offloader a resource builds (and compresses) the frames of large
+broadcasts in a thread before writing them, and the view's websockets
+compress large messages in one. Work smaller than ``min_size`` bytes is still
+done inline, where it costs less than the hand off.
+
+Threads only run in parallel with the hub while the work releases the GIL,
+as zlib and most C extensions do; pure Python work is interleaved with the
+hub instead, which still keeps any single connection from being starved.
+"""
+
+from eventlet import tpool
+
+
+class Offloader(object):
+    """Runs everything inline, on the calling greenthread
+
+    This is what resources and views use when no offloader is configured,
+    and the base for offloaders that run work elsewhere.
+
+    :param min_size: See :attr:`min_size`
+    """
+
+    #: Size in bytes of the smallest message whose framing or compression
+    #: is sent elsewhere
+    min_size = 16 * 1024
+
+    def __init__(self, min_size=None):
+        if min_size is not None:
+            self.min_size = min_size
+
+    def run(self, func, *args, **kwargs):
+        """Calls ``func(*args, **kwargs)`` and returns what it returns,
+        raising what it raises
+        """
+        return func(*args, **kwargs)
+
+    def worth_it(self, size):
+        """Whether work on ``size`` bytes should be run elsewhere. Work of
+        unknown size (None), such as encoding an object, always is.
+        """
+        return size is None or size >= self.min_size
+
+    def prepare(self, frames, listeners):
+        """Builds ``frames`` for the wire protocols of ``listeners``, if the
+        message is large enough for it to be worth doing elsewhere
+
+        :param frames: A :class:`~stargate.frames.FrameCache`,
+            :class:`~stargate.frames.FrameBatch` or
+            :class:`~stargate.codec.ObjectFrames`
+        """
+        if not self.worth_it(frames.size):
+            return
+        targets = set()
+        for ws in listeners:
+            protocol = getattr(ws, 'wire_protocol', None)
+            if protocol is not None:
+                targets.add((getattr(ws, 'codec', None), protocol))
+        if targets:
+            self.run(frames.prepare, targets)
+
+
+class ThreadOffloader(Offloader):
+    """Runs work in :mod:`eventlet.tpool`'s thread pool
+
+    The pool's size is set by the ``EVENTLET_THREADPOOL_SIZE`` environment
+    variable (20 threads by default).
+    """
+
+    def run(self, func, *args, **kwargs):
+        return tpool.execute(func, *args, **kwargs)
+
+
+class _Inline(Offloader):
+
+    def worth_it(self, size):
+        return False
+
+
+#: The :class:`Offloader` used when none is configured, which never
+#: considers work worth preparing separately
+INLINE = _Inline()
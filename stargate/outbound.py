@@ -0,0 +1,219 @@
+"""Per listener outbound queues
+
+An :class:`OutboundQueue` sits between a
+:class:`~stargate.resource.WebSocketAwareResource` and one of its listeners.
+Broadcasts are put on the queue without blocking and a writer greenthread
+drains it to the socket, so a slow client only ever costs ``maxsize`` queued
+messages. What happens when the queue is full is decided by the overflow
+policy:
+
+* :data:`DROP_OLDEST` discards the oldest queued message
+* :data:`DROP_NEWEST` discards the message being queued
+* :data:`DISCONNECT` closes the connection with a 1008 (policy violation)
+  close code
+
+A :class:`ConflatingQueue` additionally replaces a queued message with a newer
+one sent under the same key, so a client that can't keep up only receives the
+latest value for each key.
+"""
+
+from collections import deque, OrderedDict
+from itertools import count
+
+import eventlet
+from eventlet.event import Event
+from eventlet.green import socket
+
+from stargate.delivery import CONFLATED, DELIVERED, DISCARDED
+from stargate.frames import write_message
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+DISCONNECT = 'disconnect'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+#: The close code sent to a client disconnected by :data:`DISCONNECT`
+POLICY_VIOLATION = 1008
+
+
+class OutboundQueue(object):
+    """A bounded queue of messages waiting to be written to one websocket
+
+    :param ws: The websocket to write to
+    :param maxsize: The most messages that may be waiting, None for no limit
+    :param policy: One of :data:`POLICIES`
+    :param on_close: Called with ``ws`` once the queue stops because the
+        connection failed or was disconnected
+    """
+
+    #: Seconds allowed for sending the close frame on :data:`DISCONNECT`
+    close_timeout = 1.0
+
+    def __init__(self, ws, maxsize, policy=DROP_OLDEST, on_close=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown overflow policy %r' % policy)
+        self.ws = ws
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_close = on_close
+        #: The number of messages discarded because the queue was full
+        self.dropped = 0
+        #: The number of queued messages replaced by newer ones
+        self.conflated = 0
+        self.closed = False
+        self._items = self._new_store()
+        self._waiter = None
+        self._writer = eventlet.spawn(self._run)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, frames):
+        """Queues a :class:`~stargate.frames.FrameCache` for writing
+
+        Never blocks.
+
+        :returns: :data:`~stargate.delivery.DELIVERED` once queued,
+            :data:`~stargate.delivery.CONFLATED` if it replaced a queued
+            message or :data:`~stargate.delivery.DISCARDED` if the queue was
+            full and it, or with :data:`DROP_OLDEST` the oldest message, was
+            thrown away
+        """
+        if self.closed:
+            return DISCARDED
+        if self._replace(frames):
+            self.conflated += 1
+            return CONFLATED
+        outcome = DELIVERED
+        if self.maxsize is not None and len(self._items) >= self.maxsize:
+            if self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return DISCARDED
+            elif self.policy == DROP_OLDEST:
+                self._pop()
+                self.dropped += 1
+                outcome = DISCARDED
+            else:
+                eventlet.spawn_n(self.disconnect)
+                return DISCARDED
+        self._push(frames)
+        self._wake()
+        return outcome
+
+    def _new_store(self):
+        return deque()
+
+    def _push(self, frames):
+        self._items.append(frames)
+
+    def _pop(self):
+        return self._items.popleft()
+
+    def _replace(self, frames):
+        """Overridden to merge ``frames`` with a queued message"""
+        return False
+
+    def _written(self):
+        """Called by the writer after each message"""
+
+    def stop(self):
+        """Stops the writer, discarding anything still queued"""
+        self.closed = True
+        self._items.clear()
+        if eventlet.getcurrent() is not self._writer:
+            self._writer.kill()
+
+    def disconnect(self, code=POLICY_VIOLATION, reason='Client too slow'):
+        """Stops the queue and closes the connection with ``code``"""
+        if self.closed:
+            return
+        self.stop()
+        ws = self.ws
+        timer = eventlet.Timeout(self.close_timeout)
+        try:
+            try:
+                ws.close(code=code, reason=reason)
+            except TypeError:
+                # draft 76 websockets have no close codes
+                ws.close()
+        except eventlet.Timeout, t:
+            if t is not timer:
+                raise
+            # The close frame couldn't be written either, just hang up
+            try:
+                ws.close_connection()
+            except (socket.error, IOError):
+                pass
+        except (socket.error, IOError):
+            pass
+        finally:
+            timer.cancel()
+        self._closed()
+
+    def _closed(self):
+        if self.on_close is not None:
+            self.on_close(self.ws)
+
+    def _wake(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.ready():
+            waiter.send()
+
+    def _run(self):
+        items = self._items
+        while not self.closed:
+            if not items:
+                self._waiter = Event()
+                self._waiter.wait()
+                self._waiter = None
+                continue
+            frames = self._pop()
+            try:
+                write_message(self.ws, frames)
+            except (socket.error, IOError):
+                self.closed = True
+                items.clear()
+                self._closed()
+            else:
+                self._written()
+
+
+class ConflatingQueue(OutboundQueue):
+    """An :class:`OutboundQueue` which keeps only the latest message per key
+
+    The key is the ``key`` of the :class:`~stargate.frames.FrameCache`; a
+    message for a key that is already waiting replaces it in its place in the
+    queue. Messages without a key are never conflated.
+
+    :param interval: The minimum number of seconds between writes. Anything
+        sent in between is conflated, debouncing bursts of updates.
+    """
+
+    def __init__(self, ws, maxsize=None, policy=DROP_OLDEST, on_close=None,
+                 interval=0):
+        self.interval = interval
+        self._unkeyed = count()
+        super(ConflatingQueue, self).__init__(ws, maxsize, policy, on_close)
+
+    def _new_store(self):
+        return OrderedDict()
+
+    def _push(self, frames):
+        key = frames.key
+        if key is None:
+            key = (None, next(self._unkeyed))
+        self._items[key] = frames
+
+    def _pop(self):
+        return self._items.popitem(last=False)[1]
+
+    def _replace(self, frames):
+        if frames.key is not None and frames.key in self._items:
+            self._items[frames.key] = frames
+            return True
+        return False
+
+    def _written(self):
+        if self.interval:
+            eventlet.sleep(self.interval)
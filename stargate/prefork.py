@@ -0,0 +1,306 @@
+"""A paste [server_factory]_ running the application in several worker
+processes, so that a server can use every core of the machine
+
+A supervising process forks the workers, restarts any that die and, on
+``SIGTERM`` or ``SIGINT``, stops them all. Each worker binds its own
+listening socket with ``SO_REUSEPORT``, leaving the kernel to spread
+connections between them, or, where that isn't available or
+``reuse_port = false``, accepts from a socket bound by the supervisor
+before forking::
+
+    [server:main]
+    use = egg:stargate#prefork_server
+    host = 0.0.0.0
+    port = 6543
+    workers = 8
+    pool_size = 10000
+    backlog = 2048
+    post_fork = myapp.workers:start
+
+Each worker is a separate process: resources, registries and admission
+limits are per worker. The application is loaded once, in the supervisor,
+and each worker starts with an event loop of its own, so greenthreads and
+connections made while loading it don't carry over. Anything a worker needs
+running, such as a :mod:`backplane <stargate.backplane>` to reach the
+listeners of every worker, is started by the ``post_fork`` hook, called with
+the application in each new worker::
+
+    def start(app):
+        backplane.start()
+
+On ``SIGTERM`` a worker stops accepting connections, closes its websockets
+with close code 1001 (going away) and exits once its connections are done
+with, or is killed after :attr:`Prefork.graceful_timeout`.
+"""
+
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from stargate.backend import get_backend
+from stargate.keepalive import GOING_AWAY
+from stargate.view import HixieWebSocket, open_websockets
+
+log = logging.getLogger(__name__)
+
+#: Whether this platform's sockets have ``SO_REUSEPORT``
+HAS_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+
+
+def asbool(value):
+    """Reads a boolean from a config value
+
+    >>> asbool('true'), asbool('Off'), asbool(True)
+    (True, False, True)
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'on', 'y', 't', '1')
+    return bool(value)
+
+
+def resolve(name):
+    """Imports the object named ``module:attribute``
+
+    >>> resolve('os.path:join') is os.path.join
+    True
+    """
+    module, attribute = name.split(':')
+    return getattr(__import__(module, fromlist=[attribute]), attribute)
+
+
+class Prefork(object):
+    """Supervises worker processes serving ``app`` on ``host`` and ``port``
+
+    :param workers: Number of worker processes, by default one per CPU
+    :param backend: The :class:`~stargate.backend.Backend` workers serve with
+    :param pool_size: Most connections each worker serves at once, None
+        for the backend's default
+    :param backlog: Each listening socket's queue of connections waiting
+        to be accepted
+    :param reuse_port: Whether each worker binds its own socket with
+        ``SO_REUSEPORT``, by default where the platform has it
+    :param post_fork: Called with ``app`` in each new worker before it
+        serves anything
+    """
+
+    #: Seconds workers that have been asked to stop get before being killed
+    graceful_timeout = 30
+    #: Workers dying sooner than this many seconds after starting are
+    #: restarted only after as long again, so a worker failing as it starts
+    #: can't fork the supervisor into the ground
+    min_uptime = 1.0
+    #: Seconds between checks for exited workers while a restart is due
+    poll_interval = 0.1
+
+    def __init__(self, app, host, port, workers=None, backend=None,
+                 pool_size=None, backlog=1024, reuse_port=None,
+                 post_fork=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.backend = backend or get_backend('eventlet')
+        self.pool_size = pool_size
+        self.backlog = backlog
+        if reuse_port is None:
+            reuse_port = HAS_REUSEPORT
+        elif reuse_port and not HAS_REUSEPORT:
+            raise ValueError('SO_REUSEPORT is not available on this platform')
+        self.reuse_port = reuse_port
+        self.post_fork = post_fork
+        #: The socket workers inherit, when not using ``SO_REUSEPORT``
+        self.socket = None
+        #: The running workers' start times, by pid
+        self.children = {}
+        #: When each worker waiting to replace one that died is due
+        self.restarts = []
+        self.stopping = False
+
+    def listen(self):
+        """Returns a new listening socket bound to :attr:`host` and
+        :attr:`port`
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        return sock
+
+    def run(self):
+        """Starts the workers and supervises them until told to stop"""
+        if not self.reuse_port and self.socket is None:
+            self.socket = self.listen()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGALRM, self.kill)
+        log.info('Starting %d workers on %s:%s', self.workers, self.host,
+                 self.port)
+        for _ in xrange(self.workers):
+            self.spawn_worker()
+        while True:
+            self.restart_due()
+            restarting = self.restarts and not self.stopping
+            if not (self.children or restarting):
+                break
+            try:
+                if restarting:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                else:
+                    pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid:
+                self.reap(pid, status)
+            elif restarting:
+                time.sleep(self.poll_interval)
+        signal.alarm(0)
+
+    def spawn_worker(self):
+        """Forks a worker process"""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+        status = 0
+        try:
+            self.serve_worker()
+        except:
+            log.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve_worker(self):
+        """Sets up a new worker process and serves until it is stopped"""
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        # ^C reaches the whole process group, the supervisor stops workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._drain_soon)
+        self.backend.after_fork()
+        if self.post_fork is not None:
+            self.post_fork(self.app)
+        sock = self.socket
+        if sock is None:
+            sock = self.listen()
+        self.backend.serve_socket(self.app, sock, self.pool_size)
+
+    def _drain_soon(self, signum, frame):
+        # from the event loop rather than inside the signal handler
+        self.backend.call_later(0, self.drain)
+
+    def drain(self):
+        """Stops a worker: closes its websockets with close code 1001 and
+        stops accepting connections, so it exits once those open are done
+        with
+        """
+        log.info('Worker %d stopping', os.getpid())
+        for websocket in open_websockets():
+            self.backend.spawn(_going_away, websocket)
+        # after the close frames are sent, as shutting down may drop the
+        # connections, without waiting on any peer not reading
+        self.backend.call_later(0, self.backend.shutdown)
+
+    def restart_due(self):
+        """Starts the workers replacing dead ones that are due"""
+        now = time.time()
+        while self.restarts and self.restarts[0] <= now:
+            self.restarts.pop(0)
+            if not self.stopping:
+                self.spawn_worker()
+
+    def reap(self, pid, status):
+        """Forgets a worker that has exited and, unless stopping, arranges
+        for another to start in its place
+        """
+        started = self.children.pop(pid, None)
+        if started is None or self.stopping:
+            return
+        if os.WIFSIGNALED(status):
+            log.error('Worker %d killed by signal %d, restarting', pid,
+                      os.WTERMSIG(status))
+        else:
+            log.error('Worker %d exited with status %d, restarting', pid,
+                      os.WEXITSTATUS(status))
+        now = time.time()
+        due = now
+        if now - started < self.min_uptime:
+            due += self.min_uptime
+        self.restarts.append(due)
+        self.restarts.sort()
+
+    def signal_workers(self, signum):
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def stop(self, signum=None, frame=None):
+        """Asks the workers to stop, killing any still running after
+        :attr:`graceful_timeout`
+        """
+        log.info('Stopping %d workers', len(self.children))
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+        signal.alarm(self.graceful_timeout)
+
+    def kill(self, signum=None, frame=None):
+        """Kills the workers outright"""
+        self.signal_workers(signal.SIGKILL)
+
+
+def _going_away(websocket):
+    try:
+        if isinstance(websocket, HixieWebSocket):
+            # draft 76 has no close codes
+            websocket.close()
+        else:
+            websocket.close(GOING_AWAY, 'Server stopping')
+    except (socket.error, IOError):
+        pass
+    except Exception:
+        # one websocket that can't be closed mustn't keep the others open
+        log.exception('Error closing %r', websocket)
+
+
+def server_factory(global_conf, host, port, workers=None, backend='eventlet',
+                   pool_size=None, backlog=1024, reuse_port=None,
+                   post_fork=None):
+    """Implements the [server_factory]_ api to serve from a :class:`Prefork`
+    of worker processes
+
+    :param workers: Number of worker processes, by default one per CPU
+    :param backend: The name of the :mod:`I/O backend <stargate.backend>`
+        workers serve with
+    :param pool_size: Most connections each worker serves at once
+    :param backlog: Length of the queue of connections waiting to be
+        accepted
+    :param reuse_port: Whether workers bind their own sockets with
+        ``SO_REUSEPORT`` instead of sharing one
+    :param post_fork: ``module:function`` called with the application in
+        each new worker, see :class:`Prefork`
+    """
+    options = dict(backend=get_backend(backend), backlog=int(backlog))
+    if workers:
+        options['workers'] = int(workers)
+    if pool_size:
+        options['pool_size'] = int(pool_size)
+    if reuse_port is not None:
+        options['reuse_port'] = asbool(reuse_port)
+    if post_fork:
+        options['post_fork'] = resolve(post_fork)
+    port = int(port)
+    def serve(app):
+        Prefork(app, host, port, **options).run()
+    return serve
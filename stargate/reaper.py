@@ -0,0 +1,116 @@
+"""A background greenthread which removes dead websockets from resources
+
+Websockets normally leave a resource when their handler exits (see
+:meth:`stargate.view.WebSocketView.handle_websocket`), but a handler that
+never reads from its socket (like the one in the examples) won't notice the
+client going away. The :class:`Reaper` periodically checks the listeners of
+every resource it tracks and removes the ones which are terminated, whose
+socket is closed, or whose peer has hung up::
+
+    WebSocketAwareResource.reaper = Reaper(interval=30)
+"""
+
+import errno
+import logging
+import weakref
+
+import eventlet
+from eventlet import patcher
+from eventlet.support import get_errno
+
+log = logging.getLogger(__name__)
+
+_select = patcher.original('select')
+_socket = patcher.original('socket')
+
+_DEAD_ERRNOS = (errno.EBADF, errno.ECONNRESET, errno.ENOTCONN, errno.EPIPE,
+                errno.ETIMEDOUT)
+
+
+def _raw_socket(ws):
+    sock = getattr(ws, 'sock', None) or getattr(ws, 'socket', None)
+    # unwrap eventlet's GreenSocket
+    return getattr(sock, 'fd', sock)
+
+
+def is_dead(ws):
+    """Returns True if ``ws`` can no longer be written to
+
+    That is the websocket has been terminated or closed, its socket has been
+    closed or the peer has shut down its side of the connection. Checking
+    doesn't consume any data waiting on the socket.
+    """
+    if getattr(ws, 'terminated', False) or \
+            getattr(ws, 'websocket_closed', False):
+        return True
+    sock = _raw_socket(ws)
+    if sock is None:
+        return False
+    try:
+        fileno = sock.fileno()
+        if fileno < 0:
+            return True
+        readable, _, _ = _select.select([fileno], [], [], 0)
+        if not readable:
+            return False
+        # readable with nothing to read means the peer sent FIN
+        return sock.recv(1, _socket.MSG_PEEK) == ''
+    except (_socket.error, _select.error, IOError), e:
+        return get_errno(e) in _DEAD_ERRNOS
+    except (TypeError, AttributeError):
+        # Not a real socket
+        return False
+
+
+class Reaper(object):
+    """Periodically removes dead listeners from the resources it tracks
+
+    Resources are held weakly, so tracking one doesn't keep it alive.
+
+    :param interval: Seconds between sweeps
+    """
+
+    def __init__(self, interval=30.0):
+        self.interval = interval
+        self._resources = weakref.WeakSet()
+        self._gt = None
+
+    def track(self, resource):
+        """Starts checking ``resource``, starting the reaper if needed"""
+        self._resources.add(resource)
+        if self._gt is None:
+            self._gt = eventlet.spawn(self._run)
+
+    def untrack(self, resource):
+        self._resources.discard(resource)
+
+    def stop(self):
+        if self._gt is not None:
+            self._gt.kill()
+            self._gt = None
+
+    def reap(self):
+        """Does a single sweep
+
+        :returns: The number of websockets removed
+        """
+        reaped = 0
+        for resource in list(self._resources):
+            for ws in resource.listeners:
+                if is_dead(ws):
+                    resource.remove_listener(ws)
+                    reaped += 1
+            if not resource.listeners:
+                self.untrack(resource)
+        return reaped
+
+    def _run(self):
+        while True:
+            eventlet.sleep(self.interval)
+            try:
+                reaped = self.reap()
+            except Exception:
+                log.exception('Reaping listeners failed')
+            else:
+                if reaped:
+                    log.debug('Reaped %d dead listeners', reaped)
@@ -0,0 +1,148 @@
+"""A registry of :class:`~stargate.resource.WebSocketAwareResource` objects
+keyed by their :func:`resource path <pyramid.traversal.resource_path>`
+
+This lets code outside of a request (backend workers, timers etc.) publish to
+a resource by its path without traversing the resource tree each time::
+
+    registry = ResourceRegistry()
+    WebSocketAwareResource.registry = registry
+
+    # ... later, from anywhere in the process
+    registry.publish('/jobs/1', 'started')
+    registry.publish_subtree('/jobs/', 'shutting down')
+
+Resources add themselves while they have at least one listener. Lookups by
+path are a dictionary lookup and subtree publishes walk a prefix trie of the
+path segments, so neither depends on the total number of resources.
+"""
+
+from stargate.frames import FrameCache
+
+
+def split_path(path):
+    """Splits a resource path into its segments
+
+    >>> split_path('/jobs/1/')
+    ('jobs', '1')
+    >>> split_path('/')
+    ()
+    """
+    return tuple(segment for segment in path.split('/') if segment)
+
+
+class _Node(object):
+
+    __slots__ = ('children', 'resource')
+
+    def __init__(self):
+        self.children = {}
+        self.resource = None
+
+    def walk(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.resource is not None:
+                yield node.resource
+            stack.extend(node.children.itervalues())
+
+
+class ResourceRegistry(object):
+    """Maps resource paths to the resources subscribed at them"""
+
+    def __init__(self):
+        self._by_path = {}
+        self._paths = {}
+        self._root = _Node()
+
+    def __len__(self):
+        return len(self._by_path)
+
+    def __contains__(self, resource):
+        return resource in self._paths
+
+    def register(self, resource):
+        """Adds ``resource`` under its current ``path``
+
+        Registering a resource again is a no-op. The path is read once, when
+        the resource is registered.
+        """
+        if resource in self._paths:
+            return
+        path = resource.path
+        segments = split_path(path)
+        node = self._root
+        for segment in segments:
+            node = node.children.setdefault(segment, _Node())
+        previous = node.resource
+        if previous is not None:
+            del self._paths[previous]
+        node.resource = resource
+        self._by_path['/' + '/'.join(segments)] = resource
+        self._paths[resource] = segments
+
+    def unregister(self, resource):
+        """Removes ``resource``, pruning any branches of the trie left empty"""
+        segments = self._paths.pop(resource, None)
+        if segments is None:
+            return
+        del self._by_path['/' + '/'.join(segments)]
+        trail = [self._root]
+        for segment in segments:
+            trail.append(trail[-1].children[segment])
+        trail[-1].resource = None
+        for parent, segment in reversed(zip(trail, segments)):
+            child = parent.children[segment]
+            if child.children or child.resource is not None:
+                break
+            del parent.children[segment]
+
+    def lookup(self, path):
+        """Returns the resource registered at ``path`` or None"""
+        return self._by_path.get('/' + '/'.join(split_path(path)))
+
+    def subtree(self, prefix):
+        """Yields every resource registered at or below ``prefix``"""
+        node = self._root
+        for segment in split_path(prefix):
+            node = node.children.get(segment)
+            if node is None:
+                return iter(())
+        return node.walk()
+
+    def publish(self, path, message, binary=False, key=None):
+        """Sends ``message`` to the resource at ``path``
+
+        ``binary`` and ``key`` are as for
+        :meth:`~stargate.resource.WebSocketAwareResource.send`
+
+        :returns: The number of listeners written to
+        """
+        resource = self.lookup(path)
+        if resource is None:
+            return 0
+        return len(resource.broadcast(FrameCache(message, binary, key)))
+
+    def publish_subtree(self, prefix, message, binary=False, key=None):
+        """Sends ``message`` to every resource at or below ``prefix``
+
+        See :meth:`send_to`
+        """
+        return self.send_to(self.subtree(prefix), message, binary, key)
+
+    def send_to(self, resources, message, binary=False, key=None):
+        """Sends ``message`` to each of ``resources``
+
+        The message is framed once for all of them and a websocket that
+        listens to more than one of the resources only receives it once.
+        It is written straight away, regardless of the resources'
+        :attr:`~stargate.resource.WebSocketAwareResource.tick`, and isn't
+        kept for replay.
+
+        :returns: The number of listeners written to
+        """
+        frames = FrameCache(message, binary, key)
+        seen = set()
+        for resource in resources:
+            seen.update(resource.deliver(frames, exclude=seen))
+        return len(seen)
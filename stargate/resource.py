@@ -4,29 +4,173 @@ functionality for adding and removing
 :class:`websockets <eventlet.websocket.WebSocket>` as listeners for events
 """
 
+import eventlet
+import logging
+import os
+import time
+from collections import deque
+from eventlet import GreenPool
 from eventlet.green import socket
-from eventlet.support import get_errno
 from pyramid.traversal import resource_path
-import errno
+
+from stargate.backend import EVENTLET
+from stargate.codec import ObjectFrames
+from stargate.delivery import Delivery, DELIVERED, fan_out
+from stargate.frames import FrameBatch, FrameCache, write_message
+from stargate.offload import INLINE
+from stargate.outbound import ConflatingQueue, DROP_OLDEST, OutboundQueue
+
+log = logging.getLogger(__name__)
+
+
+class ListenerSet(object):
+    """A copy-on-write set of websockets
+
+    Adding or removing a listener replaces the underlying frozenset, so
+    iterating is always over a consistent snapshot that broadcasts can walk
+    while listeners come and go.
+    """
+
+    __hash__ = None
+
+    def __init__(self):
+        self._members = frozenset()
+
+    def add(self, ws):
+        if ws not in self._members:
+            self._members = self._members | frozenset([ws])
+
+    def discard(self, ws):
+        if ws in self._members:
+            self._members = self._members - frozenset([ws])
+
+    def snapshot(self):
+        """Returns the current listeners as a frozenset"""
+        return self._members
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, ws):
+        return ws in self._members
+
+    def __eq__(self, other):
+        if isinstance(other, ListenerSet):
+            other = other._members
+        return self._members == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ListenerSet(%r)' % list(self._members)
+
 
 class ListenersDescriptor(object):
 
     def __get__(self, obj, klass=None):
         if obj:
             if not hasattr(obj, '_registered'):
-                obj._registered = set()
+                obj._registered = ListenerSet()
             return obj._registered
 
 
+class PoolDescriptor(object):
+    """Lazily creates a :class:`eventlet.greenpool.GreenPool` of
+    ``pool_size`` per resource for :meth:`WebSocketAwareResource.publish`
+    """
+
+    def __get__(self, obj, klass=None):
+        if obj:
+            if not hasattr(obj, '_pool'):
+                obj._pool = GreenPool(obj.pool_size)
+            return obj._pool
+
+
+class QueuesDescriptor(object):
+    """A mapping of listener to its :class:`~stargate.outbound.OutboundQueue`
+    when :attr:`WebSocketAwareResource.queue_size` is set
+    """
+
+    def __get__(self, obj, klass=None):
+        if obj:
+            if not hasattr(obj, '_queues'):
+                obj._queues = {}
+            return obj._queues
+
+
 class WebSocketAwareResource(object):
     """An object in a :term:`pyramid:traversal` graph that handles websockets
 
     It is designed to be persistent and to route messages to attached clients
     """
 
-    #: A set of attached :class:`websockets <eventlet.websocket.WebSocket>`
+    #: A :class:`ListenerSet` of attached
+    #: :class:`websockets <eventlet.websocket.WebSocket>`
     listeners = ListenersDescriptor()
 
+    #: A :class:`stargate.reaper.Reaper` which periodically removes dead
+    #: websockets from the :attr:`listeners`
+    reaper = None
+
+    #: The greenthreads used by :meth:`publish` to write to listeners
+    pool = PoolDescriptor()
+
+    #: Maximum number of listener writes :meth:`publish` has in flight
+    pool_size = 1000
+
+    #: Seconds :meth:`publish` allows for writing to a single listener
+    write_timeout = 10.0
+
+    #: Listeners' :class:`outbound queues <stargate.outbound.OutboundQueue>`
+    queues = QueuesDescriptor()
+
+    #: When set, each listener gets its own outbound queue holding at most
+    #: this many messages and broadcasts never wait on a socket
+    queue_size = None
+
+    #: What to do when a listener's queue is full, one of
+    #: :data:`stargate.outbound.POLICIES`
+    overflow_policy = DROP_OLDEST
+
+    #: Give each listener a :class:`~stargate.outbound.ConflatingQueue` so
+    #: that a listener which is behind only receives the latest message sent
+    #: for each ``key``
+    conflate = False
+
+    #: With :attr:`conflate`, the minimum seconds between writes to a listener
+    conflate_interval = 0
+
+    #: When set, messages sent during each ``tick`` seconds are buffered and
+    #: each listener receives them in a single write at the end of the tick
+    tick = None
+
+    #: How many of the most recent messages to keep for :meth:`replay`
+    replay_size = 0
+
+    #: The sequence number of the last message delivered, counting from 1
+    sequence = 0
+
+    _epoch = None
+
+    #: A :class:`stargate.registry.ResourceRegistry` the resource adds itself
+    #: to while it has listeners, so it can be published to by path
+    registry = None
+
+    #: A :class:`stargate.backplane.Backplane` which :meth:`send` publishes
+    #: through so that listeners in every worker process receive the message
+    backplane = None
+
+    #: The :class:`stargate.backend.Backend` running :attr:`tick` timers
+    backend = EVENTLET
+
+    #: A :class:`stargate.offload.Offloader` which large messages are framed
+    #: and compressed by, off the hub, before they are written
+    offloader = INLINE
+
     __name__ = ''
     __parent__ = None
 
@@ -38,26 +182,275 @@ class WebSocketAwareResource(object):
     def path(self):
         return resource_path(self)
 
-    def add_listener(self, ws):
-        """Adds a :class:`eventlet.websocket.WebSocket` the the set of listeners"""
+    @property
+    def epoch(self):
+        """Identifies the process numbering this resource's messages
+
+        Sequence numbers count from 1 again when a server restarts and are
+        kept separately by each worker process. Send the epoch to clients
+        along with sequence numbers, see :meth:`sequence_message`, so that a
+        client reconnecting to another process can present it and be sent a
+        :meth:`snapshot`.
+        """
+        pid = os.getpid()
+        if self._epoch is None or self._epoch[0] != pid:
+            self._epoch = (pid, '%x.%x' % (pid, int(time.time() * 1000)))
+        return self._epoch[1]
+
+    def add_listener(self, ws, last_seq=None, epoch=None):
+        """Adds a :class:`eventlet.websocket.WebSocket` the the set of listeners
+
+        Websockets created by :class:`~stargate.view.WebSocketView` are removed
+        again automatically when their handler exits.
+
+        :param last_seq: For a reconnecting client, the sequence number of the
+            last message it received. With :attr:`replay_size` set it is sent
+            what it missed, see :meth:`replay`, before being added.
+        :param epoch: The :attr:`epoch` ``last_seq`` was numbered in
+        """
+        if last_seq is not None and self.replay_size:
+            self.replay(ws, last_seq, epoch)
+        if ws not in self.queues:
+            if self.conflate:
+                self.queues[ws] = ConflatingQueue(
+                    ws, self.queue_size, self.overflow_policy,
+                    on_close=self.remove_listener,
+                    interval=self.conflate_interval)
+            elif self.queue_size:
+                self.queues[ws] = OutboundQueue(ws, self.queue_size,
+                                                self.overflow_policy,
+                                                on_close=self.remove_listener)
+        if ws not in self.listeners and hasattr(ws, 'add_close_callback'):
+            ws.add_close_callback(self.remove_listener)
         self.listeners.add(ws)
+        if self.registry is not None:
+            self.registry.register(self)
+        if self.reaper is not None:
+            self.reaper.track(self)
 
     def remove_listener(self, ws):
         """Removes ws from the set of listeners"""
+        if ws in self.listeners and hasattr(ws, 'remove_close_callback'):
+            ws.remove_close_callback(self.remove_listener)
         self.listeners.discard(ws)
+        queue = self.queues.pop(ws, None)
+        if queue is not None:
+            queue.stop()
+        if self.registry is not None and not self.listeners:
+            self.registry.unregister(self)
+
+    def _write(self, ws, frames):
+        """Writes to ``ws`` directly or via its queue if it has one
+
+        :returns: The :mod:`delivery <stargate.delivery>` outcome
+        """
+        queue = self.queues.get(ws)
+        if queue is None:
+            write_message(ws, frames)
+            return DELIVERED
+        return queue.put(frames)
 
-    def send(self, message):
+    def send(self, message, binary=False, key=None):
         """Sends ``message`` to all sockets in the set of :attr:`listeners`
 
-        It will clear up any websockets that are no longer connected
+        The message is framed once for each wire protocol in use (see
+        :class:`stargate.frames.FrameCache`) rather than once per listener.
+        If :attr:`queue_size` is set the message is queued for each listener
+        instead of being written straight away. Any websocket that can't be
+        written to is removed without interrupting the broadcast.
+
+        With a :attr:`backplane` the message is published to it and is
+        delivered once the backplane hands it back, in this process and all
+        of the others.
+
+        ``key`` identifies what the message is the latest value of, see
+        :attr:`conflate`
+        """
+        if self.backplane is not None:
+            self.backplane.publish(self.path, message, binary, key)
+        else:
+            self.broadcast(FrameCache(message, binary, key))
+
+    def send_obj(self, obj, key=None):
+        """Sends ``obj`` to all of the :attr:`listeners`, each encoded with
+        its websocket's :attr:`~stargate.codec.ObjectMixin.codec`
+
+        The object is encoded once per codec in use, see
+        :class:`stargate.codec.ObjectFrames`. Objects can't be sent through a
+        :attr:`backplane`, which only carries encoded messages.
+        """
+        if self.backplane is not None:
+            raise TypeError('Objects must be encoded to be sent through a '
+                            'backplane, use send')
+        self.broadcast(ObjectFrames(obj, key))
+
+    def broadcast(self, frames):
+        """Delivers ``frames`` now, or at the end of the current :attr:`tick`
+
+        :returns: The listeners the message is, or will be, written to
+        """
+        if not self.tick:
+            return self.deliver(self._sequenced(frames))
+        batch = getattr(self, '_batch', None)
+        if batch is None:
+            self._batch = batch = []
+            self._flusher = self.backend.call_later(self.tick, self.flush)
+        batch.append(frames)
+        return list(self.listeners)
+
+    def flush(self):
+        """Delivers the messages buffered during the current :attr:`tick`"""
+        batch = getattr(self, '_batch', None)
+        if not batch:
+            return
+        self._batch = None
+        # does nothing when called by the timer itself
+        self._flusher.cancel()
+        self._flusher = None
+        batch = [self._sequenced(frames) for frames in batch]
+        if len(batch) == 1:
+            self.deliver(batch[0])
+        else:
+            self.deliver(FrameBatch(batch))
+
+    def _sequenced(self, frames):
+        """Numbers ``frames`` and keeps it for :meth:`replay`"""
+        if not self.replay_size:
+            return frames
+        self.sequence = seq = self.sequence + 1
+        message = self.sequence_message(seq, frames.message)
+        if message is not frames.message:
+            frames = frames.with_message(message)
+        history = getattr(self, '_history', None)
+        if history is None or history.maxlen != self.replay_size:
+            self._history = history = deque(history or (),
+                                            maxlen=self.replay_size)
+        history.append((seq, frames))
+        return frames
+
+    def sequence_message(self, seq, message):
+        """Returns ``message`` as it should be sent with sequence ``seq``
+
+        Override this to embed the sequence number, and the :attr:`epoch`,
+        in your messages so that clients can present the last ones they saw
+        when they reconnect. The default sends the message unchanged.
         """
-        remove = []
+        return message
+
+    def missed(self, last_seq):
+        """Returns the ``(seq, frames)`` sent after ``last_seq``
+
+        :returns: A list, or None if some of them are no longer kept or
+            ``last_seq`` is ahead of :attr:`sequence`, so was numbered by
+            another process
+        """
+        if last_seq > self.sequence:
+            return None
+        if last_seq == self.sequence:
+            return []
+        history = getattr(self, '_history', None)
+        if not history or history[0][0] > last_seq + 1:
+            return None
+        return [(seq, frames) for seq, frames in history if seq > last_seq]
+
+    def replay(self, ws, last_seq, epoch=None):
+        """Sends ``ws`` everything delivered after ``last_seq``
+
+        Falls back to :meth:`snapshot` when the messages are no longer in
+        the replay buffer, or ``last_seq`` wasn't numbered by this process:
+        it is from another :attr:`epoch` or ahead of :attr:`sequence`.
+        Messages sent while replaying are caught up on too.
+
+        :returns: The sequence number ``ws`` is now up to date with
+        """
+        if last_seq > self.sequence or (epoch is not None and
+                                        epoch != self.epoch):
+            current = self.sequence
+            self.snapshot(ws)
+            last_seq = current
+        while last_seq < self.sequence:
+            missed = self.missed(last_seq)
+            if missed is None:
+                current = self.sequence
+                self.snapshot(ws)
+                last_seq = current
+                continue
+            for seq, frames in missed:
+                write_message(ws, frames)
+                last_seq = seq
+        return last_seq
+
+    def snapshot(self, ws):
+        """Sends ``ws`` the complete current state
+
+        Called by :meth:`replay` when a client has missed more than the
+        replay buffer holds. Override it to send whatever a client needs to
+        resynchronise, the default sends nothing.
+        """
+
+    def deliver(self, frames, exclude=()):
+        """Writes an already prepared message to the :attr:`listeners`
+
+        :param frames: A :class:`stargate.frames.FrameCache`
+        :param exclude: Listeners not to write to, for instance because they
+            have already received ``frames`` from another resource
+        :returns: The listeners written to
+        """
+        self.offloader.prepare(frames, self.listeners)
+        written = []
         for ws in self.listeners:
+            if ws in exclude:
+                continue
             try:
-                ws.send(message)
-            except socket.error, e: #pragma NO COVER
-                if get_errno(e) != errno.EPIPE:
-                    raise
-                remove.append(ws)
-        for ws in remove:
+                self._write(ws, frames)
+            except (socket.error, IOError), e:
+                log.debug('Removing listener %r after write failed: %s', ws, e)
+                self.remove_listener(ws)
+            else:
+                written.append(ws)
+        return written
+
+    def publish(self, message, binary=False, timeout=None, key=None):
+        """Sends ``message`` to all :attr:`listeners` without blocking
+
+        Each listener is written to concurrently from :attr:`pool` and has
+        ``timeout`` (default :attr:`write_timeout`) seconds to accept the
+        message. Listeners that fail or time out are removed and their
+        connection closed, since a timed out frame may be half written.
+
+        The message is numbered and kept for :meth:`replay` like one that
+        is sent, but isn't held back by :attr:`tick`. It is only written to
+        the listeners in this process, a :attr:`backplane` isn't used, so
+        with several workers use :meth:`send` instead.
+
+        :returns: A :class:`~stargate.delivery.Delivery` whose ``wait`` returns
+            the :class:`~stargate.delivery.DeliveryStats`
+        """
+        if timeout is None:
+            timeout = self.write_timeout
+        frames = self._sequenced(FrameCache(message, binary, key))
+        listeners = list(self.listeners)
+        return Delivery(eventlet.spawn(self._publish, listeners, frames,
+                                       timeout))
+
+    def _publish(self, listeners, frames, timeout):
+        self.offloader.prepare(frames, listeners)
+        stats = fan_out(self.pool, listeners, frames, timeout, self._write)
+        self._drop(stats.dropped)
+        return stats
+
+    def offload(self, func, *args, **kwargs):
+        """Runs ``func(*args, **kwargs)`` with the :attr:`offloader` and
+        returns its result, for work such as encoding a message before
+        sending it
+        """
+        return self.offloader.run(func, *args, **kwargs)
+
+    def _drop(self, dropped):
+        """Removes and disconnects listeners a publish gave up on"""
+        for ws in dropped:
             self.remove_listener(ws)
+            try:
+                ws.close_connection()
+            except (AttributeError, socket.error):
+                pass
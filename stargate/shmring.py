@@ -0,0 +1,243 @@
+"""A memory mapped ring buffer shared by the worker processes on one host
+
+:class:`SharedMemoryBackplane` is a :class:`~stargate.backplane.Backplane`
+built on it: a broadcast is copied into the ring once, by the worker that
+sends it, and every worker (including that one) reads it straight out of the
+shared mapping and delivers it to its local listeners. Nothing is pushed
+through a socket or pipe per worker::
+
+    registry = ResourceRegistry()
+    backplane = SharedMemoryBackplane(registry, '/dev/shm/stargate.ring')
+    backplane.start()
+    WebSocketAwareResource.registry = registry
+    WebSocketAwareResource.backplane = backplane
+
+The ring is a file (put it on a tmpfs such as ``/dev/shm``) holding a small
+header followed by the records. Writers take an exclusive ``flock`` for the
+few microseconds it takes to copy a record in, on a descriptor each process
+opens for itself, so rings made before a server forks its workers still
+exclude the writers in different workers. Readers take no lock at all; each
+one remembers how far it has read and polls the header for new records.
+
+A writer reserves the space for a record in the header before copying it in
+and only then moves the write position past it. A reader that has copied a
+record checks that no writer has reserved the space it was read from, so a
+record being overwritten as it is read is never delivered torn. A reader
+that falls more than a whole ring behind loses the records that were
+overwritten and skips forward to the newest.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+
+import eventlet
+
+from stargate.backplane import Backplane, pack_message, unpack_message
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'SGR2'
+#: Magic, capacity, absolute write position, absolute end of the space
+#: reserved by the writer, records written
+HEADER = struct.Struct('!4sxxxxQQQQ')
+#: Offsets of the header fields changed while the ring is in use. Each is
+#: copied in and out of the mapping a whole aligned field at a time, so that
+#: a reader never sees one half written.
+POSITION, RESERVED, COUNT = 16, 24, 32
+FIELD = struct.Struct('!Q')
+#: Record length and sequence number
+RECORD = struct.Struct('!IQ')
+#: Marks that the rest of the ring is unused and records continue at the start
+WRAP = 0xFFFFFFFF
+
+
+class RingFull(Exception):
+    """Raised for a record larger than the ring"""
+
+
+class SharedRing(object):
+    """A single writer at a time, many reader, ring of byte records
+
+    :param path: The file backing the ring, created if it doesn't exist
+    :param capacity: Bytes available for records. Ignored when attaching to
+        an existing ring, whose capacity is used instead.
+    """
+
+    def __init__(self, path, capacity=8 * 1024 * 1024):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._pid = os.getpid()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            existing = os.fstat(self._fd).st_size
+            if existing >= HEADER.size:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                magic, capacity, _, _, _ = HEADER.unpack(
+                    os.read(self._fd, HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError('%s is not a stargate ring' % path)
+            else:
+                os.ftruncate(self._fd, HEADER.size + capacity)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, HEADER.pack(MAGIC, capacity, 0, 0, 0))
+            self.capacity = capacity
+            self._map = mmap.mmap(self._fd, HEADER.size + capacity)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _get(self, field):
+        return FIELD.unpack(self._map[field:field + FIELD.size])[0]
+
+    def _set(self, field, value):
+        self._map[field:field + FIELD.size] = FIELD.pack(value)
+
+    @property
+    def write_position(self):
+        """The absolute offset the next record will be written at"""
+        return self._get(POSITION)
+
+    @property
+    def reserved_position(self):
+        """The absolute offset up to which a writer may be copying"""
+        return self._get(RESERVED)
+
+    def _lock(self):
+        if self._pid != os.getpid():
+            # A forked child shares its parent's open file description, and
+            # with it any flock the parent holds
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._pid = os.getpid()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def append(self, data):
+        """Copies ``data`` into the ring
+
+        :returns: The record's sequence number
+        """
+        needed = RECORD.size + len(data)
+        if needed > self.capacity:
+            raise RingFull('%d byte record does not fit in a %d byte ring' %
+                           (len(data), self.capacity))
+        self._lock()
+        try:
+            position = self._get(POSITION)
+            offset = position % self.capacity
+            wrap = needed > self.capacity - offset
+            end = position + needed
+            if wrap:
+                end += self.capacity - offset
+            self._set(RESERVED, end)
+            if wrap:
+                if self.capacity - offset >= 4:
+                    struct.pack_into('!I', self._map, HEADER.size + offset,
+                                     WRAP)
+                offset = 0
+            start = HEADER.size + offset
+            seq = self._get(COUNT) + 1
+            RECORD.pack_into(self._map, start, len(data), seq)
+            self._map[start + RECORD.size:start + needed] = data
+            self._set(COUNT, seq)
+            self._set(POSITION, end)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return seq
+
+    def reader(self):
+        """Returns a :class:`RingReader` starting at the newest record"""
+        return RingReader(self)
+
+
+class RingReader(object):
+    """Reads the records appended to a :class:`SharedRing` after it was made"""
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.position = ring.write_position
+        #: Records lost because the writers lapped this reader
+        self.lost = 0
+
+    def _lapped(self, upto):
+        if upto - self.position > self.ring.capacity:
+            log.warning('Shared ring reader fell behind, skipping ahead')
+            self.lost += 1
+            self.position = upto
+            return True
+        return False
+
+    def read(self):
+        """Returns a list of the records written since the last read"""
+        ring = self.ring
+        mapping = ring._map
+        capacity = ring.capacity
+        records = []
+        end = ring.write_position
+        while self.position < end:
+            if self._lapped(ring.reserved_position):
+                break
+            offset = self.position % capacity
+            if capacity - offset < 4:
+                self.position += capacity - offset
+                continue
+            start = HEADER.size + offset
+            length = struct.unpack_from('!I', mapping, start)[0]
+            if length == WRAP:
+                self.position += capacity - offset
+                continue
+            data = mapping[start + RECORD.size:start + RECORD.size + length]
+            # A writer may have started overwriting the record while it was
+            # copied, in which case it has reserved the space
+            if self._lapped(ring.reserved_position):
+                break
+            records.append(data)
+            self.position += RECORD.size + length
+        return records
+
+
+class SharedMemoryBackplane(Backplane):
+    """A :class:`~stargate.backplane.Backplane` for workers sharing a host
+
+    :param registry: See :class:`~stargate.backplane.Backplane`
+    :param path: The file backing the :class:`SharedRing`
+    :param capacity: See :class:`SharedRing`
+    :param poll_interval: Seconds between checks for new records when idle
+    """
+
+    def __init__(self, registry, path, capacity=8 * 1024 * 1024,
+                 poll_interval=0.001):
+        super(SharedMemoryBackplane, self).__init__(registry)
+        self.ring = SharedRing(path, capacity)
+        self.poll_interval = poll_interval
+        self._reader = None
+
+    def start(self):
+        self._reader = eventlet.spawn(self._read, self.ring.reader())
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.kill()
+            self._reader = None
+        self.ring.close()
+
+    def publish(self, path, message, binary=False, key=None):
+        self.ring.append(pack_message(path, message, binary, key)[4:])
+
+    def _read(self, reader):
+        while True:
+            records = reader.read()
+            for record in records:
+                try:
+                    self.dispatch(*unpack_message(record))
+                except Exception:
+                    log.exception('Failed dispatching shared ring message')
+            if not records:
+                eventlet.sleep(self.poll_interval)
+            else:
+                eventlet.sleep(0)
@@ -1,32 +1,124 @@
+from contextlib import contextmanager
 import errno
+import mmap
+import os
+import stat
 import sys
+import time
 import types
+import weakref
 from eventlet import wsgi
+from eventlet.hubs import trampoline
 from eventlet.semaphore import Semaphore
 from eventlet.support import get_errno
 from eventlet.green import socket
 from eventlet.websocket import WebSocket as v76WebSocket
 from webob import Response
-from pyramid.httpexceptions import HTTPBadRequest
-from ws4py.streaming import Stream
-
+from pyramid.httpexceptions import HTTPBadRequest, HTTPServiceUnavailable
+from ws4py.framing import OPCODE_TEXT, OPCODE_BINARY, OPCODE_PING
+from ws4py.messaging import CloseControlMessage
+
+from stargate.admission import NO_TICKET, Overloaded
+from stargate.codec import JSON, ObjectMixin
+from stargate.deflate import Deflate
+from stargate.frames import HIXIE76, HYBI, hybi_header
+from stargate.framing import Stream
+from stargate.offload import INLINE
 from stargate.handshake import websocket_handshake, HandShakeFailed
 
-class WebSocket(object):
-    def __init__(self, sock, environ, protocols=None, extensions=None):
+
+#: The websockets being handled by views in this process
+_handling = weakref.WeakSet()
+
+
+def open_websockets():
+    """Returns the websockets being handled by views in this process, for
+    instance to close them as the process stops
+    """
+    return list(_handling)
+
+
+class CloseCallbacksMixin(object):
+    """Lets interested parties, such as the resources a websocket listens to,
+    be told when the websocket's handler has finished with it
+    """
+
+    _close_callbacks = ()
+
+    def add_close_callback(self, callback):
+        """Arranges for ``callback(websocket)`` to be called on close"""
+        if not self._close_callbacks:
+            self._close_callbacks = []
+        self._close_callbacks.append(callback)
+
+    def remove_close_callback(self, callback):
+        if callback in self._close_callbacks:
+            self._close_callbacks.remove(callback)
+
+    def fire_close_callbacks(self):
+        """Calls, and forgets, every registered close callback"""
+        callbacks, self._close_callbacks = self._close_callbacks, ()
+        for callback in callbacks:
+            callback(self)
+
+
+class WebSocket(CloseCallbacksMixin, ObjectMixin):
+
+    #: The framing spoken by this websocket, see :mod:`stargate.frames`
+    wire_protocol = HYBI
+    #: Size of the buffer each read from the connection fills
+    read_buffer_size = 64 * 1024
+    #: Largest fragment sent by :meth:`send_stream`
+    fragment_size = 64 * 1024
+    #: Without ``sendmsg``, frames smaller than this have their header and
+    #: payload joined and written at once rather than written separately
+    gather_threshold = 16 * 1024
+    #: Seconds a read or write on the connection may block for, or None
+    #: to block for ever
+    timeout = 30.0
+    #: Largest message accepted from the peer, larger ones close the
+    #: connection with code 1009. None for no limit.
+    max_message_size = Stream.max_message_size
+    #: Largest message accepted by :meth:`receive_fragments`, which only
+    #: ever holds a read's worth of it. None for no limit.
+    max_streamed_size = Stream.max_streamed_size
+
+    #: The negotiated :class:`~stargate.deflate.Deflate`, if any
+    deflate = None
+    #: The :class:`~stargate.offload.Offloader` compressing large messages
+    offloader = INLINE
+
+    def __init__(self, sock, environ, protocols=None, extensions=None,
+                 timeout=None):
         self.stream = Stream()
+        self.stream.max_message_size = self.max_message_size
+        self.stream.max_streamed_size = self.max_streamed_size
+        self._read_buffer = bytearray(self.read_buffer_size)
 
         self.protocols = protocols
         self.extensions = extensions
+        _use_extensions(self, extensions)
         self.environ = environ
 
         self.sock = sock
-        self.sock.settimeout(30.0)
+        if timeout is not None:
+            self.timeout = timeout
+        self.sock.settimeout(self.timeout)
+
+        #: When anything, or a message, was last received from the peer
+        #: and when a message was last sent or received, as time.time()
+        #: values. Used by :mod:`stargate.keepalive`.
+        self.last_received = self.last_active = time.time()
 
         self.client_terminated = False
         self.server_terminated = False
 
-        self._lock = Semaphore()
+        # Guards the stream. Only held while parsing and never while
+        # writing, so a reader never holds up a writer.
+        self._read_lock = Semaphore()
+        # Serialises whole frames (or whole fragmented messages) onto the
+        # connection
+        self._write_lock = Semaphore()
 
     def close(self, code=1000, reason=''):
         """
@@ -41,9 +133,11 @@ class WebSocket(object):
         @param code: status code describing why the connection is closed
         @param reason: a human readable message describing why the connection is closed
         """
-        if not self.server_terminated:
-            self.server_terminated = True
-            self.write_to_connection(self.stream.close(code=code, reason=reason))
+        with self._write_lock:
+            if not self.server_terminated:
+                self.server_terminated = True
+                self.sock.sendall(
+                    CloseControlMessage(code=code, reason=reason).single())
         self.close_connection()
 
     @property
@@ -60,15 +154,101 @@ class WebSocket(object):
 
         @param bytes: data tio send out
         """
-        return self.sock.sendall(bytes)
+        with self._writing():
+            return self.sock.sendall(bytes)
+
+    def write_buffers(self, buffers):
+        """
+        Writes each of the provided buffers to the underlying
+        connection, without joining them and without any other
+        write getting in between.
+
+        @param buffers: a list of strings, bytearrays or memoryviews
+        """
+        with self._writing():
+            self._send_buffers(buffers)
+
+    @contextmanager
+    def _writing(self):
+        """
+        Holds the write lock for the duration of the block, once
+        it is known the close frame hasn't been sent.
+        """
+        with self._write_lock:
+            if self.server_terminated:
+                raise socket.error(errno.EPIPE, 'The websocket is closed')
+            yield
+
+    def _send_buffers(self, buffers):
+        # the caller holds the write lock
+        if _has_sendmsg:
+            return self._sendmsg(buffers)
+        if len(buffers) == 1:
+            return self.sock.sendall(buffers[0])
+        if sum(map(len, buffers)) < self.gather_threshold:
+            data = bytearray()
+            for buf in buffers:
+                data += buf
+            return self.sock.sendall(data)
+        # With MSG_MORE the kernel holds the header back until the
+        # payload arrives instead of sending it in a segment of its own
+        for buf in buffers[:-1]:
+            self.sock.sendall(buf, _MSG_MORE)
+        self.sock.sendall(buffers[-1])
+
+    def _sendmsg(self, buffers):
+        # the caller holds the write lock
+        sock = getattr(self.sock, 'fd', self.sock)
+        buffers = list(buffers)
+        while buffers:
+            try:
+                sent = sock.sendmsg(buffers)
+            except socket.error, e:
+                if get_errno(e) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                trampoline(sock, write=True, timeout=self.sock.gettimeout(),
+                           timeout_exc=socket.timeout)
+                continue
+            while sent:
+                size = len(buffers[0])
+                if sent < size:
+                    buffers[0] = memoryview(buffers[0])[sent:]
+                    break
+                sent -= size
+                buffers.pop(0)
+
+    def write_frame(self, frame):
+        """
+        Writes an already built frame, as produced by
+        :mod:`stargate.frames`, to the connection.
+
+        @param frame: the frame bytes
+        """
+        self.last_active = time.time()
+        return self.write_to_connection(frame)
+
+    def ping(self, data=''):
+        """
+        Sends a ping frame, which the peer answers with a pong.
+
+        @param data: application data, at most 125 bytes
+        """
+        self.write_to_connection(hybi_header(len(data), OPCODE_PING) + data)
 
     def read_from_connection(self, amount):
         """
-        Reads bytes from the underlying connection.
+        Reads bytes from the underlying connection into the
+        preallocated read buffer.
+
+        Returns a buffer over the bytes read rather than a copy of
+        them, which the next read overwrites; the stream's parser
+        copies out, unmasking as it goes, only what it keeps.
 
-        @param amount: quantity to read (if possible)
+        @param amount: most bytes to read, at most read_buffer_size
         """
-        return self.sock.recv(amount)
+        buf = self._read_buffer
+        received = self.sock.recv_into(buf, min(amount, len(buf)))
+        return buffer(buf, 0, received)
 
     def close_connection(self):
         """
@@ -83,99 +263,371 @@ class WebSocket(object):
         """
         Sends the given payload out.
 
-        If payload is some bytes or a bytearray,
-        then it is sent as a single message not fragmented.
+        If payload is some bytes, a bytearray or a memoryview,
+        then it is sent as a single message not fragmented. The
+        frame header and payload are written as separate buffers
+        so the payload is never copied into a frame.
 
         If payload is a generator, each chunk is sent as part of
         fragmented message.
 
-        @param payload: string, bytes, bytearray or a generator
+        With permessage-deflate negotiated, whole messages are
+        sent compressed.
+
+        @param payload: string, bytes, bytearray, memoryview or a generator
         @param binary: if set, handles the payload as a binary message
         """
-        if isinstance(payload, basestring) or isinstance(payload, bytearray):
-            if not binary:
-                self.write_to_connection(self.stream.text_message(payload).single())
+        self.last_active = time.time()
+        if isinstance(payload, (basestring, bytearray, memoryview)):
+            opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+            if isinstance(payload, unicode):
+                payload = payload.encode('utf-8')
+            if self.deflate is not None:
+                # compressed under the lock so that, with context
+                # takeover, frames go out in the order they were
+                # compressed
+                with self._writing():
+                    payload = self._compress(payload)
+                    self._send_buffers([
+                        hybi_header(len(payload), opcode, rsv1=1), payload])
             else:
-                self.write_to_connection(self.stream.binary_message(payload).single())
+                self.write_buffers([
+                    hybi_header(len(payload) * _itemsize(payload), opcode),
+                    payload])
 
         elif type(payload) == types.GeneratorType:
-            bytes = payload.next()
-            first = True
-            for chunk in payload:
-                if not binary:
-                    self.write_to_connection(self.stream.text_message(bytes).fragment(first=first))
-                else:
-                    self.write_to_connection(self.stream.binary_message(payload).fragment(first=first))
-                bytes = chunk
-                first = False
-            if not binary:
-                self.write_to_connection(self.stream.text_message(bytes).fragment(last=True))
-            else:
-                self.write_to_connection(self.stream.text_message(bytes).fragment(last=True))
+            self.send_stream(payload, binary)
 
-    def receive(self, message_obj=False):
+    def send_stream(self, source, binary=True, fragment_size=None):
+        """
+        Sends the contents of source as one fragmented message,
+        without holding more than a fragment of it in memory.
+
+        source may be a file object, an mmap or another buffer,
+        or an iterable of strings or buffers. Files are read
+        into a reused buffer with readinto and buffers are sliced
+        without being copied. Where os.sendfile exists, regular
+        files are sent by it straight from the page cache (unless
+        the message is being compressed).
+
+        Nothing else is written to the connection until the whole
+        message has been sent.
+
+        @param source: file, mmap, buffer or iterable of buffers
+        @param binary: if set, sends a binary message
+        @param fragment_size: largest fragment to send, defaults
+            to the fragment_size attribute
+        """
+        self.last_active = time.time()
+        size = fragment_size or self.fragment_size
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        with self._writing():
+            if self.deflate is None and _sendfile is not None:
+                fd = _regular_file(source)
+                if fd is not None:
+                    return self._sendfile(source, fd, opcode, size)
+            first = True
+            pieces = _pieces(source, size)
+            piece = next(pieces, '')
+            while True:
+                following = next(pieces, None)
+                if self._send_fragment(piece, opcode, following is None,
+                                       first):
+                    first = False
+                if following is None:
+                    break
+                piece = following
+
+    def _send_fragment(self, data, opcode, fin, first):
+        # the caller holds the write lock
+        rsv1 = 0
+        if self.deflate is not None:
+            data = self._compress(data, fin)
+            if not data and not fin:
+                # nothing ready from the compressor yet
+                return False
+            rsv1 = int(first)
+        self._send_buffers([
+            hybi_header(len(data), opcode if first else 0, int(fin), rsv1),
+            data])
+        return True
+
+    def _compress(self, data, final=True):
+        # the caller holds the write lock, which keeps the compressor to
+        # one thread at a time
+        if self.offloader.worth_it(len(data)):
+            return self.offloader.run(self.deflate.compress, data, final)
+        return self.deflate.compress(data, final)
+
+    def _sendfile(self, source, fd, opcode, size):
+        # the caller holds the write lock
+        offset = source.tell()
+        remaining = os.fstat(fd).st_size - offset
+        out = self.sock.fileno()
+        first = True
+        while first or remaining:
+            count = min(size, remaining)
+            remaining -= count
+            self.sock.sendall(hybi_header(count, opcode if first else 0,
+                                          int(not remaining)), _MSG_MORE)
+            while count:
+                try:
+                    sent = _sendfile(out, fd, offset, count)
+                except OSError, e:
+                    if get_errno(e) != errno.EAGAIN:
+                        raise
+                    trampoline(out, write=True,
+                               timeout=self.sock.gettimeout(),
+                               timeout_exc=socket.timeout)
+                    continue
+                if not sent:
+                    raise IOError('%r was truncated while being sent' %
+                                  source)
+                offset += sent
+                count -= sent
+            first = False
+        source.seek(offset)
+
+    def receive(self, message_obj=False, as_view=False):
         """
         Performs the operation of reading from the underlying
         connection in order to feed the stream of bytes.
 
-        We start with a small size of two bytes to be read
-        from the connection so that we can quickly parse an
-        incoming frame header. Then the stream indicates
-        whatever size must be read from the connection since
-        it knows the frame payload length.
+        Each read fills as much of the read buffer as the
+        connection has available and every frame completed by it
+        is parsed. Messages beyond the first are kept in the
+        stream's queue and returned by the following calls without
+        touching the connection, so a burst of small messages costs
+        a single read.
+
+        A message's payload is assembled, unmasked, straight from
+        the read buffer and then copied once into the string
+        returned. With ``as_view`` set it is returned as a
+        :class:`memoryview` over the buffer it was assembled in
+        instead, saving that copy.
 
         Note that we perform some automatic opererations:
 
         * On a closing message, we respond with a closing
-          message and finally close the connection
+          message and finally close the connection, once any
+          messages received before it have been returned
         * We respond to pings with pong messages.
         * Whenever an error is raised by the stream parsing,
           we initiate the closing of the connection with the
           appropriate error code.
         """
-        next_size = 2
-        #try:
+        s = self.stream
         while not self.terminated:
-            bytes = self.read_from_connection(next_size)
-            if not bytes and next_size > 0:
-                raise IOError()
-
-            message = None
-            with self._lock:
-                s = self.stream
-                next_size = s.parser.send(bytes)
-
-                if s.closing is not None:
-                    if not self.server_terminated:
-                        next_size = 2
-                        self.close(s.closing.code, s.closing.reason)
-                    else:
-                        self.client_terminated = True
-                    raise IOError()
-
-                elif s.errors:
-                    errors = s.errors[:]
-                    for error in s.errors:
-                        self.close(error.code, error.reason)
-                        s.errors.remove(error)
-                    raise IOError()
-
-                elif s.has_message:
-                    if message_obj:
-                        message = s.message
-                        s.message = None
+            with self._read_lock:
+                if s.messages:
+                    return self._take_message(message_obj, as_view)
+                closing = s.closing
+            if closing is not None:
+                self._closed_by_peer(closing)
+            self._read()
+
+    def receive_fragments(self):
+        """
+        Iterates over the next message as it arrives rather than
+        once it is complete, yielding ``(data, last)`` pairs where
+        ``last`` is set on the message's final piece.
+
+        Each piece is at most as large as what one read from the
+        connection returned, so a message of any size can be
+        piped somewhere with bounded memory. Compressed messages
+        are decompressed, and text validated, as they arrive.
+
+        A message completed before iteration started is yielded
+        whole. The iterator should be run to the end, or the rest
+        of the message will be read as a message of its own.
+        """
+        s = self.stream
+        with self._read_lock:
+            if s.messages:
+                message = self._take_message(False, False)
+            else:
+                message = None
+                s.streaming = True
+        if message is not None:
+            yield message, True
+            return
+        try:
+            while not self.terminated:
+                with self._read_lock:
+                    if s.fragments:
+                        data, last = s.fragments.popleft()
                     else:
-                        message = str(s.message)
-                        s.message.data = None
-                        s.message = None
+                        data = None
+                        closing = s.closing
+                if data is not None:
+                    yield data, last
+                    if last:
+                        return
+                else:
+                    if closing is not None:
+                        self._closed_by_peer(closing)
+                    self._read()
+        finally:
+            s.streaming = False
+
+    def _closed_by_peer(self, closing):
+        if not self.server_terminated:
+            self.close(closing.code, closing.reason)
+        else:
+            self.client_terminated = True
+        raise IOError()
+
+    def _read(self):
+        """Reads once from the connection, feeds the stream with it
+        and then, outside of the read lock, answers any pings"""
+        bytes = self.read_from_connection(self.read_buffer_size)
+        if not bytes:
+            raise IOError()
+        self.last_received = time.time()
+
+        with self._read_lock:
+            s = self.stream
+            s.parser.send(bytes)
+            errors, s.errors = s.errors, []
+            pings, s.pings = s.pings, []
+            s.pongs = []
+            if s.messages or s.fragments:
+                self.last_active = self.last_received
+
+        if errors:
+            self.close(errors[0].code, errors[0].reason)
+            raise IOError()
+        for ping in pings:
+            if not self.server_terminated:
+                self.write_to_connection(s.pong(str(ping.data)))
+
+    def _take_message(self, message_obj, as_view):
+        s = self.stream
+        message = s.messages.popleft()
+        if s.message is message:
+            s.message = None
+        if message_obj:
+            return message
+        if as_view:
+            return message.view()
+        data = str(message)
+        message.data = None
+        return data
+
+
+def _use_extensions(ws, extensions):
+    """Sets a websocket up for the extensions negotiated in its handshake"""
+    for extension in extensions or ():
+        if isinstance(extension, Deflate):
+            ws.deflate = ws.stream.deflate = extension
+            # None when frames compressed with their own context can't be
+            # shared
+            ws.wire_protocol = extension.wire_protocol
+
+_sendfile = getattr(os, 'sendfile', None)
+_has_sendmsg = hasattr(socket.socket, 'sendmsg')
+# Python 2 doesn't expose MSG_MORE; it is 0x8000 on Linux and unknown to
+# (so has to be left out on) other platforms
+_MSG_MORE = getattr(socket, 'MSG_MORE',
+                    0x8000 if sys.platform.startswith('linux') else 0)
+
+def _itemsize(payload):
+    return getattr(payload, 'itemsize', 1)
+
+def _regular_file(source):
+    """Returns the descriptor of a file object for a regular file"""
+    try:
+        fd = source.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            source.flush()
+            return fd
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    return None
+
+def _slice(data, offset, size):
+    if isinstance(data, memoryview):
+        return data[offset:offset + size]
+    return buffer(data, offset, size)
+
+def _pieces(source, size):
+    """Yields the contents of ``source`` in pieces of at most ``size`` bytes,
+    each only valid until the next is asked for
+    """
+    if isinstance(source, (str, bytearray, memoryview, mmap.mmap)):
+        for offset in xrange(0, len(source), size):
+            yield _slice(source, offset, size)
+    elif hasattr(source, 'readinto'):
+        buffers = bytearray(size), bytearray(size)
+        views = memoryview(buffers[0]), memoryview(buffers[1])
+        current = 0
+        while True:
+            read = source.readinto(buffers[current])
+            if not read:
+                break
+            yield views[current][:read]
+            current = 1 - current
+    elif hasattr(source, 'read'):
+        for data in iter(lambda: source.read(size), ''):
+            yield data
+    else:
+        for chunk in source:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            if len(chunk) <= size:
+                if chunk:
+                    yield chunk
+            else:
+                for offset in xrange(0, len(chunk), size):
+                    yield _slice(chunk, offset, size)
 
-                for ping in s.pings:
-                    self.write_to_connection(s.pong(str(ping.data)))
-                s.pings = []
-                s.pongs = []
 
-                if message is not None:
-                    return message
+class HixieWebSocket(CloseCallbacksMixin, ObjectMixin, v76WebSocket):
+    """A draft 76 :class:`eventlet.websocket.WebSocket` which can also be
+    written pre-built frames by :mod:`stargate.frames`
+    """
+
+    wire_protocol = HIXIE76
+
+    def __init__(self, sock, environ, version=76):
+        v76WebSocket.__init__(self, sock, environ, version)
+        #: See :attr:`WebSocket.last_received`. Draft 76 has no pings, so
+        #: both only change with messages.
+        self.last_received = self.last_active = time.time()
+
+    def send(self, message, binary=False):
+        """Sends a text message. Draft 76 has no binary messages, so
+        ``binary`` must be False.
+        """
+        if binary:
+            raise ValueError('Draft 76 websockets can only send text')
+        v76WebSocket.send(self, message)
+        self.last_active = time.time()
+
+    def wait(self):
+        message = v76WebSocket.wait(self)
+        if message is not None:
+            self.last_received = self.last_active = time.time()
+        return message
+
+    def receive(self):
+        """Returns the next message, or None once the connection is closed,
+        as :meth:`wait`
+        """
+        return self.wait()
+
+    def write_frame(self, frame):
+        """Writes an already built draft 76 frame to the socket"""
+        with self._sendlock:
+            self.socket.sendall(frame)
+        self.last_active = time.time()
+
+    def close_connection(self):
+        """Shutdowns then closes the underlying connection"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        finally:
+            self.socket.close()
 
 
 class IncorrectlyConfigured(Exception):
@@ -188,6 +640,28 @@ class WebSocketView(object):
     communiction.
     """
 
+    #: Extensions offered to clients, such as
+    #: :class:`~stargate.deflate.PerMessageDeflate`
+    extensions = ()
+    #: The :mod:`codecs <stargate.codec>` clients may ask for as their
+    #: subprotocol, most preferred first
+    codecs = ()
+    #: The codec of websockets whose clients didn't ask for one of
+    #: :attr:`codecs`
+    default_codec = JSON
+    #: A :class:`~stargate.keepalive.Keepalive` pinging this view's
+    #: websockets and closing dead and idle ones
+    keepalive = None
+    #: Seconds a websocket's reads and writes may block for, see
+    #: :attr:`WebSocket.timeout`
+    timeout = WebSocket.timeout
+    #: A :class:`~stargate.offload.Offloader` for :meth:`offload`, which
+    #: also compresses this view's large outgoing messages
+    offloader = INLINE
+    #: An :class:`~stargate.admission.Admission` turning upgrades away while
+    #: the process is overloaded. Share one between all views.
+    admission = None
+
     def __init__(self, request):
         self.request = request
         self.environ = request.environ
@@ -206,26 +680,70 @@ class WebSocketView(object):
         """
         raise NotImplementedError
 
+    def offload(self, func, *args, **kwargs):
+        """Runs ``func(*args, **kwargs)`` with the :attr:`offloader`,
+        leaving the hub free for other connections, and returns its result
+        """
+        return self.offloader.run(func, *args, **kwargs)
+
     def handle_websocket(self, websocket):
         """Handles the connection after setup and handshake is done
 
         Hands off to :meth:`handler` until the socket is closed and then
         ensures a correct :class:`webob.Response` is returned after the socket
-        is closed
+        is closed. Whatever happens the websocket's close callbacks are fired,
+        removing it from any resources it was listening to.
 
         :param websocket: A :class:`WebSocket <eventlet.websocket.Websocket>`
         """
+        if self.keepalive is not None:
+            self.keepalive.add(websocket)
         try:
             self.handler(websocket)
         except socket.error, e: #pragma NO COVER
             if get_errno(e) != errno.EPIPE:
                 raise
+        finally:
+            websocket.fire_close_callbacks()
         # use this undocumented feature of eventlet.wsgi to close the
         # connection properly
         resp = Response()
         resp.app_iter = wsgi.ALREADY_HANDLED
         return resp
 
+    def admit(self):
+        """Takes a place for the connection from :attr:`admission`,
+        counted against the request's ``context``
+
+        :returns: A :class:`~stargate.admission.Ticket` to release once the
+            connection is over
+        :raises: :exc:`~stargate.admission.Overloaded`
+        """
+        if self.admission is None:
+            return NO_TICKET
+        return self.admission.admit(getattr(self.request, 'context', None))
+
+    def overloaded(self, reason):
+        """Returns the response to an upgrade request turned away by
+        :attr:`admission`
+
+        :returns: :exc:`webob.exc.HTTPServiceUnavailable`
+        """
+        return HTTPServiceUnavailable(
+            headers={'Connection': 'Close',
+                     'Retry-After': str(reason.retry_after)},
+            body='Server overloaded:\n\t%s\n' % reason)
+
+    def handshake_failed(self, reason):
+        """Returns the response to an upgrade request that can't be
+        completed
+
+        :returns: :exc:`webob.exc.HTTPBadRequest`
+        """
+        return HTTPBadRequest(headers=dict(Connection='Close'),
+                              body='Upgrade negotiation failed:\n\t%s\n%s' % \
+                                        (reason, self.request.headers))
+
     def handle_upgrade(self):
         """Completes the upgrade request sent by the browser
 
@@ -234,21 +752,45 @@ class WebSocketView(object):
 
         See [websocket_protocol]_
 
-        :returns: :exc:`webob.exc.HTTPBadRequest` if handshake fails
+        :returns: :exc:`webob.exc.HTTPBadRequest` if handshake fails, or
+            :exc:`webob.exc.HTTPServiceUnavailable` if :attr:`admission`
+            turns the connection away
         """
         #from nose.tools import set_trace; set_trace()
         try:
-            v, handshake_reply = websocket_handshake(self.request.headers)
+            ticket = self.admit()
+        except Overloaded:
+            _, val, _ = sys.exc_info()
+            return self.overloaded(val)
+        try:
+            v, handshake_reply = websocket_handshake(
+                self.request.headers, extensions=self.extensions,
+                codecs=self.codecs)
         except HandShakeFailed:
+            ticket.release()
             _, val, _ = sys.exc_info()
-            response = HTTPBadRequest(headers=dict(Connection='Close'),
-                                      body='Upgrade negotiation failed:\n\t%s\n%s' % \
-                                                (val, self.request.headers))
-            return response
+            return self.handshake_failed(val)
         sock = self.environ['eventlet.input'].get_socket()
-        sock.sendall(handshake_reply)
+        try:
+            sock.sendall(handshake_reply)
+        except:
+            ticket.release()
+            raise
         if v < 2:
-            return self.handle_websocket(v76WebSocket(self.sock, self.environ))
+            websocket = HixieWebSocket(self.sock, self.environ)
         else:
-            return self.handle_websocket(WebSocket(self.sock, self.environ))
+            websocket = WebSocket(
+                self.sock, self.environ,
+                extensions=self.environ.get('stargate.extensions'),
+                timeout=self.timeout)
+            websocket.offloader = self.offloader
+        websocket.add_close_callback(ticket.release)
+        _handling.add(websocket)
+        websocket.add_close_callback(_handling.discard)
+        websocket.codec = self.environ.get('stargate.codec') or \
+            self.default_codec
+        # draft 76 has no binary messages
+        if websocket.codec.binary and websocket.wire_protocol == HIXIE76:
+            websocket.codec = JSON
+        return self.handle_websocket(websocket)
   
\ No newline at end of file
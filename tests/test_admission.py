@@ -0,0 +1,131 @@
+from nose.tools import eq_, ok_
+from unittest import TestCase
+
+from eventlet import wsgi
+from eventlet.green import socket
+import mock
+
+from stargate.admission import Admission, Overloaded, TokenBucket
+from stargate.fastpath import UpgradeRequest
+from stargate.view import WebSocketView
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.bucket = TokenBucket(2, burst=3, clock=self.clock)
+
+    def test_burst_then_rate(self):
+        eq_([self.bucket.take() for i in xrange(4)], [True] * 3 + [False])
+        eq_(self.bucket.wait(), 0.5)
+        self.clock.now += 0.5
+        ok_(self.bucket.take())
+        ok_(not self.bucket.take())
+
+    def test_refill_capped_at_burst(self):
+        self.clock.now += 60
+        eq_(sum(self.bucket.take() for i in xrange(10)), 3)
+
+
+class TestAdmission(TestCase):
+
+    def test_max_connections(self):
+        admission = Admission(max_connections=2, retry_after=5)
+        tickets = [admission.admit(), admission.admit()]
+        try:
+            admission.admit()
+        except Overloaded, e:
+            eq_(e.retry_after, 5)
+        else:
+            self.fail('Admitted a third connection')
+        tickets[0].release()
+        tickets[0].release()
+        eq_(admission.connections, 1)
+        admission.admit()
+        eq_(admission.rejected, 1)
+
+    def test_max_per_resource(self):
+        admission = Admission(max_per_resource=1)
+        ticket = admission.admit('a')
+        admission.admit('b')
+        self.assertRaises(Overloaded, admission.admit, 'a')
+        ticket.release()
+        eq_(admission.connections_to('a'), 0)
+        admission.admit('a')
+
+    def test_handshake_rate(self):
+        admission = Admission(handshake_rate=0.5, handshake_burst=1)
+        admission.admit().release()
+        try:
+            admission.admit()
+        except Overloaded, e:
+            eq_(e.retry_after, 2)
+        else:
+            self.fail('Admitted a handshake over the rate')
+
+    def test_refused_connections_take_no_tokens(self):
+        admission = Admission(max_connections=1, handshake_rate=1,
+                              handshake_burst=2)
+        ticket = admission.admit()
+        self.assertRaises(Overloaded, admission.admit)
+        ticket.release()
+        admission.admit()
+
+
+class HoldingView(WebSocketView):
+
+    def handler(self, websocket):
+        eq_(self.admission.connections_to('resource'), 1)
+
+
+class TestView(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        HoldingView.admission = Admission(max_per_resource=1)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def request(self):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'HTTP_HOST': 'localhost',
+            'HTTP_UPGRADE': 'websocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+            'HTTP_SEC_WEBSOCKET_VERSION': '13',
+            'eventlet.input': mock.Mock(
+                **{'get_socket.return_value': self.server}),
+        }
+        return UpgradeRequest(environ, context='resource')
+
+    def test_released_when_handler_finishes(self):
+        response = HoldingView(self.request())()
+        eq_(response.app_iter, wsgi.ALREADY_HANDLED)
+        eq_(HoldingView.admission.connections, 0)
+
+    def test_overloaded(self):
+        HoldingView.admission.admit('resource')
+        response = HoldingView(self.request())()
+        eq_(response.status_int, 503)
+        eq_(response.headers['Retry-After'], '1')
+        self.client.setblocking(False)
+        self.assertRaises(socket.error, self.client.recv, 1)
+
+    def test_released_when_handshake_fails(self):
+        request = self.request()
+        request.environ['HTTP_SEC_WEBSOCKET_KEY'] = 'c2hvcnQ='
+        eq_(HoldingView(request)().status_int, 400)
+        eq_(HoldingView.admission.connections, 0)
@@ -0,0 +1,235 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, ok_
+from unittest import TestCase
+from weakref import WeakSet
+import socket
+
+import mock
+from webob import Request
+from ws4py.framing import Frame, OPCODE_TEXT, OPCODE_CLOSE
+
+try:
+    from stargate import aio
+except ImportError:
+    raise SkipTest('Neither asyncio nor trollius is installed')
+from stargate.backend import EVENTLET, get_backend
+
+KEY = 'abcd'
+
+UPGRADE = ('GET /echo HTTP/1.1\r\n'
+           'Host: localhost\r\n'
+           'Upgrade: websocket\r\n'
+           'Connection: Upgrade\r\n'
+           'Origin: http://localhost\r\n'
+           'Sec-WebSocket-Version: 13\r\n'
+           'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n')
+
+
+def client_frame(payload, opcode=OPCODE_TEXT):
+    return Frame(opcode=opcode, body=payload, fin=1,
+                 masking_key=KEY).build()
+
+
+class Transport(object):
+    """Records what is written to it"""
+
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(str(data))
+
+    def close(self):
+        self.closed = True
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def get_extra_info(self, name):
+        return {'sockname': ('127.0.0.1', 6543),
+                'peername': ('127.0.0.1', 40000)}.get(name)
+
+    def take(self):
+        data, self.written = ''.join(self.written), []
+        return data
+
+
+class EchoView(aio.AsyncioWebSocketView):
+
+    opened = None
+
+    def handler(self, websocket):
+        EchoView.opened = websocket
+
+    def received(self, websocket, message):
+        websocket.send(str(message))
+
+
+def app(environ, start_response):
+    request = Request(environ)
+    if request.path == '/echo':
+        response = EchoView(request)()
+    else:
+        response = Request.blank('/').ResponseClass(body='hello ' + request.path)
+    return response(environ, start_response)
+
+
+def test_get_backend():
+    eq_(get_backend('eventlet'), EVENTLET)
+    eq_(get_backend('asyncio'), aio.ASYNCIO)
+    ok_(isinstance(get_backend('asyncio'), aio.AsyncioBackend))
+
+
+class TestHTTPProtocol(TestCase):
+
+    def setUp(self):
+        # keeps the websockets opened here from prefork tests, which close
+        # every websocket being handled after this test's loop has gone
+        self.handling = mock.patch.object(aio, '_handling', WeakSet())
+        self.handling.start()
+        self.transport = Transport()
+        self.protocol = aio.HTTPProtocol(app)
+        self.protocol.connection_made(self.transport)
+
+    def tearDown(self):
+        self.handling.stop()
+
+    def test_plain_request(self):
+        self.protocol.data_received('GET /a HTTP/1.1\r\nHost: ')
+        eq_(self.transport.written, [])
+        self.protocol.data_received('localhost\r\n\r\n')
+        response = self.transport.take()
+        ok_(response.startswith('HTTP/1.1 200 OK\r\n'))
+        ok_('Connection: close\r\n' in response)
+        ok_(response.endswith('\r\n\r\nhello /a'))
+        ok_(self.transport.closed)
+
+    def test_bad_request(self):
+        self.protocol.data_received('nonsense\r\n\r\n')
+        ok_(self.transport.take().startswith('HTTP/1.1 400 '))
+        ok_(self.transport.closed)
+
+    def test_echo(self):
+        self.protocol.data_received(UPGRADE + client_frame('first'))
+        reply = self.transport.take()
+        ok_(reply.startswith('HTTP/1.1 101 '))
+        ok_(reply.endswith('\r\n\r\n\x81\x05first'))
+        self.protocol.data_received(client_frame('again'))
+        eq_(self.transport.take(), '\x81\x05again')
+
+    def test_decode_obj(self):
+        received = []
+        with mock.patch.object(EchoView, 'received',
+                               lambda self, ws, message:
+                                   received.append(ws.decode_obj(message))):
+            self.protocol.data_received(UPGRADE + client_frame('{"a":1}'))
+        eq_(received, [{'a': 1}])
+        self.assertRaises(TypeError, EchoView.opened.receive_obj)
+
+    def test_close_handshake(self):
+        self.protocol.data_received(UPGRADE)
+        self.transport.take()
+        ws = EchoView.opened
+        callback = mock.Mock()
+        ws.add_close_callback(callback)
+        self.protocol.data_received(client_frame('\x03\xe8', OPCODE_CLOSE))
+        eq_(self.transport.take()[:4], '\x88\x02\x03\xe8')
+        ok_(self.transport.closed)
+        self.assertRaises(socket.error, ws.send, 'late')
+        self.protocol.connection_lost(None)
+        callback.assert_called_once_with(ws)
+
+    def test_draft76_refused(self):
+        hixie = UPGRADE.split('Sec-')[0].replace('websocket', 'WebSocket')
+        self.protocol.data_received(hixie + '\r\n')
+        ok_(self.transport.take().startswith('HTTP/1.1 400 '))
+
+
+class TestAsyncioResource(TestCase):
+
+    def setUp(self):
+        self.handling = mock.patch.object(aio, '_handling', WeakSet())
+        self.handling.start()
+        self.loop = aio.asyncio.new_event_loop()
+        self.resource = aio.AsyncioResource()
+        self.resource.backend = aio.AsyncioBackend(self.loop)
+        self.transports = [Transport(), Transport()]
+        self.websockets = [aio.AsyncioWebSocket(transport, {})
+                           for transport in self.transports]
+        for ws in self.websockets:
+            self.resource.add_listener(ws)
+
+    def tearDown(self):
+        self.loop.close()
+        self.handling.stop()
+
+    def test_send(self):
+        self.resource.send('hi')
+        eq_([t.take() for t in self.transports], ['\x81\x02hi'] * 2)
+
+    def test_tick_runs_on_the_loop(self):
+        self.resource.tick = 0.01
+        self.resource.send('a')
+        self.resource.send('b')
+        eq_(self.transports[0].written, [])
+        self.loop.run_until_complete(aio.asyncio.sleep(0.05, loop=self.loop))
+        eq_(self.transports[0].take(), '\x81\x01a\x81\x01b')
+
+    def test_publish_drops_backed_up_listener(self):
+        self.transports[1].get_write_buffer_size = lambda: 10 ** 7
+        stats = self.resource.publish('hi').wait()
+        eq_((stats.delivered, stats.timed_out), (1, 1))
+        eq_(list(self.resource.listeners), [self.websockets[0]])
+        ok_(self.transports[1].closed)
+
+    def test_publish_is_kept_for_replay(self):
+        self.resource.replay_size = 2
+        self.resource.publish('hi')
+        eq_(self.resource.sequence, 1)
+        eq_([seq for seq, frames in self.resource.missed(0)], [1])
+
+
+class TestServe(TestCase):
+
+    def test_over_a_real_socket(self):
+        loop = aio.asyncio.new_event_loop()
+        backend = aio.AsyncioBackend(loop)
+        server = loop.run_until_complete(loop.create_server(
+            lambda: aio.HTTPProtocol(app, backend), '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        received = []
+
+        class Client(aio.asyncio.Protocol):
+            def connection_made(self, transport):
+                transport.write(UPGRADE + client_frame('ping?'))
+            def data_received(self, data):
+                received.append(data)
+                if ''.join(received).endswith('ping?'):
+                    loop.stop()
+
+        try:
+            loop.run_until_complete(loop.create_connection(
+                Client, '127.0.0.1', port))
+            loop.call_later(5, loop.stop)
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.close()
+        ok_(''.join(received).endswith('\r\n\r\n\x81\x05ping?'))
+
+    @mock.patch.object(aio, '_handling', set())
+    def test_shutdown(self):
+        loop = aio.asyncio.new_event_loop()
+        backend = aio.AsyncioBackend(loop)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        stop = loop.call_later(5, loop.stop)
+        loop.call_later(0.05, backend.shutdown)
+        try:
+            backend.serve_socket(app, sock)
+            ok_(not stop._cancelled and loop.time() < stop._when)
+            eq_(backend._servers, [])
+        finally:
+            loop.close()
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+
+import eventlet
+from eventlet.green import socket
+from eventlet.queue import Queue
+from eventlet.semaphore import Semaphore
+from nose.tools import eq_, assert_raises
+from stargate import WebSocketAwareResource
+from stargate import backplane as bp
+from stargate.registry import ResourceRegistry
+from stargate.view import WebSocket
+from unittest import TestCase
+import mock
+
+ENVIRON = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+
+class Job(WebSocketAwareResource):
+
+    def __init__(self, name, registry, backplane):
+        self.__name__ = name
+        self.__parent__ = WebSocketAwareResource()
+        self.registry = registry
+        self.backplane = backplane
+
+
+def make_ws():
+    return WebSocket(mock.Mock(), ENVIRON)
+
+
+def wait_for(predicate, timeout=1):
+    with eventlet.Timeout(timeout):
+        while not predicate():
+            eventlet.sleep(0.01)
+
+
+class TestPacking(TestCase):
+
+    def test_round_trip(self):
+        record = bp.pack_message(u'/jobs/1', u'\xe9', binary=False)
+        eq_(len(record) - 4, bp.HEADER.unpack_from(record)[0])
+        eq_(bp.unpack_message(record[4:]),
+            ('/jobs/1', '\xc3\xa9', False, None))
+
+    def test_binary_flag(self):
+        record = bp.pack_message('/', '\x00\x01', binary=True)
+        eq_(bp.unpack_message(record[4:]), ('/', '\x00\x01', True, None))
+
+    def test_key(self):
+        record = bp.pack_message('/', 'value', key='cpu')
+        eq_(bp.unpack_message(record[4:]), ('/', 'value', False, 'cpu'))
+
+
+class TestLocalBackplane(TestCase):
+
+    def test_send_goes_through_backplane(self):
+        registry = ResourceRegistry()
+        backplane = bp.LocalBackplane(registry)
+        job = Job('1', registry, backplane)
+        ws = make_ws()
+        job.add_listener(ws)
+        with mock.patch.object(backplane, 'publish',
+                               wraps=backplane.publish) as publish:
+            job.send('hello')
+        publish.assert_called_once_with('/1', 'hello', False, None)
+        ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+
+
+class TestUnixSocketBackplane(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmp, 'broker.sock')
+        self.broker = bp.UnixSocketBroker(self.address)
+        self.broker.start()
+        self.workers = []
+        for i in range(2):
+            registry = ResourceRegistry()
+            backplane = bp.UnixSocketBackplane(registry, self.address)
+            backplane.start()
+            self.workers.append((registry, backplane))
+        wait_for(lambda: len(self.broker.clients) == 2)
+
+    def tearDown(self):
+        for registry, backplane in self.workers:
+            backplane.close()
+        self.broker.close()
+        shutil.rmtree(self.tmp)
+
+    def test_send_reaches_every_worker(self):
+        listeners = []
+        jobs = []
+        for registry, backplane in self.workers:
+            job = Job('1', registry, backplane)
+            ws = make_ws()
+            job.add_listener(ws)
+            jobs.append(job)
+            listeners.append(ws)
+        jobs[0].send('hello')
+        for ws in listeners:
+            wait_for(lambda: ws.sock.sendall.called)
+            ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+
+    def test_concurrent_publishers(self):
+        received = []
+        registry, backplane = self.workers[1]
+        backplane.dispatch = lambda *args: received.append(args[1])
+        big = ['a' * 2 ** 20, 'b' * 2 ** 20]
+        pool = eventlet.GreenPool()
+        for message in big:
+            for _, publisher in self.workers:
+                pool.spawn(publisher.publish, '/', message)
+        pool.waitall()
+        wait_for(lambda: len(received) == 4, timeout=5)
+        eq_(sorted(received), sorted(big * 2))
+        eq_(len(self.broker.clients), 2)
+
+    def test_failed_subscriber_dropped(self):
+        client = mock.Mock(**{'sendall.side_effect': socket.error})
+        self.broker.clients[client] = Semaphore()
+        self.workers[0][1].publish('/', 'hi')
+        wait_for(lambda: client not in self.broker.clients)
+        client.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+    def test_publish_when_closed(self):
+        registry, backplane = self.workers[0]
+        backplane.close()
+        assert_raises(bp.BackplaneError, backplane.publish, '/', 'hi')
+
+
+class QueueAdapter(bp.BrokerAdapter):
+
+    def __init__(self):
+        self.queue = Queue()
+
+    def publish(self, channel, data):
+        self.queue.put((channel, data))
+
+    def listen(self, channel):
+        while True:
+            published_on, data = self.queue.get()
+            eq_(published_on, channel)
+            yield data
+
+
+class TestAdapterBackplane(TestCase):
+
+    def test_publish_and_dispatch(self):
+        registry = ResourceRegistry()
+        backplane = bp.AdapterBackplane(registry, QueueAdapter(), 'jobs')
+        backplane.start()
+        job = Job('1', registry, backplane)
+        ws = make_ws()
+        job.add_listener(ws)
+        job.send('hello')
+        wait_for(lambda: ws.sock.sendall.called)
+        ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+        backplane.close()
+
+    def test_redis_adapter(self):
+        client = mock.Mock()
+        client.pubsub.return_value.listen.return_value = iter([
+            dict(type='subscribe', data=1),
+            dict(type='message', data='payload'),
+        ])
+        adapter = bp.RedisAdapter(client)
+        adapter.publish('stargate', 'data')
+        client.publish.assert_called_once_with('stargate', 'data')
+        eq_(list(adapter.listen('stargate')), ['payload'])
+        client.pubsub.return_value.subscribe.assert_called_once_with('stargate')
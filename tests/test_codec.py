@@ -0,0 +1,185 @@
+from nose.tools import eq_, ok_, raises
+from unittest import TestCase
+
+import eventlet
+from eventlet.green import socket
+import mock
+from webob import Request
+from ws4py.framing import Frame, OPCODE_TEXT
+
+from stargate import codec
+from stargate.frames import HYBI
+from stargate.framing import FrameParser
+from stargate.handshake import handshake_hybi_10
+from stargate.fastpath import UpgradeRequest
+from stargate.resource import WebSocketAwareResource
+from stargate.view import HixieWebSocket, WebSocket, WebSocketView
+
+
+class CountingCodec(codec.Codec):
+
+    def __init__(self, name, binary=False):
+        self.name = name
+        self.binary = binary
+        self.encoded = 0
+
+    def encode(self, obj):
+        self.encoded += 1
+        return '%s:%r' % (self.name, obj)
+
+
+class TestNegotiation(TestCase):
+
+    def test_server_preference_wins(self):
+        eq_(codec.negotiate_codec('json, raw', [codec.RAW, codec.JSON]),
+            codec.RAW)
+
+    def test_nothing_in_common(self):
+        eq_(codec.negotiate_codec('chat', [codec.JSON]), None)
+        eq_(codec.negotiate_codec(None, [codec.JSON]), None)
+
+    def test_unavailable_codec_skipped(self):
+        unavailable = CountingCodec('json')
+        unavailable.available = False
+        eq_(codec.negotiate_codec('json', [unavailable]), None)
+
+    def test_handshake(self):
+        request = Request.blank('/', headers={
+            'Upgrade': 'websocket', 'Connection': 'Upgrade',
+            'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+            'Sec-WebSocket-Protocol': 'msgpack, json'})
+        response = handshake_hybi_10(request.headers, codecs=[codec.JSON])
+        ok_('\r\nSec-WebSocket-Protocol: json\r\n' in response)
+        eq_(request.environ['stargate.codec'], codec.JSON)
+
+    def test_handshake_without_offer(self):
+        request = Request.blank('/', headers={
+            'Upgrade': 'websocket', 'Connection': 'Upgrade',
+            'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ=='})
+        response = handshake_hybi_10(request.headers, codecs=[codec.JSON])
+        ok_('Sec-WebSocket-Protocol' not in response)
+        eq_(request.environ['stargate.codec'], None)
+
+
+class TestCodecs(TestCase):
+
+    def test_json(self):
+        encoded = codec.JSON.encode({'a': [1, 2]})
+        eq_(encoded, '{"a":[1,2]}')
+        eq_(codec.JSON.decode(bytearray(encoded)), {'a': [1, 2]})
+
+    def test_raw(self):
+        eq_(codec.RAW.encode(u'\xe9'), '\xc3\xa9')
+        eq_(codec.RAW.decode('x'), 'x')
+        ok_(codec.RAW.binary)
+
+
+class TestWebSocket(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.ws = WebSocket(self.server, {})
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_send_obj(self):
+        self.ws.send_obj({'a': 1})
+        frame, = FrameParser().feed(self.client.recv(100))
+        eq_((frame.opcode, str(frame.payload)), (OPCODE_TEXT, '{"a":1}'))
+
+    def test_receive_obj(self):
+        self.client.sendall(Frame(opcode=OPCODE_TEXT, body='[1,"b"]', fin=1,
+                                  masking_key='abcd').build())
+        eq_(self.ws.receive_obj(), [1, 'b'])
+
+
+class RawView(WebSocketView):
+
+    default_codec = codec.RAW
+
+    def handler(self, websocket):
+        self.websocket = websocket
+        websocket.send_obj({'a': 1})
+        self.received = websocket.receive_obj()
+
+
+class TestDraft76(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_send_and_receive_obj(self):
+        ws = HixieWebSocket(self.server, {})
+        ws.send_obj([1])
+        eq_(self.client.recv(10), '\x00[1]\xff')
+        self.client.sendall('\x00{"b":2}\xff')
+        eq_(ws.receive_obj(), {'b': 2})
+        self.client.close()
+        eq_(ws.receive_obj(), None)
+
+    @raises(ValueError)
+    def test_no_binary_messages(self):
+        HixieWebSocket(self.server, {}).send('\x00', binary=True)
+
+    def test_binary_default_codec_falls_back_to_text(self):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': '/',
+            'wsgi.url_scheme': 'http',
+            'HTTP_HOST': 'localhost',
+            'HTTP_ORIGIN': 'http://localhost',
+            'HTTP_UPGRADE': 'WebSocket',
+            'HTTP_CONNECTION': 'Upgrade',
+            'eventlet.input': mock.Mock(
+                **{'get_socket.return_value': self.server}),
+        }
+        self.client.sendall('\x00[2]\xff')
+        view = RawView(UpgradeRequest(environ))
+        view()
+        eq_(view.websocket.codec, codec.JSON)
+        eq_(self.client.recv(1024).split('\r\n\r\n')[1], '\x00{"a":1}\xff')
+        eq_(view.received, [2])
+
+
+class TestBroadcast(TestCase):
+
+    def setUp(self):
+        self.resource = WebSocketAwareResource()
+        self.codecs = [CountingCodec('a'), CountingCodec('b', binary=True)]
+        self.listeners = []
+        for i in xrange(6):
+            ws = mock.Mock(wire_protocol=HYBI, codec=self.codecs[i % 2])
+            self.listeners.append(ws)
+            self.resource.add_listener(ws)
+
+    def written(self, ws):
+        return [str(frame.payload) for call in ws.write_frame.call_args_list
+                for frame in FrameParser().feed(call[0][0])]
+
+    def test_encoded_once_per_codec(self):
+        self.resource.send_obj(1)
+        eq_([c.encoded for c in self.codecs], [1, 1])
+        for ws in self.listeners:
+            eq_(self.written(ws), ['%s:1' % ws.codec.name])
+
+    def test_tick_batches_objects(self):
+        self.resource.tick = 0.01
+        self.resource.send_obj(1)
+        self.resource.send_obj(2)
+        eventlet.sleep(0.05)
+        eq_([c.encoded for c in self.codecs], [2, 2])
+        ws = self.listeners[1]
+        eq_(ws.write_frame.call_count, 1)
+        eq_(self.written(ws), ['b:1', 'b:2'])
+
+    @raises(TypeError)
+    def test_not_through_a_backplane(self):
+        self.resource.backplane = mock.Mock()
+        self.resource.send_obj(1)
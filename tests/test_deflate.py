@@ -0,0 +1,207 @@
+from nose.tools import eq_, ok_
+from unittest import TestCase
+
+from eventlet.green import socket
+from webob import Request
+from ws4py.framing import Frame, OPCODE_TEXT
+
+from stargate import deflate, frames
+from stargate.handshake import handshake_hybi_10
+from stargate.view import WebSocket
+
+KEY = 'abcd'
+
+
+def accept(params, **config):
+    return deflate.PerMessageDeflate(**config).accept(params)
+
+
+class TestNegotiation(TestCase):
+
+    def test_defaults(self):
+        negotiated = accept([])
+        eq_(negotiated.response_params(),
+            'permessage-deflate; server_no_context_takeover')
+        ok_(negotiated.shareable)
+
+    def test_context_takeover(self):
+        negotiated = accept([], server_no_context_takeover=False)
+        eq_(negotiated.response_params(), 'permessage-deflate')
+        ok_(not negotiated.shareable)
+
+    def test_client_asks_for_no_context_takeover(self):
+        negotiated = accept([('server_no_context_takeover', None)],
+                            server_no_context_takeover=False)
+        ok_(negotiated.shareable)
+
+    def test_server_window_bits(self):
+        negotiated = accept([('server_max_window_bits', '10')])
+        eq_(negotiated.server_max_window_bits, 10)
+        ok_('server_max_window_bits=10' in negotiated.response_params())
+        negotiated = accept([], server_max_window_bits=11)
+        ok_('server_max_window_bits=11' in negotiated.response_params())
+
+    def test_client_window_bits(self):
+        eq_(accept([]).client_max_window_bits, None)
+        eq_(accept([('client_max_window_bits', None)],
+                   client_max_window_bits=12).client_max_window_bits, 12)
+        eq_(accept([('client_max_window_bits', '9')]).client_max_window_bits,
+            9)
+
+    def test_declined(self):
+        for params in ([('server_max_window_bits', '16')],
+                       [('server_max_window_bits', None)],
+                       [('server_max_window_bits', '8')],
+                       [('client_max_window_bits', '010')],
+                       [('server_no_context_takeover', 'yes')],
+                       [('unknown', None)],
+                       [('client_max_window_bits', None)] * 2):
+            eq_(accept(params), None, params)
+
+    def test_negotiate_falls_back_to_later_offers(self):
+        accepted = deflate.negotiate(
+            'permessage-deflate; server_max_window_bits=16, '
+            'permessage-deflate; client_max_window_bits',
+            [deflate.PerMessageDeflate()])
+        eq_(len(accepted), 1)
+        eq_(accepted[0].client_max_window_bits, 15)
+
+    def test_handshake(self):
+        request = Request.blank('/', headers={
+            'Upgrade': 'websocket', 'Connection': 'Upgrade',
+            'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+            'Sec-WebSocket-Extensions': 'permessage-deflate'})
+        response = handshake_hybi_10(request.headers,
+                                     [deflate.PerMessageDeflate()])
+        ok_('\r\nSec-WebSocket-Extensions: permessage-deflate; '
+            'server_no_context_takeover\r\n' in response)
+        ok_(response.endswith('\r\n\r\n'))
+        eq_(len(request.environ['stargate.extensions']), 1)
+
+    def test_handshake_without_offer(self):
+        request = Request.blank('/', headers={
+            'Upgrade': 'websocket', 'Connection': 'Upgrade',
+            'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ=='})
+        response = handshake_hybi_10(request.headers,
+                                     [deflate.PerMessageDeflate()])
+        ok_('Extensions' not in response)
+        eq_(request.environ['stargate.extensions'], [])
+
+
+class TestDeflate(TestCase):
+
+    def test_round_trip(self):
+        sender, receiver = deflate.Deflate(), deflate.Deflate()
+        for message in ('{"a": 1}' * 100, '', 'x'):
+            eq_(receiver.decompress(sender.compress(message)), message)
+
+    def test_context_takeover_shrinks_repeats(self):
+        sender = deflate.Deflate(server_no_context_takeover=False)
+        receiver = deflate.Deflate()
+        message = 'some repetitive json' * 10
+        first, second = sender.compress(message), sender.compress(message)
+        ok_(len(second) < len(first))
+        eq_(receiver.decompress(first), message)
+        eq_(receiver.decompress(second), message)
+
+    def test_equal_parameters_share_frames(self):
+        one, two = deflate.Deflate(), deflate.Deflate()
+        eq_(one.wire_protocol, two.wire_protocol)
+        eq_(hash(one.wire_protocol), hash(two.wire_protocol))
+        ok_(one.wire_protocol !=
+            deflate.Deflate(server_max_window_bits=10).wire_protocol)
+        eq_(deflate.Deflate(server_no_context_takeover=False).wire_protocol,
+            None)
+
+    def test_frame_cache_compresses_once(self):
+        cache = frames.FrameCache('x' * 1000)
+        frame = cache.frame_for(deflate.Deflate().wire_protocol)
+        ok_(cache.frame_for(deflate.DeflateProtocol()) is frame)
+        eq_(frame[0], '\xc1')
+        ok_(len(frame) < 100)
+
+    def test_shared_frame_independent_of_a_stream_in_progress(self):
+        own = deflate.Deflate()
+        start = own.compress('x' * 1000 + 'stream start', final=False)
+        frame = frames.FrameCache('hello world').frame_for(own.wire_protocol)
+        eq_(deflate.Deflate().decompress(frame[2:]), 'hello world')
+        rest = own.compress(' and end')
+        eq_(deflate.Deflate().decompress(start + rest),
+            'x' * 1000 + 'stream start and end')
+
+
+class TestDecompressionLimit(TestCase):
+
+    def setUp(self):
+        self.compressed = deflate.Deflate().compress('x' * 1000)
+
+    def test_within_limit(self):
+        eq_(deflate.Deflate().decompress(self.compressed, max_size=1000),
+            'x' * 1000)
+
+    def test_over_limit(self):
+        self.assertRaises(ValueError, deflate.Deflate().decompress,
+                          self.compressed, max_size=999)
+
+
+class TestCompressedWebSocket(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_receive_compressed(self):
+        ws = WebSocket(self.server, {}, extensions=[deflate.Deflate()])
+        payload = deflate.Deflate().compress('hello ' * 50)
+        self.client.sendall(Frame(opcode=OPCODE_TEXT, body=payload, fin=1,
+                                  rsv1=1, masking_key=KEY).build())
+        eq_(ws.receive(), 'hello ' * 50)
+
+    def test_receive_fragments_compressed(self):
+        ws = WebSocket(self.server, {}, extensions=[deflate.Deflate()])
+        payload = deflate.Deflate().compress('hello ' * 50)
+        self.client.sendall(
+            Frame(opcode=OPCODE_TEXT, body=payload[:10], fin=0, rsv1=1,
+                  masking_key=KEY).build() +
+            Frame(opcode=0, body=payload[10:], fin=1,
+                  masking_key=KEY).build())
+        pieces = list(ws.receive_fragments())
+        eq_(pieces[-1][1], True)
+        eq_(''.join([data for data, last in pieces]), 'hello ' * 50)
+
+    def test_invalid_compressed_data(self):
+        ws = WebSocket(self.server, {}, extensions=[deflate.Deflate()])
+        self.client.sendall(Frame(opcode=OPCODE_TEXT, body='\xff\xff', fin=1,
+                                  rsv1=1, masking_key=KEY).build())
+        self.assertRaises(IOError, ws.receive)
+        close = self.client.recv(100)
+        eq_(close[0], '\x88')
+        eq_(close[2:4], '\x03\xef')
+
+    def test_decompression_bomb(self):
+        ws = WebSocket(self.server, {}, extensions=[deflate.Deflate()])
+        ws.stream.max_message_size = 64 * 1024
+        payload = deflate.Deflate().compress('\x00' * 2 ** 20)
+        ok_(len(payload) < 2048)
+        self.client.sendall(Frame(opcode=OPCODE_TEXT, body=payload, fin=1,
+                                  rsv1=1, masking_key=KEY).build())
+        self.assertRaises(IOError, ws.receive)
+        close = self.client.recv(100)
+        eq_(close[2:4], '\x03\xf1')
+
+    def test_send_compressed(self):
+        ws = WebSocket(self.server, {}, extensions=[deflate.Deflate()])
+        ws.send('hello ' * 50)
+        frame = self.client.recv(1000)
+        eq_(frame[0], '\xc1')
+        eq_(deflate.Deflate().decompress(frame[2:]), 'hello ' * 50)
+
+    def test_wire_protocol(self):
+        shared = WebSocket(self.server, {}, extensions=[deflate.Deflate()])
+        eq_(shared.wire_protocol, deflate.DeflateProtocol())
+        own = WebSocket(self.server, {}, extensions=[
+            deflate.Deflate(server_no_context_takeover=False)])
+        eq_(own.wire_protocol, None)
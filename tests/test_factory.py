@@ -11,4 +11,10 @@ def test_loadserver(server_patch, listen_patch):
     listen_patch.return_value = mock.sentinel.SERVE
     server(mock.sentinel.APP)
     listen_patch.assert_called_with(('0.0.0.0', 6544))
-    server_patch.assert_called_with(mock.sentinel.SERVE, mock.sentinel.APP)
\ No newline at end of file
+    server_patch.assert_called_with(mock.sentinel.SERVE, mock.sentinel.APP)
+
+
+def test_unknown_backend():
+    from nose.tools import assert_raises
+    from stargate.factory import server_factory
+    assert_raises(ValueError, server_factory, {}, '0.0.0.0', '6544', 'nope')
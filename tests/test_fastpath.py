@@ -0,0 +1,109 @@
+from nose.tools import eq_, ok_
+from unittest import TestCase
+
+from eventlet import wsgi
+from eventlet.green import socket
+import mock
+
+from stargate.fastpath import UpgradeMiddleware, UpgradeRequest
+from stargate.view import WebSocketView
+
+
+def upgrade_environ(path, sock=None):
+    return {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'HTTP_HOST': 'localhost',
+        'HTTP_UPGRADE': 'websocket',
+        'HTTP_CONNECTION': 'Upgrade',
+        'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        'HTTP_SEC_WEBSOCKET_VERSION': '13',
+        'eventlet.input': mock.Mock(**{'get_socket.return_value': sock}),
+    }
+
+
+class RecordingView(WebSocketView):
+
+    handled = []
+
+    def handler(self, websocket):
+        self.handled.append((self.request, websocket))
+
+
+class TestRouting(TestCase):
+
+    def setUp(self):
+        self.app = mock.Mock(return_value=['app'])
+        self.middleware = UpgradeMiddleware(self.app)
+        self.view = mock.Mock()
+
+    def test_prefix(self):
+        self.middleware.add_prefix('/feeds/', self.view, context='feeds')
+        view, request = self.middleware.route({'PATH_INFO': '/feeds/a'})
+        ok_(view is self.view)
+        eq_((request.context, request.matchdict), ('feeds', {}))
+        eq_(self.middleware.route({'PATH_INFO': '/other'}), None)
+
+    def test_pattern(self):
+        context = mock.Mock(return_value='job')
+        self.middleware.add_pattern(r'^/jobs/(?P<job>\d+)$', self.view,
+                                    context=context)
+        view, request = self.middleware.route({'PATH_INFO': '/jobs/12'})
+        eq_(request.matchdict, {'job': '12'})
+        eq_(request.context, 'job')
+        context.assert_called_once_with(request)
+        eq_(self.middleware.route({'PATH_INFO': '/jobs/x'}), None)
+
+    def test_first_match_wins(self):
+        other = mock.Mock()
+        self.middleware.add_prefix('/a', self.view)
+        self.middleware.add_prefix('/a/b', other)
+        ok_(self.middleware.route({'PATH_INFO': '/a/b'})[0] is self.view)
+
+    def test_other_requests_passed_on(self):
+        self.middleware.add_prefix('/', self.view)
+        start_response = mock.Mock()
+        eq_(self.middleware({'PATH_INFO': '/'}, start_response), ['app'])
+        environ = upgrade_environ('/')
+        del environ['HTTP_UPGRADE']
+        self.middleware(environ, start_response)
+        eq_(self.view.call_count, 0)
+
+    def test_unregistered_upgrade_passed_on(self):
+        self.middleware.add_prefix('/feeds/', self.view)
+        eq_(self.middleware(upgrade_environ('/x'), mock.Mock()), ['app'])
+
+
+class TestUpgrade(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.app = mock.Mock()
+        self.middleware = UpgradeMiddleware(self.app)
+        self.middleware.add_prefix('/ws', RecordingView, context='resource')
+        RecordingView.handled = []
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_handshake_without_pyramid(self):
+        start_response = mock.Mock()
+        result = self.middleware(upgrade_environ('/ws', self.server),
+                                 start_response)
+        eq_(result, wsgi.ALREADY_HANDLED)
+        eq_(self.app.call_count, 0)
+        ok_(self.client.recv(1024).startswith(
+            'HTTP/1.1 101 Switching Protocols\r\n'))
+        (request, websocket), = RecordingView.handled
+        ok_(isinstance(request, UpgradeRequest))
+        eq_(request.context, 'resource')
+
+    def test_failed_handshake(self):
+        environ = upgrade_environ('/ws', self.server)
+        del environ['HTTP_SEC_WEBSOCKET_KEY']
+        environ['HTTP_UPGRADE'] = 'WebSocket'
+        environ['HTTP_CONNECTION'] = 'keep-alive'
+        start_response = mock.Mock()
+        self.middleware(environ, start_response)
+        ok_(start_response.call_args[0][0].startswith('400'))
@@ -0,0 +1,69 @@
+from nose.tools import eq_, ok_
+from stargate import frames
+from unittest import TestCase
+import mock
+
+
+class TestEncoders(TestCase):
+
+    def test_encode_hybi_text(self):
+        eq_(frames.encode_hybi('hello'), '\x81\x05hello')
+
+    def test_encode_hybi_binary(self):
+        eq_(frames.encode_hybi('\x00\x01', binary=True), '\x82\x02\x00\x01')
+
+    def test_encode_hybi_unicode(self):
+        eq_(frames.encode_hybi(u'\xe9'), '\x81\x02\xc3\xa9')
+
+    def test_encode_hybi_extended_length(self):
+        frame = frames.encode_hybi('x' * 200)
+        eq_(frame[:4], '\x81\x7e\x00\xc8')
+        eq_(len(frame), 204)
+
+    def test_encode_hixie76(self):
+        eq_(frames.encode_hixie76('hello'), '\x00hello\xff')
+        eq_(frames.encode_hixie76(u'\xe9'), '\x00\xc3\xa9\xff')
+
+
+class TestFrameCache(TestCase):
+
+    def test_frame_built_once_per_protocol(self):
+        cache = frames.FrameCache('hello')
+        with mock.patch.dict(frames.ENCODERS,
+                             {frames.HYBI: mock.Mock(return_value='H'),
+                              frames.HIXIE76: mock.Mock(return_value='X')}):
+            for i in xrange(3):
+                eq_(cache.frame_for(frames.HYBI), 'H')
+                eq_(cache.frame_for(frames.HIXIE76), 'X')
+            eq_(frames.ENCODERS[frames.HYBI].call_count, 1)
+            eq_(frames.ENCODERS[frames.HIXIE76].call_count, 1)
+
+    def test_write_message_uses_frame(self):
+        ws = mock.Mock()
+        ws.wire_protocol = frames.HYBI
+        frames.write_message(ws, frames.FrameCache('hello'))
+        ws.write_frame.assert_called_with('\x81\x05hello')
+        ok_(not ws.send.called)
+
+    def test_write_message_falls_back_to_send(self):
+        ws = mock.Mock(spec=['send'])
+        frames.write_message(ws, frames.FrameCache('hello'))
+        ws.send.assert_called_with('hello')
+
+
+class TestFrameBatch(TestCase):
+
+    def test_frames_joined_once(self):
+        batch = frames.FrameBatch([frames.FrameCache('a'),
+                                   frames.FrameCache('bc')])
+        eq_(len(batch), 2)
+        eq_(batch.frame_for(frames.HYBI), '\x81\x01a\x81\x02bc')
+        eq_(batch.frame_for(frames.HIXIE76), '\x00a\xff\x00bc\xff')
+        ok_(batch.frame_for(frames.HYBI) is batch.frame_for(frames.HYBI))
+
+    def test_unframed_fallback(self):
+        ws = mock.Mock(spec=['send'])
+        batch = frames.FrameBatch([frames.FrameCache('a'),
+                                   frames.FrameCache('b')])
+        frames.write_message(ws, batch)
+        eq_(ws.send.call_args_list, [mock.call('a'), mock.call('b')])
@@ -0,0 +1,225 @@
+from nose.tools import eq_, ok_
+from unittest import TestCase
+import os
+import struct
+
+from ws4py.framing import Frame as WS4PYFrame, OPCODE_TEXT, OPCODE_BINARY, \
+     OPCODE_CONTINUATION, OPCODE_CLOSE, OPCODE_PING
+
+from stargate import framing
+
+KEY = '\x01\x02\x03\x04'
+
+
+def client_frame(payload, opcode=OPCODE_TEXT, fin=1, key=KEY, rsv1=0):
+    """Builds a frame the way a browser would, masked"""
+    return WS4PYFrame(opcode=opcode, body=payload, fin=fin, masking_key=key,
+                      rsv1=rsv1).build()
+
+
+class TestMask(TestCase):
+
+    def reference(self, key, data):
+        return WS4PYFrame(masking_key=key).mask(data)
+
+    def test_matches_ws4py(self):
+        key = os.urandom(4)
+        for size in (0, 1, 3, 4, 5, 7, 19, 20, 127, 1024, 5001, 65537):
+            data = os.urandom(size)
+            out = bytearray(size + 3)
+            framing._mask_python(key, data, out, 3)
+            eq_(str(out[3:]), self.reference(key, data))
+            if framing.numpy is not None:
+                out = bytearray(size + 3)
+                framing._mask_numpy(key, data, out, 3)
+                eq_(str(out[3:]), self.reference(key, data))
+
+    def test_round_trip(self):
+        data = os.urandom(10000)
+        eq_(framing.mask(KEY, str(framing.mask(KEY, data))), data)
+
+
+class TestFrameParser(TestCase):
+
+    def test_single_frame(self):
+        parser = framing.FrameParser()
+        frames = parser.feed(client_frame('hello'))
+        eq_(len(frames), 1)
+        eq_(frames[0].payload, 'hello')
+        eq_(frames[0].opcode, OPCODE_TEXT)
+        ok_(frames[0].fin)
+        ok_(frames[0].masked)
+        eq_(parser.needed, 2)
+
+    def test_several_frames_in_one_chunk(self):
+        parser = framing.FrameParser()
+        data = client_frame('one') + client_frame('two') + client_frame('th')
+        eq_([f.payload for f in parser.feed(data)], ['one', 'two', 'th'])
+
+    def test_byte_at_a_time(self):
+        parser = framing.FrameParser()
+        data = client_frame('x' * 300) + client_frame('y')
+        frames = []
+        for byte in data:
+            frames.extend(parser.feed(byte))
+        eq_([f.payload for f in frames], ['x' * 300, 'y'])
+
+    def test_needed(self):
+        parser = framing.FrameParser()
+        data = client_frame('x' * 70000)
+        eq_(parser.feed(data[:2]), [])
+        # 64 bit length and the mask
+        eq_(parser.needed, 12)
+        eq_(parser.feed(data[2:14]), [])
+        eq_(parser.needed, 70000)
+        eq_(len(parser.feed(data[14:])), 1)
+
+    def test_chunks_joined_once_complete(self):
+        parser = framing.FrameParser()
+        data = client_frame('x' * 70000)
+        for start in xrange(0, 60000, 1000):
+            eq_(parser.feed(data[start:start + 1000]), [])
+        frames = parser.feed(data[60000:] + client_frame('y')[:3])
+        eq_(frames[0].payload, 'x' * 70000)
+        eq_(parser.feed(client_frame('y')[3:])[0].payload, 'y')
+
+    def test_reused_buffer(self):
+        # fed a buffer over memory that is overwritten by the next read,
+        # as by WebSocket.read_from_connection
+        data = client_frame('x' * 300) + client_frame('y' * 20) + \
+            WS4PYFrame(opcode=OPCODE_TEXT, body='plain', fin=1).build()
+        for size in (1, 5, 37, 64):
+            parser = framing.FrameParser()
+            memory = bytearray(size)
+            frames = []
+            for start in xrange(0, len(data), size):
+                chunk = data[start:start + size]
+                memory[:len(chunk)] = chunk
+                frames.extend(parser.feed(buffer(memory, 0, len(chunk))))
+                memory[:] = '\xff' * size
+            eq_([str(f.payload) for f in frames],
+                ['x' * 300, 'y' * 20, 'plain'])
+
+
+class TestPartialFrames(TestCase):
+
+    def test_pieces(self):
+        parser = framing.FrameParser()
+        parser.partial = True
+        data = client_frame('abcdefghij', opcode=OPCODE_BINARY)
+        first = parser.feed(data[:9])
+        eq_([(str(f.payload), f.more) for f in first], [('abc', True)])
+        rest = parser.feed(data[9:])
+        eq_([(str(f.payload), f.more) for f in rest], [('defghij', False)])
+
+    def test_control_frames_not_split(self):
+        parser = framing.FrameParser()
+        parser.partial = True
+        data = client_frame('ping', opcode=OPCODE_PING)
+        eq_(parser.feed(data[:7]), [])
+        eq_(parser.feed(data[7:])[0].payload, 'ping')
+
+
+class TestLimits(TestCase):
+
+    def header(self, length, opcode=OPCODE_BINARY):
+        """A masked frame's header declaring a 64 bit ``length``"""
+        return chr(0x80 | opcode) + '\xff' + struct.pack('!Q', length) + KEY
+
+    def raises(self, parser, data, code):
+        try:
+            parser.feed(data)
+        except framing.FrameError, e:
+            eq_(e.code, code)
+        else:
+            self.fail('%r was accepted' % data)
+
+    def test_refused_before_allocating(self):
+        self.raises(framing.FrameParser(max_size=1024),
+                    self.header(2 ** 33), 1009)
+
+    def test_fragments_summed(self):
+        parser = framing.FrameParser(max_size=10)
+        parser.feed(client_frame('x' * 6, opcode=OPCODE_BINARY, fin=0))
+        parser.feed(client_frame('p', opcode=OPCODE_PING))
+        self.raises(parser, client_frame('x' * 6, opcode=OPCODE_CONTINUATION),
+                    1009)
+
+    def test_next_message_counted_afresh(self):
+        parser = framing.FrameParser(max_size=10)
+        parser.feed(client_frame('x' * 6, opcode=OPCODE_BINARY))
+        eq_(len(parser.feed(client_frame('x' * 6, opcode=OPCODE_BINARY))), 1)
+
+    def test_long_control_frame(self):
+        self.raises(framing.FrameParser(), self.header(126, OPCODE_PING),
+                    1002)
+
+    def test_stream_error(self):
+        stream = framing.Stream()
+        stream.max_message_size = 4
+        stream.parser.send(client_frame('hello') + client_frame('x'))
+        eq_(stream.errors[0].code, 1009)
+        ok_(not stream.messages)
+
+
+class TestStream(TestCase):
+
+    def feed(self, data):
+        stream = framing.Stream()
+        stream.parser.send(data)
+        return stream
+
+    def test_text_message(self):
+        stream = self.feed(client_frame('hello'))
+        ok_(stream.has_message)
+        eq_(str(stream.message), 'hello')
+
+    def test_binary_message(self):
+        stream = self.feed(client_frame('\x00\xff', opcode=OPCODE_BINARY))
+        ok_(stream.message.is_binary)
+        eq_(stream.message.data, '\x00\xff')
+
+    def test_messages_queued(self):
+        stream = self.feed(client_frame('one') + client_frame('two'))
+        eq_([str(m) for m in stream.messages], ['one', 'two'])
+        eq_(str(stream.message), 'two')
+
+    def test_fragmented_message(self):
+        stream = framing.Stream()
+        stream.parser.send(client_frame('hel', fin=0))
+        ok_(not stream.has_message)
+        stream.parser.send(client_frame('lo', opcode=OPCODE_CONTINUATION))
+        eq_(str(stream.message), 'hello')
+
+    def test_ping(self):
+        stream = self.feed(client_frame('p', opcode=OPCODE_PING))
+        eq_(stream.pings[0].data, 'p')
+
+    def test_close(self):
+        stream = self.feed(client_frame(struct.pack('!H', 1001) + 'bye',
+                                        opcode=OPCODE_CLOSE))
+        eq_(stream.closing.code, 1001)
+        eq_(stream.closing.reason, 'bye')
+
+    def test_invalid_close_code(self):
+        stream = self.feed(client_frame(struct.pack('!H', 1004),
+                                        opcode=OPCODE_CLOSE))
+        eq_(stream.closing.code, 1002)
+
+    def test_unmasked_frame_is_an_error(self):
+        stream = self.feed(WS4PYFrame(opcode=OPCODE_TEXT, body='x',
+                                      fin=1).build())
+        eq_(stream.errors[0].code, 1002)
+
+    def test_reserved_bits_are_an_error(self):
+        stream = self.feed(client_frame('x', rsv1=1))
+        eq_(stream.errors[0].code, 1002)
+
+    def test_invalid_utf8_is_an_error(self):
+        stream = self.feed(client_frame('\xff\xfe'))
+        eq_(stream.errors[0].code, 1007)
+        ok_(not stream.has_message)
+
+    def test_new_message_mid_fragments_is_an_error(self):
+        stream = self.feed(client_frame('a', fin=0) + client_frame('b'))
+        eq_(stream.errors[0].code, 1002)
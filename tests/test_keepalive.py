@@ -0,0 +1,158 @@
+from nose.tools import eq_, ok_
+from unittest import TestCase
+import time
+
+import eventlet
+from eventlet.green import socket
+import mock
+from ws4py.framing import Frame, OPCODE_PONG
+
+from stargate.keepalive import Keepalive, TimerWheel, shared_wheel
+from stargate.view import HixieWebSocket, WebSocket
+
+
+class TestTimerWheel(TestCase):
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=1.0, size=8)
+        self.fired = []
+        # keep the wheel's own greenthread from advancing it
+        self.wheel._gt = mock.Mock()
+
+    def test_fires_after_delay(self):
+        self.wheel.schedule('a', 2, self.fired.append)
+        eq_(self.wheel.advance(), 0)
+        eq_(self.wheel.advance(), 1)
+        eq_(self.fired, ['a'])
+        eq_(len(self.wheel), 0)
+
+    def test_delay_rounded_up_to_a_tick(self):
+        self.wheel.schedule('a', 0.1, self.fired.append)
+        self.wheel.advance()
+        eq_(self.fired, ['a'])
+
+    def test_delay_longer_than_the_wheel(self):
+        self.wheel.schedule('a', 11, self.fired.append)
+        for i in xrange(10):
+            self.wheel.advance()
+        eq_(self.fired, [])
+        self.wheel.advance()
+        eq_(self.fired, ['a'])
+
+    def test_reschedule_replaces(self):
+        self.wheel.schedule('a', 1, self.fired.append)
+        self.wheel.schedule('a', 3, self.fired.append)
+        eq_(len(self.wheel), 1)
+        self.wheel.advance()
+        self.wheel.advance()
+        eq_(self.fired, [])
+        self.wheel.advance()
+        eq_(self.fired, ['a'])
+
+    def test_cancel(self):
+        self.wheel.schedule('a', 1, self.fired.append)
+        self.wheel.cancel('a')
+        self.wheel.cancel('a')
+        ok_('a' not in self.wheel)
+        self.wheel.advance()
+        eq_(self.fired, [])
+
+    def test_callback_can_reschedule(self):
+        def again(key):
+            self.fired.append(key)
+            self.wheel.schedule(key, 1, again)
+        self.wheel.schedule('a', 1, again)
+        self.wheel.advance()
+        self.wheel.advance()
+        eq_(self.fired, ['a', 'a'])
+
+    def test_failing_callback_does_not_stop_others(self):
+        self.wheel.schedule('a', 1, mock.Mock(side_effect=ValueError))
+        self.wheel.schedule('b', 1, self.fired.append)
+        self.wheel.advance()
+        eq_(self.fired, ['b'])
+
+    def test_runs_by_itself(self):
+        wheel = TimerWheel(tick=0.01)
+        try:
+            wheel.schedule('a', 0.02, self.fired.append)
+            eventlet.sleep(0.1)
+            eq_(self.fired, ['a'])
+        finally:
+            wheel.stop()
+
+
+class TestKeepalive(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.ws = WebSocket(self.server, {})
+        wheel = TimerWheel()
+        wheel._gt = mock.Mock()
+        self.keepalive = Keepalive(ping_interval=10, pong_timeout=5,
+                                   idle_timeout=60, wheel=wheel)
+        self.now = time.time()
+        self.ws.last_received = self.ws.last_active = self.now
+        self.keepalive.add(self.ws)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def check(self, later):
+        with mock.patch('time.time', return_value=self.now + later):
+            self.keepalive._check(self.ws)
+        eventlet.sleep(0)
+
+    def test_pings_quiet_websocket(self):
+        self.check(10)
+        eq_(self.client.recv(10), '\x89\x00')
+
+    def test_no_ping_while_hearing_from_peer(self):
+        self.ws.last_received = self.now + 5
+        self.check(10)
+        self.client.setblocking(False)
+        self.assertRaises(socket.error, self.client.recv, 10)
+
+    def test_pong_keeps_connection(self):
+        self.check(10)
+        self.client.sendall(Frame(opcode=OPCODE_PONG, body='', fin=1,
+                                  masking_key='abcd').build())
+        self.ws._read()
+        self.ws.last_received = self.now + 11
+        self.check(15)
+        ok_(not self.ws.server_terminated)
+
+    def test_no_pong_closes(self):
+        self.check(10)
+        self.check(15)
+        ok_(self.ws.server_terminated)
+        eq_(len(self.keepalive), 0)
+
+    def test_idle_closes(self):
+        self.ws.last_received = self.now + 55
+        self.check(60)
+        ok_(self.ws.server_terminated)
+        eq_(self.client.recv(10)[:4], '\x88\x06\x03\xe9')
+
+    def test_close_callbacks_stop_tracking(self):
+        eq_(len(self.keepalive), 1)
+        self.ws.fire_close_callbacks()
+        eq_(len(self.keepalive), 0)
+
+    def test_wheel_shared(self):
+        first, second = Keepalive(tick=0.5), Keepalive(tick=0.5)
+        ok_(first.wheel is second.wheel is shared_wheel(0.5))
+        ok_(Keepalive().wheel is not first.wheel)
+
+    def test_busy_draft76_websocket_not_idle(self):
+        ws = HixieWebSocket(self.server, {})
+        self.keepalive.add(ws)
+        with mock.patch('time.time', return_value=self.now + 55):
+            ws.send('hi')
+        with mock.patch('time.time', return_value=self.now + 65):
+            self.keepalive._check(ws)
+        eventlet.sleep(0)
+        ok_(not ws.websocket_closed)
+        eq_(self.client.recv(10), '\x00hi\xff')
+        eq_(len(self.keepalive), 2)
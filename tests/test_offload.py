@@ -0,0 +1,103 @@
+from nose.tools import eq_, ok_, raises
+from unittest import TestCase
+import thread
+import time
+import zlib
+
+import eventlet
+from eventlet.green import socket
+import mock
+
+from stargate.deflate import Deflate, TAIL
+from stargate.frames import HYBI, FrameCache
+from stargate.framing import FrameParser
+from stargate.offload import INLINE, Offloader, ThreadOffloader
+from stargate.resource import WebSocketAwareResource
+from stargate.view import WebSocket
+
+
+class TestThreadOffloader(TestCase):
+
+    def setUp(self):
+        self.offloader = ThreadOffloader()
+
+    def test_runs_in_another_thread(self):
+        ok_(self.offloader.run(thread.get_ident) != thread.get_ident())
+
+    def test_returns_result(self):
+        eq_(self.offloader.run(lambda a, b=0: a + b, 1, b=2), 3)
+
+    @raises(ValueError)
+    def test_raises(self):
+        self.offloader.run(int, 'x')
+
+    def test_hub_keeps_running(self):
+        ticks = []
+        def ticker():
+            while True:
+                ticks.append(1)
+                eventlet.sleep(0.01)
+        gt = eventlet.spawn(ticker)
+        try:
+            eventlet.sleep(0)
+            self.offloader.run(time.sleep, 0.2)
+        finally:
+            gt.kill()
+        ok_(len(ticks) > 5)
+
+    def test_worth_it(self):
+        ok_(not Offloader(min_size=10).worth_it(9))
+        ok_(Offloader(min_size=10).worth_it(10))
+        ok_(not INLINE.worth_it(10 ** 9))
+
+
+class TestResourceOffload(TestCase):
+
+    def setUp(self):
+        self.resource = WebSocketAwareResource()
+        self.offloader = Offloader(min_size=100)
+        self.offloader.run = mock.Mock(wraps=self.offloader.run)
+        self.resource.offloader = self.offloader
+        self.ws = mock.Mock(wire_protocol=HYBI, codec=None)
+        self.resource.add_listener(self.ws)
+
+    def test_large_message_framed_by_offloader(self):
+        frames = FrameCache('x' * 100)
+        self.resource.deliver(frames)
+        self.offloader.run.assert_called_once_with(frames.prepare,
+                                                   set([(None, HYBI)]))
+        self.ws.write_frame.assert_called_once_with(frames.frame_for(HYBI))
+
+    def test_small_message_framed_inline(self):
+        self.resource.send('x' * 99)
+        eq_(self.offloader.run.call_count, 0)
+        eq_(self.ws.write_frame.call_count, 1)
+
+    def test_offload(self):
+        eq_(self.resource.offload(len, 'abc'), 3)
+        self.offloader.run.assert_called_once_with(len, 'abc')
+
+
+class TestWebSocketOffload(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.ws = WebSocket(self.server, {}, extensions=[
+            Deflate(server_no_context_takeover=False)])
+        self.ws.offloader = ThreadOffloader(min_size=1000)
+        self.ws.offloader.run = mock.Mock(wraps=self.ws.offloader.run)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_large_message_compressed_by_offloader(self):
+        payload = 'abc' * 1000
+        self.ws.send(payload)
+        eq_(self.ws.offloader.run.call_count, 1)
+        self.ws.send('small')
+        eq_(self.ws.offloader.run.call_count, 1)
+        frames = FrameParser().feed(self.client.recv(65536))
+        decompressor = zlib.decompressobj(-15)
+        eq_([decompressor.decompress(str(frame.payload) + TAIL)
+             for frame in frames], [payload, 'small'])
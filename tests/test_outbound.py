@@ -0,0 +1,215 @@
+import eventlet
+from eventlet.event import Event
+from nose.tools import eq_, ok_, assert_raises
+from stargate import WebSocketAwareResource
+from stargate import outbound
+from stargate.delivery import CONFLATED, DELIVERED, DISCARDED
+from stargate.frames import FrameCache
+from stargate.view import WebSocket
+from unittest import TestCase
+import mock
+
+ENVIRON = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+
+class SlowSocket(object):
+    """A socket whose writes block until ``release`` is called"""
+
+    def __init__(self):
+        self.written = []
+        self.gate = Event()
+
+    def settimeout(self, timeout):
+        pass
+
+    def release(self):
+        self.gate.send()
+
+    def sendall(self, data):
+        self.gate.wait()
+        self.written.append(data)
+
+    shutdown = close = mock.Mock()
+
+
+def payloads(sock):
+    return [frame[2:] for frame in sock.written]
+
+
+class TestOutboundQueue(TestCase):
+
+    def setUp(self):
+        self.sock = SlowSocket()
+        self.ws = WebSocket(self.sock, ENVIRON)
+
+    def fill(self, queue, count):
+        for i in range(count):
+            queue.put(FrameCache('m%d' % i))
+        # let the writer pick up the first message and block on it
+        eventlet.sleep(0)
+
+    def test_unknown_policy(self):
+        assert_raises(ValueError, outbound.OutboundQueue, self.ws, 1, 'nope')
+
+    def test_drains_in_order(self):
+        queue = outbound.OutboundQueue(self.ws, 10)
+        self.fill(queue, 3)
+        self.sock.release()
+        eventlet.sleep(0.01)
+        eq_(payloads(self.sock), ['m0', 'm1', 'm2'])
+        eq_(len(queue), 0)
+
+    def test_drop_oldest(self):
+        queue = outbound.OutboundQueue(self.ws, 2, outbound.DROP_OLDEST)
+        self.fill(queue, 1)
+        for i in range(1, 5):
+            queue.put(FrameCache('m%d' % i))
+        eq_(len(queue), 2)
+        eq_(queue.dropped, 2)
+        self.sock.release()
+        eventlet.sleep(0.01)
+        eq_(payloads(self.sock), ['m0', 'm3', 'm4'])
+
+    def test_drop_newest(self):
+        queue = outbound.OutboundQueue(self.ws, 2, outbound.DROP_NEWEST)
+        self.fill(queue, 1)
+        outcomes = [queue.put(FrameCache('m%d' % i)) for i in range(1, 5)]
+        eq_(outcomes, [DELIVERED, DELIVERED, DISCARDED, DISCARDED])
+        eq_(queue.dropped, 2)
+        self.sock.release()
+        eventlet.sleep(0.01)
+        eq_(payloads(self.sock), ['m0', 'm1', 'm2'])
+
+    def test_disconnect(self):
+        closed = []
+        queue = outbound.OutboundQueue(self.ws, 1, outbound.DISCONNECT,
+                                       on_close=closed.append)
+        self.fill(queue, 2)
+        eq_(queue.put(FrameCache('overflow')), DISCARDED)
+        self.sock.release()
+        eventlet.sleep(0.01)
+        ok_(queue.closed)
+        eq_(closed, [self.ws])
+        # The close frame carries the policy violation code
+        eq_(self.sock.written[-1][:4], '\x88\x11\x03\xf0')
+
+    def test_write_error_closes_queue(self):
+        sock = mock.Mock()
+        sock.sendall.side_effect = IOError
+        ws = WebSocket(sock, ENVIRON)
+        closed = []
+        queue = outbound.OutboundQueue(ws, 1, on_close=closed.append)
+        queue.put(FrameCache('hello'))
+        eventlet.sleep(0)
+        ok_(queue.closed)
+        eq_(closed, [ws])
+
+
+class TestQueuedResource(TestCase):
+
+    def setUp(self):
+        self.ctx = WebSocketAwareResource()
+        self.ctx.queue_size = 2
+
+    def test_send_does_not_block_on_slow_listener(self):
+        slow = SlowSocket()
+        fast = mock.Mock()
+        slow_ws = WebSocket(slow, ENVIRON)
+        fast_ws = WebSocket(fast, ENVIRON)
+        self.ctx.add_listener(slow_ws)
+        self.ctx.add_listener(fast_ws)
+        with eventlet.Timeout(0.5):
+            for i in range(10):
+                self.ctx.send('m%d' % i)
+                eventlet.sleep(0)
+        eq_(fast.sendall.call_count, 10)
+        ok_(len(self.ctx.queues[slow_ws]) <= 2)
+
+    def test_remove_listener_stops_queue(self):
+        ws = WebSocket(mock.Mock(), ENVIRON)
+        self.ctx.add_listener(ws)
+        queue = self.ctx.queues[ws]
+        self.ctx.remove_listener(ws)
+        ok_(queue.closed)
+        eq_(self.ctx.queues, {})
+
+    def test_disconnected_listener_removed(self):
+        self.ctx.overflow_policy = outbound.DISCONNECT
+        slow = SlowSocket()
+        ws = WebSocket(slow, ENVIRON)
+        self.ctx.add_listener(ws)
+        for i in range(4):
+            self.ctx.send('m%d' % i)
+            eventlet.sleep(0)
+        slow.release()
+        eventlet.sleep(0.01)
+        eq_(self.ctx.listeners, set())
+
+
+class TestConflatingQueue(TestCase):
+
+    def setUp(self):
+        self.sock = SlowSocket()
+        self.ws = WebSocket(self.sock, ENVIRON)
+
+    def test_latest_value_per_key(self):
+        queue = outbound.ConflatingQueue(self.ws)
+        queue.put(FrameCache('first', key='a'))
+        eventlet.sleep(0)
+        # 'first' is being written, the rest wait behind it
+        outcomes = [queue.put(FrameCache('%s%d' % (key, i), key=key))
+                    for i in range(5) for key in 'ab']
+        eq_(outcomes, [DELIVERED] * 2 + [CONFLATED] * 8)
+        eq_(queue.put(FrameCache('plain')), DELIVERED)
+        queue.put(FrameCache('plain'))
+        eq_(len(queue), 4)
+        eq_(queue.conflated, 8)
+        self.sock.release()
+        eventlet.sleep(0.01)
+        eq_(payloads(self.sock), ['first', 'a4', 'b4', 'plain', 'plain'])
+
+    def test_interval_debounces(self):
+        sock = mock.Mock()
+        queue = outbound.ConflatingQueue(WebSocket(sock, ENVIRON),
+                                         interval=0.05)
+        for i in range(20):
+            queue.put(FrameCache('v%d' % i, key='k'))
+            eventlet.sleep(0.005)
+        eventlet.sleep(0.06)
+        sent = [c[0][0][2:] for c in sock.sendall.call_args_list]
+        ok_(len(sent) < 5)
+        eq_(sent[0], 'v0')
+        eq_(sent[-1], 'v19')
+        queue.stop()
+
+
+class TestConflatingResource(TestCase):
+
+    def test_send_with_key(self):
+        ctx = WebSocketAwareResource()
+        ctx.conflate = True
+        slow = SlowSocket()
+        ws = WebSocket(slow, ENVIRON)
+        ctx.add_listener(ws)
+        ok_(isinstance(ctx.queues[ws], outbound.ConflatingQueue))
+        for i in range(10):
+            ctx.send('state %d' % i, key='state')
+            eventlet.sleep(0)
+        slow.release()
+        eventlet.sleep(0.01)
+        eq_(payloads(slow), ['state 0', 'state 9'])
+
+    def test_publish_counts_conflated(self):
+        ctx = WebSocketAwareResource()
+        ctx.conflate = True
+        slow = SlowSocket()
+        ctx.add_listener(WebSocket(slow, ENVIRON))
+        ctx.publish('state 0', key='state').wait()
+        eventlet.sleep(0)
+        outcomes = [ctx.publish('state %d' % i, key='state').wait()
+                    for i in range(1, 4)]
+        eq_([(s.delivered, s.conflated) for s in outcomes],
+            [(1, 0), (0, 1), (0, 1)])
+        eq_(outcomes[-1].listeners, 1)
+        eq_(outcomes[-1].dropped, [])
+        slow.release()
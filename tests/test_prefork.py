@@ -0,0 +1,207 @@
+from nose.tools import eq_, ok_
+from unittest import TestCase
+import os
+import signal
+import socket
+import time
+
+import mock
+
+from stargate import prefork
+from stargate.backend import EVENTLET
+from stargate.fastpath import UpgradeMiddleware
+from stargate.prefork import Prefork, server_factory
+from stargate.view import WebSocketView
+
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+
+def get(port):
+    for _ in xrange(50):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+            break
+        except socket.error:
+            time.sleep(0.1)
+    sock.sendall('GET / HTTP/1.0\r\n\r\n')
+    response = ''
+    while True:
+        data = sock.recv(1024)
+        if not data:
+            break
+        response += data
+    sock.close()
+    return int(response.rsplit('\r\n', 1)[-1])
+
+
+class EchoView(WebSocketView):
+
+    def handler(self, websocket):
+        try:
+            while True:
+                websocket.send(websocket.receive())
+        except IOError:
+            pass
+
+
+echo_app = UpgradeMiddleware(pid_app)
+echo_app.add_prefix('/', EchoView)
+
+
+class TestServerFactory(TestCase):
+
+    @mock.patch.object(Prefork, 'run', autospec=True)
+    def test_options(self, run):
+        server_factory({}, '0.0.0.0', '6544', workers='3', pool_size='100',
+                       backlog='64', reuse_port='false')(pid_app)
+        server, = run.call_args[0]
+        eq_((server.port, server.workers, server.pool_size, server.backlog),
+            (6544, 3, 100, 64))
+        eq_((server.reuse_port, server.backend), (False, EVENTLET))
+
+    @mock.patch.object(Prefork, 'run', autospec=True)
+    def test_defaults(self, run):
+        server_factory({}, '0.0.0.0', '6544')(pid_app)
+        server, = run.call_args[0]
+        ok_(server.workers >= 1)
+        eq_((server.pool_size, server.reuse_port, server.post_fork),
+            (None, prefork.HAS_REUSEPORT, None))
+
+    @mock.patch.object(Prefork, 'run', autospec=True)
+    def test_post_fork(self, run):
+        server_factory({}, '0.0.0.0', '6544',
+                       post_fork='os.path:basename')(pid_app)
+        server, = run.call_args[0]
+        eq_(server.post_fork, os.path.basename)
+
+
+class TestSupervision(TestCase):
+
+    def setUp(self):
+        self.server = Prefork(pid_app, '127.0.0.1', 0, workers=1)
+        self.server.spawn_worker = mock.Mock()
+
+    def test_dead_worker_restarted(self):
+        self.server.children[10] = time.time() - 60
+        self.server.reap(10, 256)
+        eq_(self.server.children, {})
+        self.server.restart_due()
+        self.server.spawn_worker.assert_called_once_with()
+        eq_(self.server.restarts, [])
+
+    @mock.patch('time.time')
+    def test_crash_loop_throttled(self, now):
+        now.return_value = 100.0
+        self.server.children[10] = 100.0
+        self.server.reap(10, signal.SIGSEGV)
+        eq_(self.server.restarts, [100.0 + self.server.min_uptime])
+        self.server.restart_due()
+        eq_(self.server.spawn_worker.call_count, 0)
+        now.return_value += self.server.min_uptime
+        self.server.restart_due()
+        eq_(self.server.spawn_worker.call_count, 1)
+
+    @mock.patch('os.kill')
+    @mock.patch('signal.alarm')
+    def test_stop(self, alarm, kill):
+        self.server.children[10] = time.time()
+        self.server.stop()
+        kill.assert_called_once_with(10, signal.SIGTERM)
+        alarm.assert_called_once_with(self.server.graceful_timeout)
+        self.server.reap(10, 0)
+        self.server.restart_due()
+        eq_(self.server.spawn_worker.call_count, 0)
+
+    def test_post_fork(self):
+        self.server.post_fork = mock.Mock()
+        self.server.backend = mock.Mock()
+        self.server.socket = mock.sentinel.socket
+        with mock.patch('signal.signal'):
+            self.server.serve_worker()
+        self.server.post_fork.assert_called_once_with(pid_app)
+        self.server.backend.serve_socket.assert_called_once_with(
+            pid_app, mock.sentinel.socket, None)
+
+    @mock.patch.object(prefork.log, 'exception')
+    def test_going_away_survives_any_error(self, exception):
+        websocket = mock.Mock()
+        websocket.close.side_effect = RuntimeError('Event loop is closed')
+        prefork._going_away(websocket)
+        eq_(exception.call_count, 1)
+
+
+class TestWorkers(TestCase):
+
+    def serve(self, reuse_port, app=pid_app, workers=2):
+        server = Prefork(app, '127.0.0.1', 0, workers=workers,
+                         reuse_port=reuse_port)
+        server.min_uptime = 0
+        if reuse_port:
+            # holds a port for the workers to bind, without accepting on it
+            held = socket.socket()
+            held.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            held.bind(('127.0.0.1', 0))
+            self.addCleanup(held.close)
+        else:
+            held = server.socket = server.listen()
+        server.port = held.getsockname()[1]
+        pid = os.fork()
+        if not pid:
+            try:
+                server.run()
+            finally:
+                os._exit(0)
+        if server.socket is not None:
+            server.socket.close()
+        return pid, server.port
+
+    def stop(self, pid):
+        os.kill(pid, signal.SIGTERM)
+        eq_(os.waitpid(pid, 0)[1], 0)
+
+    def test_inherited_listener_restarts_workers(self):
+        supervisor, port = self.serve(reuse_port=False)
+        try:
+            worker = get(port)
+            os.kill(worker, signal.SIGKILL)
+            time.sleep(0.2)
+            ok_(get(port) != worker)
+        finally:
+            self.stop(supervisor)
+
+    if prefork.HAS_REUSEPORT:
+        def test_reuse_port(self):
+            supervisor, port = self.serve(reuse_port=True)
+            try:
+                pids = set(get(port) for _ in xrange(40))
+                eq_(len(pids), 2)
+                ok_(supervisor not in pids)
+            finally:
+                self.stop(supervisor)
+
+    def test_websockets_closed_on_stop(self):
+        supervisor, port = self.serve(reuse_port=False, app=echo_app,
+                                      workers=1)
+        sock = socket.create_connection(('127.0.0.1', port))
+        try:
+            sock.sendall('GET / HTTP/1.1\r\n'
+                         'Host: localhost\r\n'
+                         'Upgrade: websocket\r\n'
+                         'Connection: Upgrade\r\n'
+                         'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                         'Sec-WebSocket-Version: 13\r\n\r\n')
+            response = ''
+            while '\r\n\r\n' not in response:
+                response += sock.recv(1024)
+            ok_(response.startswith('HTTP/1.1 101'))
+            os.kill(supervisor, signal.SIGTERM)
+            sock.settimeout(5)
+            eq_(sock.recv(4), '\x88\x11\x03\xe9')
+            started = time.time()
+            eq_(os.waitpid(supervisor, 0)[1], 0)
+            ok_(time.time() - started < 5)
+        finally:
+            sock.close()
@@ -0,0 +1,64 @@
+from eventlet.green import socket
+from nose.tools import eq_, ok_
+from stargate import WebSocketAwareResource
+from stargate.reaper import Reaper, is_dead
+from stargate.view import WebSocket
+from unittest import TestCase
+import eventlet
+
+ENVIRON = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+
+class TestIsDead(TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.ws = WebSocket(self.ours, ENVIRON)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_alive(self):
+        ok_(not is_dead(self.ws))
+
+    def test_alive_with_pending_data(self):
+        self.theirs.sendall('\x81\x00')
+        ok_(not is_dead(self.ws))
+        # the pending data hasn't been consumed
+        eq_(self.ours.recv(2), '\x81\x00')
+
+    def test_peer_hung_up(self):
+        self.theirs.close()
+        ok_(is_dead(self.ws))
+
+    def test_socket_closed(self):
+        self.ours.close()
+        ok_(is_dead(self.ws))
+
+    def test_terminated(self):
+        self.ws.client_terminated = self.ws.server_terminated = True
+        ok_(is_dead(self.ws))
+
+
+class TestReaper(TestCase):
+
+    def test_reap(self):
+        reaper = Reaper(interval=0.01)
+        ctx = WebSocketAwareResource()
+        ctx.reaper = reaper
+        pairs = [socket.socketpair() for i in range(3)]
+        listeners = [WebSocket(ours, ENVIRON) for ours, theirs in pairs]
+        for ws in listeners:
+            ctx.add_listener(ws)
+        pairs[0][1].close()
+        eventlet.sleep(0.05)
+        eq_(ctx.listeners, set(listeners[1:]))
+        for ours, theirs in pairs[1:]:
+            theirs.close()
+        eq_(reaper.reap(), 2)
+        eq_(ctx.listeners, set())
+        eq_(len(reaper._resources), 0)
+        reaper.stop()
+        for ours, theirs in pairs:
+            ours.close()
@@ -0,0 +1,86 @@
+from nose.tools import eq_, ok_
+from stargate import WebSocketAwareResource
+from stargate.registry import ResourceRegistry, split_path
+from stargate.view import WebSocket
+from unittest import TestCase
+import mock
+
+ENVIRON = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+
+class Node(WebSocketAwareResource):
+
+    def __init__(self, name='', parent=None):
+        self.__name__ = name
+        self.__parent__ = parent
+
+
+def make_ws():
+    return WebSocket(mock.Mock(), ENVIRON)
+
+
+class TestResourceRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = ResourceRegistry()
+        Node.registry = self.registry
+        self.root = Node()
+        self.jobs = Node('jobs', self.root)
+        self.job1 = Node('1', self.jobs)
+        self.job2 = Node('2', self.jobs)
+        self.users = Node('users', self.root)
+
+    def tearDown(self):
+        del Node.registry
+
+    def test_split_path(self):
+        eq_(split_path('/jobs/1/'), ('jobs', '1'))
+        eq_(split_path('/'), ())
+
+    def test_registered_while_listened_to(self):
+        ws = make_ws()
+        self.job1.add_listener(ws)
+        ok_(self.job1 in self.registry)
+        eq_(self.registry.lookup('/jobs/1'), self.job1)
+        eq_(self.registry.lookup('/jobs/1/'), self.job1)
+        self.job1.remove_listener(ws)
+        ok_(self.job1 not in self.registry)
+        eq_(self.registry.lookup('/jobs/1'), None)
+        eq_(len(self.registry), 0)
+
+    def test_publish_by_path(self):
+        ws = make_ws()
+        self.job1.add_listener(ws)
+        eq_(self.registry.publish('/jobs/1', 'hello'), 1)
+        ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+        eq_(self.registry.publish('/jobs/3', 'hello'), 0)
+
+    def test_publish_subtree(self):
+        listeners = {}
+        for node in (self.root, self.jobs, self.job1, self.job2, self.users):
+            listeners[node] = ws = make_ws()
+            node.add_listener(ws)
+        eq_(sorted(r.path for r in self.registry.subtree('/jobs/')),
+            ['/jobs', '/jobs/1', '/jobs/2'])
+        eq_(self.registry.publish_subtree('/jobs/', 'hi'), 3)
+        for node in (self.jobs, self.job1, self.job2):
+            eq_(listeners[node].sock.sendall.call_count, 1)
+        for node in (self.root, self.users):
+            eq_(listeners[node].sock.sendall.call_count, 0)
+        eq_(list(self.registry.subtree('/nothing')), [])
+
+    def test_send_to_deduplicates(self):
+        shared = make_ws()
+        only_job2 = make_ws()
+        self.job1.add_listener(shared)
+        self.job2.add_listener(shared)
+        self.job2.add_listener(only_job2)
+        eq_(self.registry.send_to([self.job1, self.job2], 'hi'), 2)
+        eq_(shared.sock.sendall.call_count, 1)
+        eq_(only_job2.sock.sendall.call_count, 1)
+
+    def test_unregister_prunes_trie(self):
+        ws = make_ws()
+        self.job1.add_listener(ws)
+        self.job1.remove_listener(ws)
+        eq_(self.registry._root.children, {})
@@ -1,7 +1,12 @@
+import os
+
+import eventlet
 from eventlet.green import socket
 from eventlet.websocket import WebSocket
 from nose.tools import *
 from stargate import WebSocketAwareResource
+from stargate import frames
+from stargate.view import WebSocket as HybiWebSocket, HixieWebSocket
 from unittest import TestCase
 import mock
 
@@ -82,3 +87,267 @@ class TestWebSocketAwareContext(TestCase):
         # The broken socket should have been removed
         eq_(ctx.listeners, set([ws]))
 
+
+    def test_send_frames_once_per_protocol(self):
+        ctx = self.ctx
+        hybi = [HybiWebSocket(mock.Mock(), self.environ) for i in range(3)]
+        hixie = [HixieWebSocket(mock.Mock(), self.environ) for i in range(3)]
+        for ws in hybi + hixie:
+            ctx.add_listener(ws)
+        with mock.patch.object(frames, 'encode_hybi',
+                               wraps=frames.encode_hybi) as encode:
+            with mock.patch.dict(frames.ENCODERS, {frames.HYBI: encode}):
+                ctx.send('hello')
+        eq_(encode.call_count, 1)
+        for ws in hybi:
+            ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+        for ws in hixie:
+            ws.socket.sendall.assert_called_once_with('\x00hello\xff')
+
+    def test_send_binary(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        self.ctx.send('\x00\x01', binary=True)
+        ws.sock.sendall.assert_called_once_with('\x82\x02\x00\x01')
+
+
+class TestPublish(TestCase):
+
+    def setUp(self):
+        self.ctx = WebSocketAwareResource()
+        self.environ = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+    def make_ws(self, sendall=None):
+        sock = mock.Mock()
+        if sendall:
+            sock.sendall.side_effect = sendall
+        ws = HybiWebSocket(sock, self.environ)
+        self.ctx.add_listener(ws)
+        return ws
+
+    def test_publish_returns_immediately(self):
+        ws = self.make_ws()
+        delivery = self.ctx.publish('hello')
+        ok_(not ws.sock.sendall.called)
+        stats = delivery.wait()
+        ok_(delivery.ready)
+        eq_(stats.delivered, 1)
+        eq_(stats.listeners, 1)
+        ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+
+    def test_slow_listener_times_out(self):
+        fast = [self.make_ws() for i in range(3)]
+        slow = self.make_ws(sendall=lambda data: eventlet.sleep(1))
+        with eventlet.Timeout(0.5):
+            stats = self.ctx.publish('hello', timeout=0.05).wait()
+        eq_(stats.delivered, 3)
+        eq_(stats.timed_out, 1)
+        eq_(stats.dropped, [slow])
+        eq_(self.ctx.listeners, set(fast))
+        ok_(slow.sock.close.called)
+
+    def test_failed_listener_removed(self):
+        def broken(data):
+            raise socket.error(32, 'Broken pipe')
+        ok = self.make_ws()
+        self.make_ws(sendall=broken)
+        stats = self.ctx.publish('hello').wait()
+        eq_(stats.delivered, 1)
+        eq_(stats.failed, 1)
+        eq_(self.ctx.listeners, set([ok]))
+
+    def test_pool_is_bounded(self):
+        self.ctx.pool_size = 2
+        for i in range(5):
+            self.make_ws()
+        stats = self.ctx.publish('hello').wait()
+        eq_(self.ctx.pool.size, 2)
+        eq_(stats.delivered, 5)
+
+
+class TestListenerCleanup(TestCase):
+
+    def setUp(self):
+        self.ctx = WebSocketAwareResource()
+        self.environ = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+    def test_listener_set_snapshot(self):
+        ws1 = HybiWebSocket(mock.Mock(), self.environ)
+        ws2 = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws1)
+        snapshot = self.ctx.listeners.snapshot()
+        self.ctx.add_listener(ws2)
+        eq_(snapshot, frozenset([ws1]))
+        eq_(self.ctx.listeners, set([ws1, ws2]))
+        # removing while iterating is safe
+        for ws in self.ctx.listeners:
+            self.ctx.remove_listener(ws)
+        eq_(len(self.ctx.listeners), 0)
+
+    def test_any_socket_error_skips_listener(self):
+        broken = HybiWebSocket(mock.Mock(), self.environ)
+        broken.sock.sendall.side_effect = socket.error(104, 'reset')
+        ok = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(broken)
+        self.ctx.add_listener(ok)
+        self.ctx.send('hello')
+        ok.sock.sendall.assert_called_once_with('\x81\x05hello')
+        eq_(self.ctx.listeners, set([ok]))
+
+    def test_removed_when_handler_exits(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        other = WebSocketAwareResource()
+        self.ctx.add_listener(ws)
+        other.add_listener(ws)
+        ws.fire_close_callbacks()
+        eq_(self.ctx.listeners, set())
+        eq_(other.listeners, set())
+
+    def test_remove_listener_forgets_callback(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        self.ctx.remove_listener(ws)
+        eq_(ws._close_callbacks, [])
+
+
+class TestTickBatching(TestCase):
+
+    def setUp(self):
+        self.ctx = WebSocketAwareResource()
+        self.ctx.tick = 0.02
+        self.environ = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+    def test_messages_in_a_tick_written_together(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        plain = WebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        self.ctx.add_listener(plain)
+        for msg in ('a', 'b', 'c'):
+            self.ctx.send(msg)
+        ok_(not ws.sock.sendall.called)
+        eventlet.sleep(0.05)
+        ws.sock.sendall.assert_called_once_with('\x81\x01a\x81\x01b\x81\x01c')
+        eq_(plain.socket.sendall.call_count, 3)
+        self.ctx.send('d')
+        eventlet.sleep(0.05)
+        eq_(ws.sock.sendall.call_args, mock.call('\x81\x01d'))
+
+    def test_flush_now(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        self.ctx.send('a')
+        self.ctx.flush()
+        ws.sock.sendall.assert_called_once_with('\x81\x01a')
+        eventlet.sleep(0.05)
+        eq_(ws.sock.sendall.call_count, 1)
+
+
+class SequencedResource(WebSocketAwareResource):
+
+    replay_size = 3
+    snapshots = 0
+
+    def sequence_message(self, seq, message):
+        return '%d:%s' % (seq, message)
+
+    def snapshot(self, ws):
+        self.snapshots += 1
+        ws.send('state')
+
+
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.ctx = SequencedResource()
+        self.environ = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+    def sent(self, ws):
+        return [c[0][0][2:] for c in ws.sock.sendall.call_args_list]
+
+    def test_sequence_numbers(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        for msg in 'abcd':
+            self.ctx.send(msg)
+        eq_(self.ctx.sequence, 4)
+        eq_(self.sent(ws), ['1:a', '2:b', '3:c', '4:d'])
+        eq_(self.ctx.missed(0), None)
+        eq_([seq for seq, frames in self.ctx.missed(2)], [3, 4])
+        eq_(self.ctx.missed(4), [])
+
+    def test_reconnect_replays_missed(self):
+        for msg in 'abcd':
+            self.ctx.send(msg)
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws, last_seq=2)
+        eq_(self.sent(ws), ['3:c', '4:d'])
+        eq_(self.ctx.snapshots, 0)
+        self.ctx.send('e')
+        eq_(self.sent(ws), ['3:c', '4:d', '5:e'])
+
+    def test_reconnect_falls_back_to_snapshot(self):
+        for msg in 'abcde':
+            self.ctx.send(msg)
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws, last_seq=1)
+        eq_(self.ctx.snapshots, 1)
+        eq_(self.sent(ws), ['state'])
+
+    def test_up_to_date_client_gets_nothing(self):
+        self.ctx.send('a')
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws, last_seq=1)
+        eq_(self.sent(ws), [])
+
+    def test_reconnect_from_ahead_gets_snapshot(self):
+        # the client was numbered by a process sending for longer
+        self.ctx.send('a')
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws, last_seq=40)
+        eq_(self.ctx.snapshots, 1)
+        self.ctx.send('b')
+        eq_(self.sent(ws), ['state', '2:b'])
+
+    def test_reconnect_from_other_epoch_gets_snapshot(self):
+        for msg in 'ab':
+            self.ctx.send(msg)
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws, last_seq=1, epoch='other')
+        eq_(self.ctx.snapshots, 1)
+        eq_(self.sent(ws), ['state'])
+
+    def test_same_epoch_replays(self):
+        for msg in 'ab':
+            self.ctx.send(msg)
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws, last_seq=1, epoch=self.ctx.epoch)
+        eq_(self.sent(ws), ['2:b'])
+
+    def test_epoch_per_process(self):
+        epoch = self.ctx.epoch
+        eq_(self.ctx.epoch, epoch)
+        ok_(epoch.startswith('%x.' % os.getpid()))
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            ok_(self.ctx.epoch != epoch)
+
+    def test_published_messages_are_sequenced(self):
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        self.ctx.send('a')
+        self.ctx.publish('b').wait()
+        eq_(self.ctx.sequence, 2)
+        eq_(self.sent(ws), ['1:a', '2:b'])
+        late = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(late, last_seq=0)
+        eq_(self.sent(late), ['1:a', '2:b'])
+
+    def test_sequenced_at_end_of_tick(self):
+        self.ctx.tick = 0.01
+        ws = HybiWebSocket(mock.Mock(), self.environ)
+        self.ctx.add_listener(ws)
+        self.ctx.send('a')
+        self.ctx.send('b')
+        eq_(self.ctx.sequence, 0)
+        self.ctx.flush()
+        eq_(self.ctx.sequence, 2)
+        eq_(self.sent(ws), ['1:a\x81\x03' '2:b'])
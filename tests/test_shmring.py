@@ -0,0 +1,164 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+
+import eventlet
+from nose.tools import eq_, ok_, assert_raises
+from stargate import WebSocketAwareResource
+from stargate.registry import ResourceRegistry
+from stargate.shmring import RingFull, SharedMemoryBackplane, SharedRing
+from stargate.view import WebSocket
+from unittest import TestCase
+import mock
+
+ENVIRON = dict(HTTP_ORIGIN='http://localhost', PATH_INFO='test')
+
+
+class TestSharedRing(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_append_and_read(self):
+        ring = SharedRing(self.path, capacity=1024)
+        reader = ring.reader()
+        eq_(reader.read(), [])
+        eq_(ring.append('one'), 1)
+        eq_(ring.append('two'), 2)
+        eq_(reader.read(), ['one', 'two'])
+        eq_(reader.read(), [])
+
+    def test_attach_to_existing(self):
+        ring = SharedRing(self.path, capacity=1024)
+        other = SharedRing(self.path, capacity=1)
+        eq_(other.capacity, 1024)
+        reader = other.reader()
+        ring.append('shared')
+        eq_(reader.read(), ['shared'])
+
+    def test_not_a_ring(self):
+        with open(self.path, 'w') as f:
+            f.write('x' * 100)
+        assert_raises(ValueError, SharedRing, self.path)
+
+    def test_wraps_around(self):
+        ring = SharedRing(self.path, capacity=64)
+        reader = ring.reader()
+        for i in range(20):
+            record = chr(ord('a') + i) * 10
+            ring.append(record)
+            eq_(reader.read(), [record])
+        ok_(ring.write_position > ring.capacity)
+
+    def test_slow_reader_is_lapped(self):
+        ring = SharedRing(self.path, capacity=64)
+        reader = ring.reader()
+        for i in range(20):
+            ring.append('%010d' % i)
+        records = reader.read()
+        eq_(reader.lost, 1)
+        eq_(records, [])
+        ring.append('fresh')
+        eq_(reader.read(), ['fresh'])
+
+    def test_record_too_large(self):
+        ring = SharedRing(self.path, capacity=64)
+        assert_raises(RingFull, ring.append, 'x' * 64)
+
+
+
+class TestProcesses(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ring = SharedRing(os.path.join(self.tmp, 'ring'), capacity=4096)
+
+    def tearDown(self):
+        self.ring.close()
+        shutil.rmtree(self.tmp)
+
+    def fork(self, func):
+        pid = os.fork()
+        if not pid:
+            try:
+                func()
+            finally:
+                os._exit(0)
+        return pid
+
+    def test_writers_in_forked_workers_excluded(self):
+        self.ring._lock()
+        try:
+            child = self.fork(lambda: self.ring.append('child'))
+            time.sleep(0.2)
+            eq_(os.waitpid(child, os.WNOHANG), (0, 0))
+        finally:
+            fcntl.flock(self.ring._fd, fcntl.LOCK_UN)
+        eq_(os.waitpid(child, 0)[1], 0)
+
+    def test_records_never_torn(self):
+        reader = self.ring.reader()
+        def write(char):
+            deadline = time.time() + 0.5
+            size = 100
+            while time.time() < deadline:
+                self.ring.append(char * size)
+                size = size % 1500 + 97
+                time.sleep(0.0002)
+        children = [self.fork(lambda c=c: write(c)) for c in 'abc']
+        read = 0
+        deadline = time.time() + 0.6
+        while time.time() < deadline:
+            for record in reader.read():
+                eq_(len(set(record)), 1)
+                read += 1
+        for pid in children:
+            eq_(os.waitpid(pid, 0)[1], 0)
+        ok_(read)
+
+
+class Job(WebSocketAwareResource):
+
+    def __init__(self, registry, backplane):
+        self.__name__ = 'job'
+        self.__parent__ = WebSocketAwareResource()
+        self.registry = registry
+        self.backplane = backplane
+
+
+class TestSharedMemoryBackplane(TestCase):
+
+    def test_send_reaches_every_worker(self):
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'ring')
+        listeners = []
+        jobs = []
+        backplanes = []
+        try:
+            for i in range(3):
+                registry = ResourceRegistry()
+                backplane = SharedMemoryBackplane(registry, path,
+                                                  capacity=4096)
+                backplane.start()
+                backplanes.append(backplane)
+                job = Job(registry, backplane)
+                ws = WebSocket(mock.Mock(), ENVIRON)
+                job.add_listener(ws)
+                jobs.append(job)
+                listeners.append(ws)
+            jobs[1].send('hello', key='k')
+            with eventlet.Timeout(1):
+                while not all(ws.sock.sendall.called for ws in listeners):
+                    eventlet.sleep(0.005)
+            for ws in listeners:
+                ws.sock.sendall.assert_called_once_with('\x81\x05hello')
+        finally:
+            for backplane in backplanes:
+                backplane.close()
+            shutil.rmtree(tmp)
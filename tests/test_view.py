@@ -0,0 +1,310 @@
+from nose.tools import eq_, ok_, raises
+from unittest import TestCase
+import errno
+import mmap
+import os
+import tempfile
+
+import eventlet
+from eventlet.green import socket
+import mock
+from ws4py.framing import Frame, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, \
+     OPCODE_PING
+
+from stargate.deflate import Deflate
+from stargate.framing import FrameParser
+from stargate.view import WebSocket
+
+KEY = 'abcd'
+
+
+def client_frame(payload, opcode=OPCODE_TEXT, fin=1):
+    return Frame(opcode=opcode, body=payload, fin=fin,
+                 masking_key=KEY).build()
+
+
+class WebSocketTestCase(TestCase):
+
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.ws = WebSocket(self.server, {})
+        self.reads = 0
+        read = self.ws.read_from_connection
+        def counting_read(amount):
+            self.reads += 1
+            return read(amount)
+        self.ws.read_from_connection = counting_read
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+
+class TestReceive(WebSocketTestCase):
+
+    def test_pipelined_messages_cost_one_read(self):
+        self.client.sendall(''.join([client_frame('m%d' % i)
+                                     for i in xrange(50)]))
+        eq_([self.ws.receive() for i in xrange(50)],
+            ['m%d' % i for i in xrange(50)])
+        eq_(self.reads, 1)
+
+    def test_message_larger_than_buffer(self):
+        payload = 'x' * (self.ws.read_buffer_size * 3 + 7)
+        eventlet.spawn(self.client.sendall,
+                       client_frame(payload, opcode=OPCODE_BINARY))
+        eq_(self.ws.receive(), payload)
+
+    def test_pings_answered_while_queued(self):
+        self.client.sendall(client_frame('a') + client_frame('p', OPCODE_PING))
+        eq_(self.ws.receive(), 'a')
+        eq_(self.client.recv(10), '\x8a\x01p')
+
+    def test_messages_before_close_are_returned(self):
+        self.client.sendall(client_frame('last') +
+                            client_frame('\x03\xe8', OPCODE_CLOSE))
+        eq_(self.ws.receive(), 'last')
+        self.assertRaises(IOError, self.ws.receive)
+        eq_(self.client.recv(10), '\x88\x02\x03\xe8')
+
+    def test_message_obj(self):
+        self.client.sendall(client_frame('hi'))
+        message = self.ws.receive(message_obj=True)
+        ok_(message.is_text)
+        eq_(message.data, 'hi')
+
+    @raises(IOError)
+    def test_peer_gone(self):
+        self.client.close()
+        self.ws.receive()
+
+
+class TestZeroCopy(WebSocketTestCase):
+
+    def test_receive_as_view(self):
+        payload = '\x00\x01' * 50000
+        eventlet.spawn(self.client.sendall,
+                       client_frame(payload, opcode=OPCODE_BINARY))
+        view = self.ws.receive(as_view=True)
+        ok_(isinstance(view, memoryview))
+        eq_(view.tobytes(), payload)
+
+    def test_send_memoryview(self):
+        self.ws.send(memoryview(bytearray('abc')), binary=True)
+        eq_(self.client.recv(10), '\x82\x03abc')
+
+    def test_send_memoryview_large(self):
+        payload = bytearray('x' * 70000)
+        eventlet.spawn(self.ws.send, memoryview(payload))
+        received = ''
+        while len(received) < 70010:
+            received += self.client.recv(70010)
+        eq_(received, '\x81\x7f' + '\x00' * 5 + '\x01\x11\x70' + 'x' * 70000)
+
+
+class TestReceiveFragments(WebSocketTestCase):
+
+    def collect(self):
+        return list(self.ws.receive_fragments())
+
+    def test_large_frame_in_pieces(self):
+        size = self.ws.read_buffer_size
+        payload = ''.join([chr(i % 256) for i in xrange(size * 3 + 5)])
+        eventlet.spawn(self.client.sendall,
+                       client_frame(payload, opcode=OPCODE_BINARY))
+        pieces = self.collect()
+        ok_(len(pieces) > 1)
+        ok_(all(len(data) <= size for data, last in pieces))
+        eq_([last for data, last in pieces],
+            [False] * (len(pieces) - 1) + [True])
+        eq_(''.join([str(data) for data, last in pieces]), payload)
+
+    def test_larger_than_max_message_size(self):
+        self.ws.stream.max_message_size = 1000
+        payload = 'x' * (self.ws.read_buffer_size * 2)
+        eventlet.spawn(self.client.sendall,
+                       client_frame(payload, opcode=OPCODE_BINARY))
+        eq_(''.join([str(data) for data, last in self.collect()]), payload)
+        # while whole messages stay limited
+        self.client.sendall(client_frame(payload, opcode=OPCODE_BINARY))
+        self.assertRaises(IOError, self.ws.receive)
+        eq_(self.client.recv(4), '\x88\x11\x03\xf1')
+
+    def test_max_streamed_size(self):
+        self.ws.stream.max_streamed_size = 1000
+        self.client.sendall(client_frame('x' * 1001, opcode=OPCODE_BINARY))
+        self.assertRaises(IOError, self.collect)
+
+    def test_fragmented_message_with_ping(self):
+        self.client.sendall(client_frame('one ', fin=0) +
+                            client_frame('p', OPCODE_PING) +
+                            client_frame('two', opcode=0))
+        pieces = self.collect()
+        eq_([(str(data), last) for data, last in pieces],
+            [('one ', False), ('two', True)])
+        eq_(self.client.recv(10), '\x8a\x01p')
+        self.client.sendall(client_frame('next'))
+        eq_(self.ws.receive(), 'next')
+
+    def test_queued_message_yielded_whole(self):
+        self.client.sendall(client_frame('a') + client_frame('b'))
+        eq_(self.ws.receive(), 'a')
+        eq_(self.collect(), [('b', True)])
+
+    def test_message_pipelined_after_streamed_one(self):
+        self.client.sendall(client_frame('first', fin=0) +
+                            client_frame('!', opcode=0) +
+                            client_frame('sec', fin=0) +
+                            client_frame('ond', opcode=0))
+        eq_([(str(data), last) for data, last in self.collect()],
+            [('first', False), ('!', True)])
+        with eventlet.Timeout(1):
+            eq_(self.ws.receive(), 'second')
+
+    def test_invalid_utf8(self):
+        self.client.sendall(client_frame('ok', fin=0) +
+                            client_frame('\xff', opcode=0))
+        self.assertRaises(IOError, self.collect)
+
+
+class TestSendStream(WebSocketTestCase):
+
+    def frames(self, sender, *args, **kw):
+        """Runs ``sender`` and returns the frames the client receives"""
+        gt = eventlet.spawn(sender, *args, **kw)
+        parser = FrameParser()
+        frames = []
+        while not frames or not frames[-1].fin:
+            frames.extend(parser.feed(self.client.recv(65536)))
+        gt.wait()
+        return [(f.opcode, f.fin, str(f.payload)) for f in frames]
+
+    def test_text_generator(self):
+        eq_(self.frames(self.ws.send, (c for c in ['a', 'b', 'c'])),
+            [(OPCODE_TEXT, 0, 'a'), (0, 0, 'b'), (0, 1, 'c')])
+
+    def test_binary_generator(self):
+        eq_(self.frames(self.ws.send, (c for c in ['a', 'b']), binary=True),
+            [(OPCODE_BINARY, 0, 'a'), (0, 1, 'b')])
+
+    def test_single_item_generator(self):
+        eq_(self.frames(self.ws.send, (c for c in ['a']), binary=True),
+            [(OPCODE_BINARY, 1, 'a')])
+
+    def test_empty_source(self):
+        eq_(self.frames(self.ws.send_stream, iter([])),
+            [(OPCODE_BINARY, 1, '')])
+
+    def test_large_chunks_split(self):
+        eq_(self.frames(self.ws.send_stream, ['abcde', 'f'], fragment_size=2),
+            [(OPCODE_BINARY, 0, 'ab'), (0, 0, 'cd'), (0, 0, 'e'),
+             (0, 1, 'f')])
+
+    def test_buffer(self):
+        eq_(self.frames(self.ws.send_stream, bytearray('abcde'),
+                        fragment_size=2),
+            [(OPCODE_BINARY, 0, 'ab'), (0, 0, 'cd'), (0, 1, 'e')])
+
+    def test_file(self):
+        source = tempfile.TemporaryFile()
+        source.write('x' * 100 + 'y' * 50)
+        source.seek(0)
+        eq_(self.frames(self.ws.send_stream, source, fragment_size=100),
+            [(OPCODE_BINARY, 0, 'x' * 100), (0, 1, 'y' * 50)])
+
+    def test_mmap(self):
+        source = tempfile.TemporaryFile()
+        source.write('abc')
+        source.flush()
+        mapped = mmap.mmap(source.fileno(), 0)
+        eq_(self.frames(self.ws.send_stream, mapped),
+            [(OPCODE_BINARY, 1, 'abc')])
+
+    def test_sendfile(self):
+        def fake_sendfile(out, fd, offset, count):
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(out, os.read(fd, count))
+        source = tempfile.TemporaryFile()
+        source.write('skipped' + 'z' * 200000)
+        source.seek(7)
+        with mock.patch('stargate.view._sendfile', fake_sendfile):
+            frames = self.frames(self.ws.send_stream, source,
+                                 fragment_size=150000)
+        eq_(frames, [(OPCODE_BINARY, 0, 'z' * 150000),
+                     (0, 1, 'z' * 50000)])
+        eq_(source.tell(), 200007)
+
+    def test_compressed(self):
+        self.ws.deflate = Deflate()
+        frames = self.frames(self.ws.send_stream, ['hello ' * 100] * 3,
+                             binary=False)
+        eq_(frames[0][0], OPCODE_TEXT)
+        eq_(Deflate().decompress(''.join([f[2] for f in frames])),
+            'hello ' * 300)
+
+
+class TestGatherWrites(TestCase):
+
+    def setUp(self):
+        self.sock = mock.Mock()
+        self.ws = WebSocket(self.sock, {})
+
+    def test_small_frames_joined(self):
+        self.ws.send('hello')
+        self.sock.sendall.assert_called_once_with(bytearray('\x81\x05hello'))
+
+    @mock.patch('stargate.view._MSG_MORE', 0x8000)
+    def test_large_payload_not_copied(self):
+        payload = 'x' * self.ws.gather_threshold
+        self.ws.send(payload, binary=True)
+        eq_(self.sock.sendall.call_args_list,
+            [mock.call('\x82\x7e\x40\x00', 0x8000), mock.call(payload)])
+        ok_(self.sock.sendall.call_args_list[1][0][0] is payload)
+
+    @mock.patch('stargate.view._has_sendmsg', True)
+    def test_sendmsg(self):
+        sent = []
+        def sendmsg(buffers):
+            # takes at most 3 bytes at a time
+            data = ''.join([memoryview(buf).tobytes() for buf in buffers])[:3]
+            sent.append(data)
+            return len(data)
+        self.sock.fd.sendmsg.side_effect = sendmsg
+        self.ws.send('hello')
+        eq_(''.join(sent), '\x81\x05hello')
+        eq_(len(sent), 3)
+        ok_(not self.sock.sendall.called)
+
+
+class TestConcurrentWrites(WebSocketTestCase):
+
+    def test_frames_not_interleaved(self):
+        payload = 'x' * 100000
+        pool = eventlet.GreenPool()
+        for i in xrange(10):
+            pool.spawn(self.ws.send, payload, binary=True)
+        parser = FrameParser()
+        frames = []
+        while len(frames) < 10:
+            frames.extend(parser.feed(self.client.recv(65536)))
+        pool.waitall()
+        eq_([str(f.payload) for f in frames], [payload] * 10)
+
+    def test_reader_does_not_block_writers(self):
+        reader = eventlet.spawn(self.ws.receive)
+        eventlet.sleep(0)
+        with eventlet.Timeout(1):
+            self.ws.send('while reading')
+            eq_(self.client.recv(100), '\x81\x0dwhile reading')
+        self.client.sendall(client_frame('done'))
+        eq_(reader.wait(), 'done')
+
+    def test_no_writes_after_close(self):
+        self.ws.close()
+        self.client.recv(100)
+        try:
+            self.ws.send('too late')
+        except socket.error, e:
+            eq_(e.errno, errno.EPIPE)
+        else:
+            self.fail('send after close succeeded')